@@ -0,0 +1,45 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Benchmarks for processing file records in xnat-query-files
+
+Run with `asv run` or, for a quick check of the current tree,
+`asv run --python=same --quick`.
+"""
+
+from pathlib import PurePosixPath
+
+from datalad_xnat.query_files import (
+    _get_name_suffix,
+    _parse_file_uri,
+)
+
+
+class FileURIParsing:
+    """Decomposition of file URIs, as done for every file record"""
+
+    def setup(self):
+        self.uris = [
+            f'/data/experiments/XNAT_E{i:05d}/scans/{i % 12}/resources/'
+            f'{i % 7}/files/{i}.MR.Sample_DICOM.2.1.20010108.120022.dcm'
+            for i in range(10000)
+        ]
+
+    def time_parse_file_uri(self):
+        for uri in self.uris:
+            _parse_file_uri(uri)
+
+    def time_get_name_suffix(self):
+        for uri in self.uris:
+            _get_name_suffix(uri)
+
+    def time_pathlib_reference(self):
+        # previous implementation, kept for comparison
+        for uri in self.uris:
+            PurePosixPath(uri).parts[5]
+            PurePosixPath(uri).suffix
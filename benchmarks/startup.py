@@ -0,0 +1,31 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Benchmarks for the start-up of the extension and its commands
+
+Each benchmark runs in a fresh interpreter, in which DataLad itself is
+imported already, as it is when the `datalad` command starts.
+"""
+
+_setup = 'import datalad.interface.base, datalad.distribution.dataset'
+
+
+class ImportTime:
+    """Import of the extension, and of its command modules"""
+
+    def timeraw_import_extension(self):
+        return 'import datalad_xnat; datalad_xnat.command_suite', _setup
+
+    def timeraw_import_query_files(self):
+        return 'import datalad_xnat.query_files', _setup
+
+    def timeraw_import_init(self):
+        return 'import datalad_xnat.init', _setup
+
+    def timeraw_import_update(self):
+        return 'import datalad_xnat.update', _setup
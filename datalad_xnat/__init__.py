@@ -22,6 +22,11 @@ command_suite = (
     ]
 )
 
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+
+def __getattr__(name):
+    # determining the version can involve calling git, only do it on demand
+    if name == '__version__':
+        from ._version import get_versions
+        version = globals()['__version__'] = get_versions()['version']
+        return version
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
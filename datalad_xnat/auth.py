@@ -0,0 +1,119 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Configuration of XNAT server authentication in a dataset
+
+This is what the `cfg_xnat_dataset` procedure does, but it runs in the
+current process, without starting an interpreter for the procedure.
+"""
+
+import logging
+
+from datalad.consts import DATALAD_SPECIAL_REMOTE
+from datalad.support.annexrepo import AnnexRepo
+from datalad.support.exceptions import RemoteNotAvailableError
+
+lgr = logging.getLogger('datalad.xnat.auth')
+
+
+def configure_dataset_auth(ds, name=None, url=None, credential_name=None):
+    """Configure a dataset with XNAT server authentication
+
+    A DataLad provider configuration for the XNAT server is saved in the
+    dataset, and the datalad special remote is enabled. Any value that is
+    not given is taken from the configuration of the dataset, see the
+    `cfg_xnat_dataset` procedure. A configured dataset is recognized
+    without running git or git-annex.
+
+    Parameters
+    ----------
+    ds: Dataset
+    name: str, optional
+      Name of the XNAT configuration.
+    url: str, optional
+      URL of the XNAT server. Asked for interactively, if not given or
+      configured.
+    credential_name: str, optional
+
+    Returns
+    -------
+    bool
+      Whether the provider configuration was changed and saved.
+    """
+    config = ds.config
+    if name is None:
+        name = config.get('datalad.xnat.default-name', 'default')
+    cfg_section = 'datalad.xnat.{}'.format(name)
+    if url is None:
+        url = config.obtain(
+            '{}.url'.format(cfg_section),
+            dialog_type='question',
+            title='XNAT server address',
+            text='Full URL of XNAT server '
+                 '(e.g. https://xnat.example.com:8443/xnat)',
+            store=False,
+            reload=False)
+    if credential_name is None:
+        credential_name = config.obtain(
+            '{}.credential-name'.format(cfg_section))
+
+    auth_cfg = """\
+[provider:xnat-{name}]
+url_re = {url}/.*
+credential = {credential_name}
+authentication_type = {auth_type}
+
+[credential:{credential_name}]
+type = {cred_type}
+""".format(
+        name=name,
+        # strip /, because it is in the template
+        url=url.rstrip('/'),
+        credential_name=credential_name,
+        auth_type=config.obtain(
+            '{}.authentication-type'.format(cfg_section),
+            'http_basic_auth'),
+        cred_type=config.obtain(
+            '{}.credential-type'.format(cfg_section),
+            'user_password'),
+    )
+
+    # place in a file that contains the config name
+    auth_file = ds.pathobj / '.datalad' / 'providers' / 'xnat-{}.cfg'.format(
+        name)
+    changed = not auth_file.exists() or auth_file.read_text() != auth_cfg
+    if changed:
+        # don't stress with prev variants, all in git anyways
+        if auth_file.exists():
+            auth_file.unlink()
+        auth_file.parent.mkdir(parents=True, exist_ok=True)
+        auth_file.write_text(auth_cfg)
+        ds.save(
+            str(auth_file),
+            to_git=True,
+            message="Configure XNAT access authentication",
+        )
+    else:
+        lgr.debug('XNAT authentication of %s is configured already', ds)
+
+    if config.get(f'remote.{DATALAD_SPECIAL_REMOTE}.annex-externaltype') \
+            == DATALAD_SPECIAL_REMOTE:
+        # nothing else to do, e.g. for every xnat-update of a mirror
+        return changed
+    # enable datalad special remote
+    repo = AnnexRepo(ds.path)
+    try:
+        repo.is_special_annex_remote(DATALAD_SPECIAL_REMOTE)
+    except RemoteNotAvailableError:
+        repo.init_remote(
+            DATALAD_SPECIAL_REMOTE,
+            ['encryption=none',
+             'type=external',
+             'externaltype=%s' % DATALAD_SPECIAL_REMOTE,
+             'autoenable=true'])
+    return changed
@@ -0,0 +1,221 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Interactive selection of what an XNAT dataset tracks
+
+Choices are shown one page at a time, and can be narrowed down by typing
+part of an ID or label, so that even long listings stay responsive. Every
+listing is requested only once, in the background: while a user picks a
+project, the subjects of candidate projects are requested already, and
+while a user picks a subject, the experiments of the project.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+lgr = logging.getLogger('datalad.xnat.browse')
+
+# number of choices shown at once
+page_size = 20
+# prefetch the next level, once a filter leaves this many candidates
+prefetch_candidates = 3
+
+
+class Listings(object):
+    """Cached listings of an XNAT server, requested in the background
+
+    Each listing is a list of (ID, label) tuples, for experiments
+    (ID, label, subject ID) tuples.
+
+    Parameters
+    ----------
+    platform: _XNAT
+    jobs: int, optional
+      Number of concurrent requests.
+    """
+    def __init__(self, platform, jobs=2):
+        self._platform = platform
+        self._pool = ThreadPoolExecutor(jobs)
+        self._lock = threading.Lock()
+        # (kind, *args) -> future of the listing
+        self._listings = {}
+
+    def prefetch(self, kind, *args):
+        """Request a listing in the background, unless it was requested
+
+        Parameters
+        ----------
+        kind: {'projects', 'subjects', 'experiments', 'collections'}
+        *args:
+          Project for 'subjects' and 'experiments', experiment for
+          'collections'.
+
+        Returns
+        -------
+        Future
+        """
+        key = (kind,) + args
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing is None:
+                listing = self._listings[key] = self._pool.submit(
+                    getattr(self, f'_list_{kind}'), *args)
+        return listing
+
+    def get(self, kind, *args):
+        """Return a listing, see `prefetch()`"""
+        return self.prefetch(kind, *args).result()
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+    def _list_projects(self):
+        return _get_choices(self._platform.get_projects(), 'name')
+
+    def _list_subjects(self, project):
+        return _get_choices(self._platform.get_subjects(project), 'label')
+
+    def _list_experiments(self, project):
+        # all experiments of a project with a single request, they are
+        # selected by subject from there
+        return _get_choices(
+            self._platform.get_experiments(project=project), 'label',
+            'subject_id')
+
+    def _list_collections(self, experiment):
+        collections = {}
+        for f in self._platform.get_files(experiment):
+            if f.get('collection'):
+                collections[f['collection']] = None
+        return [(c, None) for c in collections]
+
+
+def _get_choices(records, label, *fields):
+    choices = []
+    for rec in records or []:
+        rec = {k.lower(): v for k, v in rec.items()}
+        choices.append(
+            (rec['id'], rec.get(label) or None)
+            + tuple(rec.get(f) for f in fields))
+    return choices
+
+
+def select(ui, title, choices, prefetch=None):
+    """Let a user pick one of many choices
+
+    Parameters
+    ----------
+    ui:
+      DataLad UI.
+    title: str
+      What is selected, e.g. 'subject'.
+    choices: list
+      (ID, label) tuples.
+    prefetch: callable, optional
+      Called with the ID of every remaining candidate, once a filter
+      leaves only a few.
+
+    Returns
+    -------
+    str or None
+      The selected ID, None for no selection.
+    """
+    if not choices:
+        ui.message(f'No {title} to select from')
+        return None
+    # lower-case search text of every choice
+    index = [
+        (f'{i} {label}' if label else str(i)).lower() for i, label in choices
+    ]
+    term = ''
+    page = 0
+    matches = choices
+    while True:
+        npages = max(1, -(-len(matches) // page_size))
+        page = min(page, npages - 1)
+        first = page * page_size
+        ui.message('{} {}s{}, page {} of {}:'.format(
+            len(matches), title,
+            f" matching '{term}'" if term else '', page + 1, npages))
+        for n, (i, label) in enumerate(
+                matches[first:first + page_size], start=first + 1):
+            ui.message(f'  {n:>4}: {i}' + (f' ({label})' if label else ''))
+        answer = ui.question(
+            f'Select a {title} by its number, or type to filter '
+            "('>'/'<' next/previous page, '-' clears the filter, "
+            'empty for no selection)',
+            title=title.capitalize(),
+            default='',
+        ).strip()
+        if not answer:
+            return None
+        if answer in ('>', '<'):
+            page += 1 if answer == '>' else -1
+            page = max(page, 0)
+            continue
+        if answer.isdigit() and 0 < int(answer) <= len(matches):
+            return matches[int(answer) - 1][0]
+        # narrow down, or start over
+        term = '' if answer == '-' else answer.lower()
+        matches = [c for c, text in zip(choices, index) if term in text] \
+            if term else choices
+        page = 0
+        if prefetch and 0 < len(matches) <= prefetch_candidates:
+            for i, _ in matches:
+                prefetch(i)
+        if len(matches) == 1:
+            i, label = matches[0]
+            if ui.yesno(
+                    f'Select {title} {i}' + (f' ({label})' if label else ''),
+                    title=title.capitalize(),
+                    default=True):
+                return i
+
+
+def browse_selection(ui, platform, project=None, subject=None,
+                     experiment=None, collection=None):
+    """Ask for a project, subject, experiment, and collection to track
+
+    Only what is not given yet is asked for, from the listings of the
+    selections made before.
+
+    Returns
+    -------
+    tuple
+      project, subject, experiment, collection. Any can be None, for no
+      constraint.
+    """
+    listings = Listings(platform)
+    try:
+        if project is None:
+            project = select(
+                ui, 'project', listings.get('projects'),
+                prefetch=lambda p: listings.prefetch('subjects', p))
+        if project is None:
+            # without a project, there is nothing to narrow down further
+            return project, subject, experiment, collection
+        # needed next
+        listings.prefetch('experiments', project)
+        if subject is None:
+            subject = select(
+                ui, 'subject', listings.get('subjects', project))
+        if experiment is None:
+            experiment = select(
+                ui, 'experiment',
+                [(i, label) for i, label, s in listings.get(
+                    'experiments', project)
+                 if subject is None or s == subject],
+                prefetch=lambda e: listings.prefetch('collections', e))
+        if collection is None and experiment is not None:
+            selected = select(
+                ui, 'collection', listings.get('collections', experiment))
+            collection = [selected] if selected else None
+        return project, subject, experiment, collection
+    finally:
+        listings.close()
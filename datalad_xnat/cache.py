@@ -0,0 +1,199 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Host-wide cache of file content downloaded from XNAT
+
+Content is stored by the MD5 digest and size reported by XNAT, so it is
+shared by all datasets on a host, regardless of the server, project, or
+file name it was obtained for. Cached files are reflinked into the annex of
+a dataset where possible, and copied otherwise. They are never hardlinked,
+so that cache and annex cannot corrupt each other's content.
+
+The cache is disabled, unless a size limit is configured with
+`datalad.xnat.cache-max-size` (bytes, or with a K/M/G/T suffix). Its
+location can be set with `datalad.xnat.cache-dir`, and defaults to an
+`xnat` directory in DataLad's cache location. When the limit is exceeded,
+the least recently used content is removed.
+"""
+
+import logging
+import os
+import threading
+from pathlib import Path
+
+from .download import clone_file
+
+lgr = logging.getLogger('datalad.xnat.cache')
+
+_size_suffixes = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def _parse_size(spec):
+    """Parse a byte size, optionally with a K/M/G/T suffix"""
+    spec = str(spec).strip().upper().rstrip('B')
+    factor = _size_suffixes.get(spec[-1:], 1)
+    if factor > 1:
+        spec = spec[:-1]
+    return int(float(spec) * factor)
+
+
+class ContentCache(object):
+    """Content-addressed cache of files, with LRU eviction
+
+    Parameters
+    ----------
+    path: Path
+      Cache directory. It is created on demand.
+    max_size: int
+      Maximum total size of the cached content in bytes.
+    """
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.max_size = max_size
+        # total size of the cached content, determined on first use
+        self._size = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Return the configured cache, or None if it is disabled
+
+        Parameters
+        ----------
+        cfg: ConfigManager
+        """
+        max_size = cfg.get('datalad.xnat.cache-max-size')
+        if not max_size:
+            return None
+        try:
+            max_size = _parse_size(max_size)
+        except ValueError:
+            lgr.warning('Ignoring invalid datalad.xnat.cache-max-size %r',
+                        max_size)
+            return None
+        if max_size <= 0:
+            return None
+        path = cfg.get('datalad.xnat.cache-dir') or \
+            Path(cfg.obtain('datalad.locations.cache')) / 'xnat'
+        return cls(path, max_size)
+
+    def _get_object_path(self, md5, size):
+        return self.path / 'objects' / md5[:2] / f'{md5}-{size}'
+
+    def contains(self, md5, size):
+        """Whether content is in the cache"""
+        try:
+            return self._get_object_path(md5, size).stat().st_size == size
+        except OSError:
+            return False
+
+    def get(self, md5, size, dest):
+        """Provide cached content at `dest`, if there is any
+
+        Only the size of the content is checked. Its digest is verified
+        when the content is injected into an annex, which is the only place
+        it is read. Use `discard()` to remove content that fails this
+        verification.
+
+        Returns
+        -------
+        bool
+          Whether content was provided.
+        """
+        obj = self._get_object_path(md5, size)
+        try:
+            if obj.stat().st_size != size:
+                raise ValueError
+            method = clone_file(obj, dest)
+        except (OSError, ValueError):
+            return False
+        # the modification time tracks the last use
+        try:
+            os.utime(obj)
+        except OSError:
+            pass
+        lgr.debug('Obtained %s-%s from cache (%s)', md5, size, method)
+        return True
+
+    def put(self, src, md5, size):
+        """Add verified content to the cache, and evict old content"""
+        if size > self.max_size:
+            return
+        obj = self._get_object_path(md5, size)
+        if obj.exists():
+            return
+        obj.parent.mkdir(parents=True, exist_ok=True)
+        tmp = obj.with_name(f'{obj.name}.{os.getpid()}.'
+                            f'{threading.get_ident()}')
+        try:
+            clone_file(src, tmp)
+            os.replace(tmp, obj)
+        except OSError as e:
+            lgr.debug('Cannot add %s to cache: %s', src, e)
+            if tmp.exists():
+                tmp.unlink()
+            return
+        with self._lock:
+            if self._size is None:
+                # the first scan already includes the new content
+                self._get_size()
+            else:
+                self._size += size
+        self.evict()
+
+    def discard(self, md5, size):
+        """Remove content, e.g. after it failed verification"""
+        obj = self._get_object_path(md5, size)
+        if obj.exists():
+            lgr.warning('Removing content %s from cache', obj)
+            self._remove(obj)
+
+    def _get_size(self):
+        if self._size is None:
+            self._size = sum(p.stat().st_size for p in self._list())
+        return self._size
+
+    def _list(self):
+        objects = self.path / 'objects'
+        if not objects.exists():
+            return []
+        return [p for p in objects.glob('*/*') if '.' not in p.name]
+
+    def _remove(self, obj):
+        try:
+            size = obj.stat().st_size
+            obj.unlink()
+        except OSError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def evict(self):
+        """Remove least recently used content beyond the size limit"""
+        with self._lock:
+            if self._get_size() <= self.max_size:
+                return
+            # other processes may have changed the cache
+            entries = []
+            for p in self._list():
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+            entries.sort()
+            self._size = sum(e[1] for e in entries)
+            while entries and self._size > self.max_size:
+                _, size, p = entries.pop(0)
+                lgr.debug('Evicting %s from cache', p.name)
+                try:
+                    p.unlink()
+                except OSError:
+                    continue
+                self._size -= size
@@ -0,0 +1,535 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Download of file content from XNAT into git-annex
+
+Files are registered in a dataset by their annex key first. Their content is
+then downloaded into the annex' temporary directory and moved into the annex
+object store with `git annex reinject`, which also verifies the checksum.
+Downloads can run in parallel threads, while injection must happen in a
+single thread, because it modifies the repository.
+
+Large files are split into byte ranges that are downloaded in parallel,
+because the throughput of a single connection is often limited by the
+server, not by the network.
+
+Downloads of files with a known size and MD5 digest are kept when they are
+interrupted, and are resumed with range requests by the next attempt to
+download the same content.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+)
+from pathlib import Path
+from tempfile import mkstemp
+
+from datalad.support.exceptions import CommandError
+
+from .platform import XNATRequestError
+
+lgr = logging.getLogger('datalad.xnat.download')
+
+# files of at least this size are downloaded in parallel byte ranges
+chunked_download_threshold = 256 * 1024 ** 2
+# size of each byte range
+chunked_download_part_size = 64 * 1024 ** 2
+# maximum number of concurrent range requests per file
+chunked_download_max_parts = 4
+
+
+def get_annex_tmp_path(repo):
+    """Return the temporary directory of an annex repository"""
+    tmp = repo.dot_git / 'annex' / 'tmp'
+    tmp.mkdir(parents=True, exist_ok=True)
+    return tmp
+
+
+def download_file(platform, url, repo, size=None, md5=None, cache=None,
+                  chunk_size=1024 * 1024, progress=None):
+    """Download a file into the annex' temporary directory
+
+    Files of at least `chunked_download_threshold` bytes are downloaded in
+    parallel byte ranges, if the server supports range requests. All other
+    files are downloaded as a single stream.
+
+    If `size` and `md5` are known, an interrupted download of more than
+    `chunked_download_part_size` bytes is kept, and resumed by the next
+    download of the same content. Smaller files are downloaded again. Content is also
+    taken from, and added to, a `cache`. Content from the cache is not
+    verified again, `git annex reinject` does that.
+
+    Parameters
+    ----------
+    platform: _XNAT
+    url: str
+    repo: AnnexRepo
+      Repository the file will be injected into.
+    size: int, optional
+      Expected file size in bytes, as reported by XNAT.
+    md5: str, optional
+      Expected MD5 digest, as reported by XNAT. If given, the download is
+      verified against it.
+    cache: ContentCache, optional
+    chunk_size: int, optional
+      Number of bytes to read and write at a time.
+    progress: callable, optional
+      Called with the number of bytes of each chunk received, or found
+      complete in a resumed download.
+
+    Returns
+    -------
+    Path
+      Location of the downloaded file.
+
+    Raises
+    ------
+    XNATRequestError
+      Also for a download that does not match the expected digest.
+    """
+    tmp = get_annex_tmp_path(repo)
+    if cache and size and md5:
+        fd, dest = mkstemp(prefix='xnat-', dir=str(tmp))
+        os.close(fd)
+        os.unlink(dest)
+        if cache.get(md5, size, dest):
+            if progress:
+                progress(size)
+            return Path(dest)
+    # the bookkeeping of a resumable download costs several file
+    # operations, not worth it for a file of a single part
+    partial = _PartialDownload.claim(tmp, size, md5) \
+        if size and md5 and size > chunked_download_part_size else None
+    if partial is None:
+        fd, dest = mkstemp(prefix='xnat-', dir=str(tmp))
+        os.close(fd)
+        dest = Path(dest)
+    else:
+        dest = partial.path
+    try:
+        if size and size >= chunked_download_threshold:
+            digest = _download_ranges(
+                platform, url, dest, size, chunk_size, progress, partial)
+        else:
+            digest = _download_stream(
+                platform, url, dest, chunk_size, progress, partial)
+        if md5 and digest != md5:
+            raise _DigestMismatch(
+                f'MD5 digest mismatch of download from {url}: '
+                f'expected {md5}, got {digest}')
+    except BaseException as e:
+        if partial is None or isinstance(e, _DigestMismatch):
+            if partial:
+                partial.discard()
+            elif dest.exists():
+                dest.unlink()
+        else:
+            lgr.debug('Keeping partial download of %s for resuming', url)
+        raise
+    finally:
+        if partial:
+            partial.release()
+    if partial:
+        partial.finish()
+    if cache and size and md5:
+        cache.put(dest, md5, size)
+    return dest
+
+
+class _DigestMismatch(XNATRequestError):
+    pass
+
+
+class _PartialDownload(object):
+    """Bookkeeping of a download that can be resumed
+
+    A download is identified by the expected size and MD5 digest of the
+    content, so it can be resumed no matter which file, or URL it is for.
+    A JSON sidecar file records whether the content is downloaded as a
+    single stream, or in byte ranges, and the MD5 digests of the ranges
+    that are complete.
+
+    Use `claim()` to get an instance. Only a single download of the same
+    content can be active at a time.
+    """
+    _active = set()
+    _lock = threading.Lock()
+
+    def __init__(self, tmp, size, md5):
+        self.size = size
+        self.md5 = md5
+        self.path = tmp / f'xnat-{md5}-{size}'
+        self.sidecar = tmp / f'xnat-{md5}-{size}.json'
+        self.state = self._load()
+
+    @classmethod
+    def claim(cls, tmp, size, md5):
+        """Return a partial download, or None if it is already active"""
+        with cls._lock:
+            if (tmp, size, md5) in cls._active:
+                return None
+            cls._active.add((tmp, size, md5))
+        return cls(tmp, size, md5)
+
+    def release(self):
+        with self._lock:
+            self._active.discard((self.path.parent, self.size, self.md5))
+
+    def _load(self):
+        try:
+            state = json.loads(self.sidecar.read_text())
+        except (OSError, ValueError):
+            return None
+        if not self.path.exists() \
+                or state.get('size') != self.size \
+                or state.get('md5') != self.md5:
+            return None
+        return state
+
+    def resume(self, mode):
+        """Return the state of a download in the given mode
+
+        A download that was started in a different mode is restarted.
+        """
+        if self.state is None or self.state['mode'] != mode:
+            if self.path.exists():
+                self.path.unlink()
+            self.state = dict(mode=mode, size=self.size, md5=self.md5,
+                              parts={})
+            self._save()
+        return self.state
+
+    def complete_part(self, start, md5):
+        """Record the completion of the byte range starting at `start`"""
+        self.state['parts'][str(start)] = md5
+        self._save()
+
+    def _save(self):
+        tmp = self.sidecar.with_name(self.sidecar.name + '.new')
+        tmp.write_text(json.dumps(self.state))
+        os.replace(tmp, self.sidecar)
+
+    def finish(self):
+        """Drop the bookkeeping of a complete download"""
+        if self.sidecar.exists():
+            self.sidecar.unlink()
+
+    def discard(self):
+        """Remove a download that cannot be resumed"""
+        self.finish()
+        if self.path.exists():
+            self.path.unlink()
+
+
+def _download_stream(platform, url, dest, chunk_size, progress,
+                     partial=None, response=None):
+    """Download into `dest` as a single stream, and return its MD5 digest
+
+    An already open `response` is consumed instead of making a new request.
+    A partial download is continued with a range request, if the server
+    supports it. The MD5 digests of parts of the download are recorded, so
+    that only the intact head of a partial download is continued.
+    """
+    md5 = hashlib.md5()
+    offset = 0
+    if partial:
+        resumed = response is None and partial.state \
+            and partial.state['mode'] == 'stream'
+        state = partial.resume('stream')
+        if resumed:
+            offset = _get_intact_head(dest, partial, chunk_size)
+        # anything after the head is written again
+        state['parts'] = {
+            k: v for k, v in state['parts'].items() if int(k) < offset}
+    if response is None and offset:
+        response = platform.get_stream(
+            url, headers={'Range': f'bytes={offset}-'})
+        if response.status_code == 206:
+            lgr.debug('Resuming download of %s at byte %i', url, offset)
+            with open(dest, 'r+b') as fp:
+                fp.truncate(offset)
+            _update_md5(md5, dest, 0, offset, chunk_size, progress)
+        else:
+            offset = 0
+            partial.state['parts'] = {}
+    if response is None:
+        response = platform.get_stream(url)
+    part_size = chunked_download_part_size
+    # position in the file, and digest of the part it is in
+    pos = offset
+    part_md5 = hashlib.md5()
+    with response, open(dest, 'ab' if offset else 'wb') as fp:
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                fp.write(chunk)
+                md5.update(chunk)
+                if progress:
+                    progress(len(chunk))
+                if not partial:
+                    continue
+                view = memoryview(chunk)
+                while view:
+                    n = min(len(view), part_size - pos % part_size)
+                    part_md5.update(view[:n])
+                    view = view[n:]
+                    pos += n
+                    if not pos % part_size:
+                        partial.complete_part(
+                            pos - part_size, part_md5.hexdigest())
+                        part_md5 = hashlib.md5()
+        except BaseException:
+            if partial and pos % part_size:
+                # the incomplete last part can be resumed too
+                fp.flush()
+                partial.complete_part(
+                    pos - pos % part_size, part_md5.hexdigest())
+            raise
+    return md5.hexdigest()
+
+
+def _get_intact_head(path, partial, chunk_size):
+    """Return the size of the verified head of a partial stream download"""
+    part_size = chunked_download_part_size
+    # a complete file was never verified, start over
+    size = min(path.stat().st_size, partial.size - 1)
+    ranges = [
+        (start, min(start + part_size, size) - 1)
+        for start in range(0, size, part_size)
+    ]
+    intact = _verify_parts(path, partial.state['parts'], ranges, chunk_size,
+                           None)
+    head = 0
+    for start, end in ranges:
+        if start not in intact:
+            break
+        head = end + 1
+    return head
+
+
+def _download_ranges(platform, url, dest, size, chunk_size, progress,
+                     partial=None):
+    """Download into `dest` in parallel byte ranges, and return its digest
+
+    The MD5 digest of the file is computed while ranges complete, by
+    reading back the downloaded content in order. If the server does not
+    respond to the first range request with partial content, the response
+    is used for a single stream download instead.
+    """
+    part_size = chunked_download_part_size
+    ranges = [
+        (start, min(start + part_size, size) - 1)
+        for start in range(0, size, part_size)
+    ]
+    # start -> MD5 digest of all complete ranges
+    complete = {}
+    if partial:
+        resumed = partial.state and partial.state['mode'] == 'ranges'
+        state = partial.resume('ranges')
+        if resumed:
+            complete = _verify_parts(dest, state['parts'], ranges,
+                                     chunk_size, progress)
+            lgr.debug('Resuming download of %s with %i of %i ranges',
+                      url, len(complete), len(ranges))
+    todo = [r for r in ranges if r[0] not in complete]
+    if todo:
+        response = platform.get_stream(
+            url, headers={'Range': 'bytes={}-{}'.format(*todo[0])})
+        if response.status_code != 206:
+            lgr.debug('No range support for %s, downloading as a single '
+                      'stream', url)
+            return _download_stream(
+                platform, url, dest, chunk_size,
+                # content of verified ranges was reported already
+                _get_offset_progress(
+                    progress, sum(e - s + 1 for s, e in ranges
+                                  if s in complete)),
+                partial, response=response)
+        if not complete:
+            # preallocate, all ranges write into the same file
+            try:
+                with open(dest, 'wb') as fp:
+                    if hasattr(os, 'posix_fallocate'):
+                        os.posix_fallocate(fp.fileno(), 0, size)
+                    else:
+                        fp.truncate(size)
+            except BaseException:
+                # the response of the first range is not consumed
+                response.close()
+                raise
+
+    md5 = hashlib.md5()
+    hashed = 0
+    with ThreadPoolExecutor(
+            min(chunked_download_max_parts, len(todo)) or 1) as pool:
+        futures = {
+            pool.submit(_download_range, platform, url, dest, start, end,
+                        chunk_size, progress,
+                        response=response if i == 0 else None): start
+            for i, (start, end) in enumerate(todo)
+        }
+        try:
+            for fut in as_completed(futures):
+                start = futures[fut]
+                complete[start] = fut.result()
+                if partial:
+                    partial.complete_part(start, complete[start])
+                # hash the contiguous head of the file
+                while hashed < size and hashed in complete:
+                    end = min(hashed + part_size, size)
+                    _update_md5(md5, dest, hashed, end, chunk_size)
+                    hashed = end
+        except BaseException:
+            for fut in futures:
+                fut.cancel()
+            raise
+    while hashed < size:
+        end = min(hashed + part_size, size)
+        _update_md5(md5, dest, hashed, end, chunk_size)
+        hashed = end
+    return md5.hexdigest()
+
+
+def _download_range(platform, url, dest, start, end, chunk_size, progress,
+                    response=None):
+    """Download bytes `start` to `end` (inclusive) into an existing file
+
+    Returns
+    -------
+    str
+      MD5 digest of the range.
+    """
+    if response is None:
+        response = platform.get_stream(
+            url, headers={'Range': f'bytes={start}-{end}'})
+    md5 = hashlib.md5()
+    with response, open(dest, 'r+b') as fp:
+        if response.status_code != 206:
+            raise XNATRequestError(
+                f'Range request for {url} not honored by the server')
+        fp.seek(start)
+        received = 0
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            fp.write(chunk)
+            md5.update(chunk)
+            received += len(chunk)
+            if progress:
+                progress(len(chunk))
+    if received != end - start + 1:
+        raise XNATRequestError(
+            f'Incomplete range download of {url}: received {received} of '
+            f'{end - start + 1} bytes starting at {start}')
+    return md5.hexdigest()
+
+
+def _verify_parts(path, parts, ranges, chunk_size, progress):
+    """Return the ranges of a partial download that are intact
+
+    Parameters
+    ----------
+    parts: dict
+      Mapping of (string) range starts to the MD5 digests recorded on
+      completion.
+    ranges: list
+      (start, end) tuples of all ranges.
+    """
+    intact = {}
+    for start, end in ranges:
+        digest = parts.get(str(start))
+        if digest is None:
+            continue
+        md5 = hashlib.md5()
+        _update_md5(md5, path, start, end + 1, chunk_size)
+        if md5.hexdigest() == digest:
+            intact[start] = digest
+            if progress:
+                progress(end - start + 1)
+        else:
+            lgr.debug('Discarding corrupted range at byte %i of %s',
+                      start, path)
+    return intact
+
+
+def _update_md5(md5, path, start, end, chunk_size, progress=None):
+    """Update `md5` with bytes `start` to `end` (exclusive) of a file"""
+    with open(path, 'rb') as fp:
+        fp.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = fp.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            md5.update(chunk)
+            remaining -= len(chunk)
+            if progress:
+                progress(len(chunk))
+
+
+def _get_offset_progress(progress, offset):
+    """Wrap a progress callback to not report the first `offset` bytes"""
+    if progress is None:
+        return None
+    skip = [offset]
+
+    def _progress(nbytes):
+        ignored = min(skip[0], nbytes)
+        skip[0] -= ignored
+        if nbytes > ignored:
+            progress(nbytes - ignored)
+    return _progress
+
+
+def clone_file(src, dest):
+    """Create `dest` as a reflink, or a copy of `src`
+
+    Never a hardlink: `src` or `dest` may become an annex object, which
+    must not share its inode with anything else.
+    """
+    try:
+        import fcntl
+        # FICLONE ioctl of Linux, supported by btrfs, XFS, and others
+        with open(src, 'rb') as s, open(dest, 'wb') as d:
+            fcntl.ioctl(d.fileno(), 0x40049409, s.fileno())
+        return 'reflink'
+    except (ImportError, OSError):
+        if os.path.exists(dest):
+            os.unlink(dest)
+    shutil.copyfile(src, dest)
+    return 'copy'
+
+
+def inject_file(repo, src, path):
+    """Move a downloaded file into the annex as content of an annexed file
+
+    Parameters
+    ----------
+    repo: AnnexRepo
+    src: Path
+      Downloaded file. It is removed in any case.
+    path: str
+      Path of the annexed file, relative to the repository root.
+
+    Returns
+    -------
+    str or None
+      Error message, if the content could not be injected, e.g. due to a
+      checksum mismatch.
+    """
+    try:
+        repo.call_annex(['reinject', str(src), path])
+    except CommandError as e:
+        return e.stderr.strip() or str(e)
+    finally:
+        if src.exists():
+            src.unlink()
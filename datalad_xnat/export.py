@@ -0,0 +1,205 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Bulk export of file records from xnat-query-files
+
+Records are written in batches straight to a file (or stdout), without going
+through DataLad's result rendering.
+"""
+
+import csv
+import json
+import logging
+import sys
+from pathlib import Path
+
+lgr = logging.getLogger('datalad.xnat.export')
+
+# names and types of all exported record properties, in output order
+_export_columns = (
+    ('path', 'string'),
+    ('project_id', 'string'),
+    ('subject_id', 'string'),
+    ('subject_label', 'string'),
+    ('experiment_id', 'string'),
+    ('scan_id', 'string'),
+    ('collection', 'string'),
+    ('name', 'string'),
+    ('name_suffix', 'string'),
+    ('file_format', 'string'),
+    ('file_content', 'string'),
+    ('byte-size', 'int64'),
+    ('digest-md5', 'string'),
+    ('uri', 'string'),
+    ('url', 'string'),
+    ('duplicate_of', 'string'),
+)
+
+# supported output formats
+export_formats = ('parquet', 'arrow', 'csv', 'jsonl')
+# formats that can be streamed to stdout
+text_formats = ('csv', 'jsonl')
+
+
+def _get_byte_size(record):
+    """Return the byte-size of a file record as an int, or None"""
+    size = record.get('byte-size')
+    try:
+        return int(size)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_row(record):
+    """Return a mapping with exactly the exported properties of a record"""
+    row = {c: record.get(c) for c, _ in _export_columns}
+    row['byte-size'] = _get_byte_size(record)
+    return row
+
+
+class _RecordWriter(object):
+    """Base class for batched writers of file records
+
+    Records are buffered and flushed to the output in batches of
+    `batch_size`. Use as a context manager, or call `close()` to flush
+    any remaining records. A `path` of None means stdout, which is only
+    supported by text formats.
+    """
+    def __init__(self, path, batch_size=10000):
+        self.path = None if path is None else Path(path)
+        self.batch_size = batch_size
+        self.count = 0
+        self._batch = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, record):
+        self._batch.append(_get_row(record))
+        self.count += 1
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self._write_batch(self._batch)
+            self._batch = []
+
+    def close(self):
+        self.flush()
+
+    def _write_batch(self, rows):
+        raise NotImplementedError
+
+
+class _TextRecordWriter(_RecordWriter):
+    """Base class for writers of text formats, to a file or stdout"""
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        self._fp = sys.stdout if self.path is None \
+            else open(self.path, 'w', newline='', encoding='utf-8')
+
+    def close(self):
+        super().close()
+        if self.path is None:
+            self._fp.flush()
+        else:
+            self._fp.close()
+
+
+class _CSVRecordWriter(_TextRecordWriter):
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        self._writer = csv.DictWriter(
+            self._fp,
+            fieldnames=[c for c, _ in _export_columns],
+            # stdout is a text stream that translates newlines itself,
+            # the CSV default of '\r\n' would end up as '\r\r\n' on
+            # Windows
+            **(dict(lineterminator='\n') if self.path is None else {}))
+        self._writer.writeheader()
+
+    def _write_batch(self, rows):
+        self._writer.writerows(rows)
+        self._fp.flush()
+
+
+class _JSONLinesRecordWriter(_TextRecordWriter):
+    """Writes one compact JSON object per line
+
+    Each record is written as soon as it is available, the output stream
+    is flushed in batches.
+    """
+    def write(self, record):
+        self._fp.write(json.dumps(_get_row(record), separators=(',', ':')))
+        self._fp.write('\n')
+        self.count += 1
+        if not self.count % self.batch_size:
+            self._fp.flush()
+
+
+class _ArrowRecordWriter(_RecordWriter):
+    """Writes Parquet files, or Arrow IPC files (format='arrow')"""
+    def __init__(self, path, format='parquet', **kwargs):
+        import pyarrow as pa
+        super().__init__(path, **kwargs)
+        self._pa = pa
+        self._schema = pa.schema(
+            [(c, getattr(pa, t)()) for c, t in _export_columns])
+        if format == 'parquet':
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(str(self.path), self._schema)
+        else:
+            self._writer = pa.ipc.new_file(str(self.path), self._schema)
+
+    def _write_batch(self, rows):
+        self._writer.write_batch(
+            self._pa.RecordBatch.from_pylist(rows, schema=self._schema))
+
+    def close(self):
+        super().close()
+        self._writer.close()
+
+
+def get_record_writer(format, path, **kwargs):
+    """Return a writer for file records
+
+    Parameters
+    ----------
+    format: {'parquet', 'arrow', 'csv', 'jsonl'}
+      Output format. If 'pyarrow' is not installed, columnar formats
+      fall back on CSV, and a '.csv' suffix is appended to `path`.
+    path: str or Path or None
+      Output file. None means stdout, for text formats only.
+    **kwargs:
+      Passed on to the writer, e.g. `batch_size`.
+
+    Returns
+    -------
+    _RecordWriter
+    """
+    if format not in export_formats:
+        raise ValueError(f'Unsupported export format {format!r}')
+    if path is None and format not in text_formats:
+        raise ValueError(f'Cannot write {format!r} output to stdout')
+    if format == 'jsonl':
+        return _JSONLinesRecordWriter(path, **kwargs)
+    if format in ('parquet', 'arrow'):
+        try:
+            return _ArrowRecordWriter(path, format=format, **kwargs)
+        except ImportError:
+            path = Path(path)
+            if path.suffix != '.csv':
+                path = path.with_name(f'{path.name}.csv')
+            lgr.warning(
+                "Cannot write %s format, 'pyarrow' is not installed. "
+                "Writing CSV to %s instead", format, path)
+    return _CSVRecordWriter(path, **kwargs)
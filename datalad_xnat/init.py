@@ -23,6 +23,7 @@ from datalad.support.constraints import (
 from datalad.support.exceptions import CapturedException
 from datalad.support.param import Parameter
 from datalad.utils import (
+    bytes2human,
     quote_cmdlinearg,
 )
 from datalad.distribution.dataset import (
@@ -31,10 +32,21 @@ from datalad.distribution.dataset import (
     require_dataset,
 )
 from datalad.ui import ui
+from .auth import configure_dataset_auth
+from .browse import browse_selection
+from .journal import get_state_path
+from .metrics import (
+    phase,
+    with_command_metrics,
+)
 from .platform import (
     _XNAT,
     XNATRequestError
 )
+from .selection import (
+    save_listings,
+    validate_selection,
+)
 
 __docformat__ = 'restructuredtext'
 
@@ -100,12 +112,21 @@ class Init(Interface):
             doc="""enables interactive configuration based on XNAT queries.
             Default: enabled in interactive sessions.""",
             action='store_true'),
+        validate=Parameter(
+            args=("--no-validate",),
+            dest='validate',
+            doc="""do not check that the project, subject, experiment, and
+            collection exist on the XNAT server. Validation reports the number
+            of experiments and files that are selected, and keeps their
+            listings for the first update.""",
+            action='store_false'),
         **_XNAT.cmd_params
     )
 
     @staticmethod
     @datasetmethod(name='xnat_init')
     @eval_results
+    @with_command_metrics('xnat-init')
     def __call__(url,
                  pathfmt="{subject}/{session}/{scan}/",
                  project=None,
@@ -115,6 +136,7 @@ class Init(Interface):
                  credential=None,
                  force=False,
                  interactive=None,
+                 validate=True,
                  dataset=None):
 
         if not pathfmt[-1] == '/':
@@ -167,19 +189,43 @@ class Init(Interface):
             )
             return
 
+        if validate:
+            # all listings of the selection can be reused by an update
+            listings = platform.record_listings()
+
         if interactive:
             # makes queries and let a user pick values
-            if project is None:
-                pass
-            if subject is None:
-                pass
-            if experiment is None:
-                pass
-            if collection is None:
-                pass
+            try:
+                project, subject, experiment, collection = browse_selection(
+                    ui, platform, project, subject, experiment, collection)
+            except XNATRequestError as e:
+                ce = CapturedException(e)
+                yield get_status_dict(
+                    status='error',
+                    message=('Cannot list XNAT server content: %s', ce),
+                    exception=ce,
+                    **res,
+                )
+                return
         # at this point, any None value of project, subject, experiment,
         # collection means: do not limit -- take all
 
+        summary = None
+        if validate:
+            try:
+                with phase('validate', project=project):
+                    summary = validate_selection(
+                        platform, project, subject, experiment, collection)
+            except (ValueError, XNATRequestError) as e:
+                ce = CapturedException(e)
+                yield get_status_dict(
+                    status='error',
+                    message=('Invalid selection: %s', ce),
+                    exception=ce,
+                    **res,
+                )
+                return
+
         _cfg_dataset(
             ds,
             url,
@@ -193,11 +239,26 @@ class Init(Interface):
 
         if not platform.credential_name == 'anonymous':
             # Configure XNAT access authentication
-            ds.run_procedure(spec='cfg_xnat_dataset')
+            configure_dataset_auth(ds)
 
+        if summary is None:
+            yield dict(
+                res,
+                status='ok',
+            )
+            return
+        save_listings(
+            get_state_path(ds, 'default') / 'listings.json',
+            platform.url,
+            listings)
         yield dict(
             res,
             status='ok',
+            message=(
+                'Selection covers %i experiments with %i files (%s)',
+                summary['experiments'], summary['files'],
+                bytes2human(summary['bytes'])),
+            **summary,
         )
         return
 
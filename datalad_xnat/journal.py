@@ -0,0 +1,180 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Checkpoint journal for xnat-update runs
+
+The journal is an append-only JSON lines file inside the dataset's `.git`
+directory. It is never committed. Each line is a single event:
+
+- `begin`: a new update run, with its parameters and the units (subjects,
+  or experiments) it will process
+- `start`: processing of a unit started (its downloads are in-flight)
+- `done`: a unit was completely processed and saved
+- `complete`: the run finished
+
+Independent of the journal, the download statistics of every run are kept
+in a separate file, to estimate the duration of future runs.
+"""
+
+import json
+import logging
+import os
+import time
+
+lgr = logging.getLogger('datalad.xnat.journal')
+
+
+def get_state_path(ds, name):
+    """Return the directory for local, uncommitted XNAT state of a dataset
+
+    Parameters
+    ----------
+    ds: Dataset
+    name: str
+      Name of the XNAT configuration section the state is about.
+
+    Returns
+    -------
+    Path
+    """
+    return ds.repo.dot_git / 'datalad' / 'xnat' / name
+
+
+def record_run_stats(path, **stats):
+    """Append the statistics of an update run to a JSON lines file
+
+    Parameters
+    ----------
+    path: Path
+    **stats:
+      E.g. 'bytes' downloaded, and the 'seconds' it took.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as fp:
+        fp.write(json.dumps(dict(stats, time=time.time())))
+        fp.write('\n')
+
+
+def get_download_rate(path, max_runs=10):
+    """Return the mean download rate of the most recent update runs
+
+    Returns
+    -------
+    float or None
+      Bytes per second, None if no run downloaded anything.
+    """
+    runs = []
+    try:
+        with open(path, encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    run = json.loads(line)
+                except ValueError:
+                    continue
+                if run.get('bytes') and run.get('seconds'):
+                    runs.append(run)
+    except OSError:
+        return None
+    runs = runs[-max_runs:]
+    if not runs:
+        return None
+    return sum(r['bytes'] for r in runs) / sum(r['seconds'] for r in runs)
+
+
+class UpdateJournal(object):
+    """Read and write the checkpoint journal of an update run
+
+    Parameters
+    ----------
+    path: Path
+      Location of the journal file. It need not exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.params = None
+        self.unit_type = None
+        self.units = []
+        # mapping of finished units to their recorded properties
+        self.finished = {}
+        self.inflight = set()
+        self.completed = False
+        # whether the last line on record was cut off
+        self._truncated = False
+        if path.exists():
+            self._load()
+
+    def _load(self):
+        with open(self.path, encoding='utf-8') as fp:
+            for line in fp:
+                self._truncated = not line.endswith('\n')
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # a line that was cut off by an interruption
+                    lgr.debug('Ignoring malformed journal line %r', line)
+                    continue
+                self._apply(event)
+
+    def _apply(self, event):
+        ev = event['event']
+        if ev == 'begin':
+            self.params = event['params']
+            self.unit_type = event.get('unit_type', 'subject')
+            self.units = event['units']
+            self.finished = {}
+            self.inflight = set()
+            self.completed = False
+        elif ev == 'start':
+            self.inflight.add(event['unit'])
+        elif ev == 'done':
+            self.inflight.discard(event['unit'])
+            self.finished[event['unit']] = event.get('props', {})
+        elif ev == 'complete':
+            self.completed = True
+
+    def _write(self, event, mode='a'):
+        event['time'] = time.time()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, mode, encoding='utf-8') as fp:
+            if mode == 'a' and self._truncated:
+                fp.write('\n')
+                self._truncated = False
+            fp.write(json.dumps(event))
+            fp.write('\n')
+            fp.flush()
+            # must survive a crashing node, not just a killed process
+            os.fsync(fp.fileno())
+        self._apply(event)
+
+    def is_resumable(self, params):
+        """Whether an unfinished run with identical parameters is on record
+        """
+        if self.params is None or self.completed:
+            return False
+        if self.params != params:
+            lgr.warning(
+                'Not resuming interrupted update with different '
+                'parameters: %s', self.params)
+            return False
+        return True
+
+    def begin(self, params, units, unit_type='subject'):
+        """Start a new journal, discarding any previous record"""
+        self._write(
+            dict(event='begin', params=params, units=list(units),
+                 unit_type=unit_type),
+            mode='w')
+
+    def start(self, unit):
+        self._write(dict(event='start', unit=unit))
+
+    def done(self, unit, **props):
+        self._write(dict(event='done', unit=unit, props=props))
+
+    def complete(self):
+        self._write(dict(event='complete'))
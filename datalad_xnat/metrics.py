@@ -0,0 +1,468 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Instrumentation of requests to XNAT servers
+
+Every request of an `_XNAT` instance is reported to request hooks as an
+event (see `_XNAT.add_request_hook()`, and `register_request_hook()`).
+`RequestMetrics` is a hook that aggregates these events per API endpoint.
+
+With the configuration 'datalad.xnat.metrics' set to true, every xnat-*
+command collects request metrics, and logs a summary at the end. All of
+these settings are read from the configuration of the dataset a command
+runs on, if there is one.
+
+With 'datalad.xnat.metrics-textfile-dir' set to a directory, every xnat-*
+command writes its metrics into a file of that directory at the end, in the
+Prometheus text format, or with 'datalad.xnat.metrics-format' set to
+'openmetrics', in the OpenMetrics text format. The directory can be the
+one of the textfile collector of the Prometheus node exporter. Besides the
+request metrics, these include the number of results, counters reported by
+the command with `count()`, and the durations of its phases, reported with
+`phase()`.
+
+With 'datalad.xnat.trace-file' set, the phases of every xnat-* command are
+traced as spans, see the `tracing` module.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from hashlib import md5
+from inspect import signature
+from pathlib import Path
+
+from .tracing import (
+    Tracer,
+    _active_tracers,
+    span,
+)
+
+lgr = logging.getLogger('datalad.xnat.metrics')
+
+# upper bounds of the latency histogram buckets in seconds
+latency_buckets = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    float('inf'),
+)
+
+
+class RequestMetrics(object):
+    """Aggregate request events per API endpoint
+
+    An instance is a request hook. Each event is a dict with the keys
+
+    - `method`: 'GET' or 'POST'
+    - `url`
+    - `endpoint`: name of the API endpoint, see `_XNAT.api_endpoints`, or
+      'file' for file content, or 'other'
+    - `status`: HTTP status code, None if there was no response
+    - `latency`: seconds until the response headers were received
+    - `duration`: seconds until the request returned. For streaming
+      requests, the body is received later, and not included.
+    - `bytes`: size of the response body. For streaming requests, the
+      announced length.
+    - `retries`: number of retries of the request
+    - `error`: error message, or None
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # endpoint -> statistics
+        self.endpoints = {}
+
+    def __call__(self, event):
+        with self._lock:
+            stats = self.endpoints.get(event['endpoint'])
+            if stats is None:
+                stats = self.endpoints[event['endpoint']] = dict(
+                    count=0,
+                    errors=0,
+                    retries=0,
+                    bytes=0,
+                    status={},
+                    latency_sum=0.0,
+                    latency_max=0.0,
+                    duration_sum=0.0,
+                    latency_buckets=[0] * len(latency_buckets),
+                )
+            stats['count'] += 1
+            stats['errors'] += bool(event.get('error'))
+            stats['retries'] += event.get('retries') or 0
+            stats['bytes'] += event.get('bytes') or 0
+            status = event.get('status')
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            latency = event.get('latency') or 0.0
+            stats['latency_sum'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+            stats['duration_sum'] += event.get('duration') or 0.0
+            for i, bound in enumerate(latency_buckets):
+                if latency <= bound:
+                    stats['latency_buckets'][i] += 1
+                    break
+
+    def format_summary(self):
+        """Return a human-readable summary, one line per endpoint"""
+        lines = []
+        with self._lock:
+            for name, stats in sorted(self.endpoints.items()):
+                lines.append(
+                    '{}: {} requests, {} errors, {} retries, {} bytes, '
+                    'latency mean {:.1f} ms, max {:.1f} ms, '
+                    'transfer {:.1f} ms per request, status {}'.format(
+                        name, stats['count'], stats['errors'],
+                        stats['retries'], stats['bytes'],
+                        1000 * stats['latency_sum'] / stats['count'],
+                        1000 * stats['latency_max'],
+                        1000 * (stats['duration_sum'] - stats['latency_sum'])
+                        / stats['count'],
+                        ', '.join(
+                            f'{code}: {n}' for code, n in sorted(
+                                stats['status'].items(),
+                                key=lambda i: str(i[0])))))
+        return '\n'.join(lines)
+
+    def log_summary(self, title='XNAT requests'):
+        if self.endpoints:
+            lgr.info('%s\n%s', title, self.format_summary())
+
+
+class CommandMetrics(object):
+    """Metrics of a single run of a command
+
+    Comprises the request metrics, the number of results by action and
+    status, counters reported with `count()`, and the durations of phases
+    reported with `phase()`.
+
+    Parameters
+    ----------
+    command: str
+      Name of the command.
+    dataset: str
+      Path of the dataset the command runs on.
+    """
+    def __init__(self, command, dataset):
+        self.command = command
+        self.dataset = dataset
+        self.requests = RequestMetrics()
+        self._lock = threading.Lock()
+        # (action, status) -> number of results
+        self.results = {}
+        # name -> value
+        self.counters = {}
+        # name -> [number of runs, total seconds]
+        self.phases = {}
+        self.start = time.time()
+        self.duration = None
+
+    def add_result(self, res):
+        key = (res.get('action'), res.get('status'))
+        with self._lock:
+            self.results[key] = self.results.get(key, 0) + 1
+
+    def add_count(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            stats = self.phases.setdefault(name, [0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+
+    def finish(self):
+        self.duration = time.time() - self.start
+
+    def format_textfile(self, openmetrics=False):
+        """Return the metrics in the Prometheus text format
+
+        Parameters
+        ----------
+        openmetrics: bool, optional
+          Use the OpenMetrics text format instead.
+        """
+        base = dict(command=self.command, dataset=self.dataset)
+        families = []
+
+        def add(name, type_, help_, samples):
+            families.append((name, type_, help_, samples))
+
+        with self.requests._lock:
+            endpoints = sorted(self.requests.endpoints.items())
+            add('datalad_xnat_requests_total', 'counter',
+                'Requests to the XNAT server',
+                [('', dict(endpoint=ep, code=str(code).lower()), n)
+                 for ep, stats in endpoints
+                 for code, n in sorted(stats['status'].items(),
+                                       key=lambda i: str(i[0]))])
+            add('datalad_xnat_request_errors_total', 'counter',
+                'Failed requests to the XNAT server',
+                [('', dict(endpoint=ep), stats['errors'])
+                 for ep, stats in endpoints])
+            add('datalad_xnat_request_retries_total', 'counter',
+                'Retries of requests to the XNAT server',
+                [('', dict(endpoint=ep), stats['retries'])
+                 for ep, stats in endpoints])
+            add('datalad_xnat_response_bytes_total', 'counter',
+                'Bytes received from the XNAT server',
+                [('', dict(endpoint=ep), stats['bytes'])
+                 for ep, stats in endpoints])
+            samples = []
+            for ep, stats in endpoints:
+                cumulative = 0
+                for bound, n in zip(latency_buckets,
+                                    stats['latency_buckets']):
+                    cumulative += n
+                    samples.append(('_bucket', dict(
+                        endpoint=ep, le=_format_value(bound)), cumulative))
+                samples.append(('_sum', dict(endpoint=ep),
+                                stats['latency_sum']))
+                samples.append(('_count', dict(endpoint=ep), stats['count']))
+            add('datalad_xnat_request_latency_seconds', 'histogram',
+                'Time until the response headers were received', samples)
+        with self._lock:
+            add('datalad_xnat_results_total', 'counter',
+                'Results of the command',
+                [('', dict(action=str(action), status=str(status)), n)
+                 for (action, status), n in sorted(
+                     self.results.items(), key=str)])
+            for name, value in sorted(self.counters.items()):
+                add(f'datalad_xnat_{name}_total', 'counter',
+                    f'Number of {name.replace("_", " ")}',
+                    [('', {}, value)])
+            add('datalad_xnat_phase_runs_total', 'counter',
+                'Runs of a phase of the command',
+                [('', dict(phase=name), n)
+                 for name, (n, _) in sorted(self.phases.items())])
+            add('datalad_xnat_phase_seconds_total', 'counter',
+                'Total time spent in a phase of the command',
+                [('', dict(phase=name), seconds)
+                 for name, (_, seconds) in sorted(self.phases.items())])
+        add('datalad_xnat_command_duration_seconds', 'gauge',
+            'Duration of the last run of the command',
+            [('', {}, self.duration or 0.0)])
+        add('datalad_xnat_command_last_run_timestamp_seconds', 'gauge',
+            'Start time of the last run of the command',
+            [('', {}, self.start)])
+
+        lines = []
+        for name, type_, help_, samples in families:
+            if not samples:
+                continue
+            # OpenMetrics names the family of counter samples without the
+            # suffix
+            family = name[:-len('_total')] \
+                if openmetrics and type_ == 'counter' else name
+            lines.append(f'# HELP {family} {help_}')
+            lines.append(f'# TYPE {family} {type_}')
+            for suffix, labels, value in samples:
+                labels = ','.join(
+                    f'{k}="{_escape_label(v)}"'
+                    for k, v in dict(base, **labels).items())
+                lines.append(
+                    f'{name}{suffix}{{{labels}}} {_format_value(value)}')
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, directory, openmetrics=False):
+        """Write the metrics into a file of a directory
+
+        The file is replaced atomically, as required for the textfile
+        collector of the Prometheus node exporter. Its name is unique for
+        the command and dataset.
+
+        Returns
+        -------
+        Path
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / 'datalad_xnat_{}_{}.prom'.format(
+            self.command.replace('-', '_'),
+            md5(self.dataset.encode('utf-8')).hexdigest()[:12])
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        tmp.write_text(self.format_textfile(openmetrics=openmetrics),
+                       encoding='utf-8')
+        os.replace(tmp, path)
+        return path
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# metrics of the commands that currently run
+_active_metrics = []
+
+
+def count(name, value=1):
+    """Add to a counter of the running command, if metrics are collected
+
+    Parameters
+    ----------
+    name: str
+      Name of the counter, as part of a metric name, e.g. 'files_added'.
+    value: int, optional
+    """
+    for metrics in _active_metrics:
+        metrics.add_count(name, value)
+
+
+@contextmanager
+def phase(name, **attributes):
+    """Measure the duration of a phase of the running command
+
+    Phases can run concurrently, or repeatedly. Their durations add up.
+    A phase is traced as a span, see `tracing.span()`.
+
+    Parameters
+    ----------
+    name: str
+      Name of the phase, e.g. 'listing'.
+    **attributes:
+      Attributes of the span, e.g. the ID of the subject.
+
+    Yields
+    ------
+    Span
+      To set further attributes of the span.
+    """
+    with span(name, **attributes) as s:
+        if not _active_metrics:
+            yield s
+            return
+        start = time.perf_counter()
+        try:
+            yield s
+        finally:
+            seconds = time.perf_counter() - start
+            for metrics in _active_metrics:
+                metrics.add_phase(name, seconds)
+
+
+def with_command_metrics(name):
+    """Decorate a command to collect metrics and a trace, when configured
+
+    Must be applied to the generator function of the command, beneath
+    `eval_results`.
+
+    Parameters
+    ----------
+    name: str
+      Name of the command, for the summary, the metrics file, and the
+      root span of the trace.
+    """
+    def decorator(func):
+        # only the settings of a command's dataset can override the global
+        # ones
+        with_dataset = 'dataset' in signature(func).parameters
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            from .platform import (
+                register_request_hook,
+                unregister_request_hook,
+            )
+            cfg, dataset = _get_command_config(
+                kwargs.get('dataset'), with_dataset)
+            log_summary = cfg.getbool('datalad.xnat', 'metrics',
+                                      default=False)
+            textfile_dir = cfg.get('datalad.xnat.metrics-textfile-dir')
+            trace_file = cfg.get('datalad.xnat.trace-file')
+            if not (log_summary or textfile_dir or trace_file):
+                yield from func(*args, **kwargs)
+                return
+            metrics = CommandMetrics(name, dataset)
+            register_request_hook(metrics.requests)
+            _active_metrics.append(metrics)
+            tracer = None
+            if trace_file:
+                tracer = Tracer(
+                    name, dict(command=name, dataset=dataset),
+                    max_spans=int(
+                        cfg.get('datalad.xnat.trace-max-spans', 10000)))
+                _active_tracers.append(tracer)
+            error = None
+            try:
+                for res in func(*args, **kwargs):
+                    metrics.add_result(res)
+                    yield res
+            except BaseException as e:
+                error = str(e) or type(e).__name__
+                raise
+            finally:
+                _active_metrics.remove(metrics)
+                unregister_request_hook(metrics.requests)
+                metrics.finish()
+                if log_summary:
+                    metrics.requests.log_summary(f'XNAT requests of {name}')
+                if textfile_dir:
+                    try:
+                        path = metrics.write_textfile(
+                            textfile_dir,
+                            openmetrics=cfg.get(
+                                'datalad.xnat.metrics-format',
+                                'prometheus') == 'openmetrics')
+                        lgr.debug('Wrote metrics to %s', path)
+                    except OSError as e:
+                        lgr.warning('Cannot write metrics to %s: %s',
+                                    textfile_dir, e)
+                if tracer:
+                    _active_tracers.remove(tracer)
+                    for (action, status), n in metrics.results.items():
+                        tracer.root.set_attribute(
+                            f'results.{action}.{status}', n)
+                    tracer.root.finish(error=error)
+                    try:
+                        tracer.write(trace_file)
+                        lgr.debug('Wrote trace to %s', trace_file)
+                    except OSError as e:
+                        lgr.warning('Cannot write trace to %s: %s',
+                                    trace_file, e)
+        return wrapper
+    return decorator
+
+
+def _get_command_config(dataset, with_dataset=True):
+    """Return the configuration, and the path of the dataset of a command
+
+    The configuration of the dataset includes its local and committed
+    settings. Without a dataset, the global configuration is used. The
+    dataset is only looked up, if metrics or tracing are enabled globally,
+    or if the command runs on a dataset, whose settings could enable them.
+
+    Returns
+    -------
+    (ConfigManager, str)
+      The path is None, if no dataset was looked up.
+    """
+    from datalad import cfg
+    from datalad.distribution.dataset import require_dataset
+    from datalad.support.exceptions import NoDatasetFound
+
+    if not with_dataset and not (
+            cfg.getbool('datalad.xnat', 'metrics', default=False)
+            or cfg.get('datalad.xnat.metrics-textfile-dir')
+            or cfg.get('datalad.xnat.trace-file')):
+        return cfg, None
+    try:
+        ds = require_dataset(dataset, check_installed=True)
+    except NoDatasetFound:
+        return cfg, os.path.abspath(
+            str(getattr(dataset, 'path', dataset) or os.curdir))
+    return ds.config, ds.path
@@ -0,0 +1,271 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Downloads from XNAT mirrors
+
+The same project can be available from several XNAT servers, e.g. a local
+site instance and a central one. Files on a mirror are matched to the files
+of the server a dataset tracks by their project, experiment label, scan,
+collection, and name, and must have the same MD5 digest. Their mirror URLs
+are registered as further sources of the files.
+
+Every download goes to the server with the shortest expected transfer
+time, estimated from the measured latency of its requests, and the
+throughput of its downloads. A server without measurements yet is tried
+first, to measure it. If a download fails, the next server is tried.
+"""
+
+import logging
+import threading
+import time
+
+from datalad.support.exceptions import CapturedException
+
+from .platform import XNATRequestError
+from .query_files import _parse_file_uri
+
+lgr = logging.getLogger('datalad.xnat.mirror')
+
+
+class Mirror(object):
+    """Files of an XNAT server that are available from another one
+
+    Parameters
+    ----------
+    name: str
+      Name of the XNAT configuration of the mirror.
+    platform: _XNAT
+      Session with the mirror.
+    """
+    def __init__(self, name, platform):
+        self.name = name
+        self.platform = platform
+        self._lock = threading.Lock()
+        # project -> {experiment label: experiment ID} on the mirror
+        self._experiments = {}
+
+    def get_urls(self, records):
+        """Return the URLs of files on the mirror
+
+        Parameters
+        ----------
+        records: list
+          File records, as reported by `query_files()`.
+
+        Returns
+        -------
+        list
+          URL on the mirror of each record, None if the mirror does not
+          have the file.
+        """
+        urls = [None] * len(records)
+        # only files with a digest can be matched
+        by_experiment = {}
+        for i, rec in enumerate(records):
+            if rec.get('digest-md5') and rec.get('project_id') \
+                    and rec.get('experiment_label'):
+                by_experiment.setdefault(
+                    (rec['project_id'], rec['experiment_label']),
+                    []).append(i)
+        try:
+            for (project, label), indices in by_experiment.items():
+                experiment = self._get_experiments(project).get(label)
+                if experiment is None:
+                    continue
+                files = {}
+                for fr in self.platform.get_files(experiment) or []:
+                    fr = {k.lower(): v for k, v in fr.items()}
+                    uri_props = _parse_file_uri(fr.get('uri', ''))
+                    if uri_props:
+                        files[(uri_props['scan_id'], fr.get('collection'),
+                               fr.get('name'))] = fr
+                for i in indices:
+                    rec = records[i]
+                    fr = files.get(
+                        (rec['scan_id'], rec.get('collection'), rec['name']))
+                    if fr and fr.get('digest') == rec['digest-md5']:
+                        urls[i] = f"{self.platform.url}{fr['uri']}"
+        except Exception as e:
+            # the files remain available from the tracked server
+            ce = CapturedException(e)
+            lgr.warning('Cannot list files of XNAT mirror %s: %s',
+                        self.name, ce)
+        return urls
+
+    def _get_experiments(self, project):
+        # a single request per project, for all units of an update
+        with self._lock:
+            experiments = self._experiments.get(project)
+            if experiments is None:
+                experiments = self._experiments[project] = {}
+                for er in self.platform.get_experiments(
+                        project=project) or []:
+                    er = {k.lower(): v for k, v in er.items()}
+                    if er.get('label'):
+                        experiments[er['label']] = er['id']
+        return experiments
+
+
+class ServerStats(object):
+    """Measured latency and throughput of XNAT servers
+
+    Both are exponentially weighted moving averages, servers are identified
+    by their URL.
+
+    Parameters
+    ----------
+    weight: float, optional
+      Weight of a new measurement.
+    """
+    def __init__(self, weight=0.3):
+        self._weight = weight
+        self._lock = threading.Lock()
+        # URL -> seconds to the response of a request
+        self._latency = {}
+        # URL -> bytes per second of a download
+        self._throughput = {}
+        # URLs of servers that could not be connected to
+        self._unreachable = set()
+
+    def watch(self, platform):
+        """Measure the latency of all requests to a server"""
+        url = platform.url
+        platform.add_request_hook(
+            lambda event: self.add_latency(url, event))
+
+    def add_latency(self, url, event):
+        """Add the latency of a request, see `RequestMetrics`"""
+        if event.get('status') is None:
+            return
+        self._add(self._latency, url, event['latency'])
+
+    def add_transfer(self, url, nbytes, seconds):
+        """Add the throughput of a download"""
+        if nbytes and seconds > 0:
+            self._add(self._throughput, url, nbytes / seconds)
+        with self._lock:
+            self._unreachable.discard(url)
+
+    def set_unreachable(self, url):
+        with self._lock:
+            self._unreachable.add(url)
+
+    def estimate(self, url, size):
+        """Return the expected seconds to download `size` bytes
+
+        Returns
+        -------
+        float or None
+          None, if the server was not measured yet.
+        """
+        with self._lock:
+            latency = self._latency.get(url)
+            throughput = self._throughput.get(url)
+        if latency is None or throughput is None:
+            return None
+        return latency + (size or 0) / throughput
+
+    def rank(self, candidates, size):
+        """Order download candidates by their expected download time
+
+        Parameters
+        ----------
+        candidates: list
+          (platform, url) tuples.
+        size: int
+          File size in bytes.
+
+        Returns
+        -------
+        list
+          The candidates, servers without measurements first, unreachable
+          servers last.
+        """
+        def order(i):
+            server = candidates[i][0].url
+            estimate = self.estimate(server, size)
+            return (server in self._unreachable,
+                    estimate is not None,
+                    estimate or 0,
+                    i)
+        return [candidates[i] for i in sorted(range(len(candidates)),
+                                              key=order)]
+
+    def _add(self, values, url, value):
+        with self._lock:
+            prev = values.get(url)
+            values[url] = value if prev is None \
+                else prev + self._weight * (value - prev)
+
+
+def download_from_fastest(candidates, stats, repo, size=None, md5=None,
+                          cache=None, progress=None):
+    """Download a file from the fastest of several servers
+
+    Parameters
+    ----------
+    candidates: list
+      (platform, url) tuples of all servers that have the file.
+    stats: ServerStats
+    repo: AnnexRepo
+    size: int, optional
+    md5: str, optional
+    cache: ContentCache, optional
+    progress: callable, optional
+      See `download_file()`. Bytes are reported only once, even if a
+      download is retried from another server.
+
+    Returns
+    -------
+    Path
+      Location of the downloaded file.
+    """
+    from requests import RequestException
+
+    from .download import download_file
+    if cache and size and md5 and cache.contains(md5, size):
+        # no transfer to measure
+        platform, url = candidates[0]
+        return download_file(platform, url, repo, size, md5, cache,
+                             progress=progress)
+    # bytes reported so far, by any attempt
+    reported = [0]
+    error = None
+    failed = []
+    for platform, url in stats.rank(candidates, size):
+        received = [0]
+
+        def _progress(nbytes):
+            received[0] += nbytes
+            if progress and received[0] > reported[0]:
+                progress(received[0] - reported[0])
+                reported[0] = received[0]
+
+        start = time.perf_counter()
+        try:
+            path = download_file(platform, url, repo, size, md5, cache,
+                                 progress=_progress)
+        except RequestException as e:
+            lgr.debug('Cannot reach %s: %s', platform.url, e)
+            stats.set_unreachable(platform.url)
+            error = e
+            failed.append(url)
+            continue
+        except XNATRequestError as e:
+            lgr.debug('Download of %s failed: %s', url, e)
+            error = e
+            failed.append(url)
+            continue
+        stats.add_transfer(
+            platform.url, received[0], time.perf_counter() - start)
+        return path
+    platform, url = candidates[0]
+    uri_props = _parse_file_uri(url[len(platform.url):])
+    raise XNATRequestError(
+        f'Download of {uri_props["name"] if uri_props else url} failed from '
+        f'all servers: {", ".join(failed)}') from error
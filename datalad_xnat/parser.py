@@ -38,25 +38,34 @@ def parse_xnat(outfile, platform, force=False,
         to.
     """
     # create csv table containing subject info & file urls
-    table_header = ['subject', 'session', 'scan', 'filename', 'url']
+    # size and MD5 are used to build annex keys, empty if unknown
+    table_header = ['subject', 'session', 'scan', 'filename', 'url',
+                    'byte_size', 'md5']
 
     # write subject info to file
     fh = csv.writer(outfile, delimiter=',')
     fh.writerow(table_header)
     for fr in query_files(
-            platform, project=project, subject=subject, experiment=experiment):
+            platform, project=project, subject=subject, experiment=experiment,
+            duplicates=False):
+        if fr.get('status') != 'ok':
+            # nothing to put into a table, but pass on for reporting
+            yield fr
+            continue
         if collections and fr.get('collection') not in collections:
             lgr.debug('File excluded by collection selection')
             continue
         # communicate the query (makes outside error control possible)
         yield fr
-        # TODO the file size is at file_rec['Size'], could be used
-        # for progress reporting, maybe
         # create line for each file with necessary subject info
+        size, md5 = fr.get('byte-size'), fr.get('digest-md5')
         fh.writerow([
             fr['subject_id'],
             fr['experiment_id'],
             fr['scan_id'],
             fr['name'],
             fr['url'],
+            # a key needs both
+            size if size and md5 else '',
+            md5 if size and md5 else '',
         ])
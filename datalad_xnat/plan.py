@@ -0,0 +1,272 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Planning of xnat-update runs without modifying a dataset
+
+The files of all units are listed, and compared against the annex keys of
+the files in the dataset. Files are
+
+- new: not yet in the dataset
+- changed: in the dataset, but with different content
+- unchanged: in the dataset with the same content
+
+The cost of an update is estimated from the number of requests and bytes
+it involves, and the download rate of previous runs.
+"""
+
+import logging
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from datalad.distribution.dataset import Dataset
+from datalad.utils import (
+    bytes2human,
+    ensure_list,
+)
+
+from .download import (
+    chunked_download_part_size,
+    chunked_download_threshold,
+)
+from .query_files import (
+    get_content_id,
+    query_files,
+)
+
+lgr = logging.getLogger('datalad.xnat.plan')
+
+# size and MD5 digest of MD5 and MD5E annex keys
+_md5_key_regex = re.compile(r'MD5E?-s(?P<size>\d+)--(?P<md5>[0-9a-f]{32})')
+
+
+def get_file_location(ds, pathfmt, rec):
+    """Return the location of a file in a dataset hierarchy
+
+    Parameters
+    ----------
+    ds: Dataset
+    pathfmt: str
+      Path format of the XNAT configuration. '//' separates the paths of
+      subdatasets.
+    rec: dict
+      File record.
+
+    Returns
+    -------
+    Path, str
+      Path of the (sub)dataset containing the file, and the path of the
+      file relative to it.
+    """
+    path = _format_path(pathfmt, rec)
+    return ds.pathobj.joinpath(*path[:-1]), path[-1]
+
+
+def get_dataset_paths(ds, pathfmt, rec):
+    """Return the paths of all (sub)datasets that contain a file
+
+    Returns
+    -------
+    list
+      Paths of the subdatasets below `ds`, top-most first.
+    """
+    path = _format_path(pathfmt, rec)
+    return [ds.pathobj.joinpath(*path[:i]) for i in range(1, len(path))]
+
+
+def get_unit_query(unit, unit_type, projects, experiment=None):
+    """Return the query constraints of a unit of an update
+
+    Parameters
+    ----------
+    unit: str or None
+      Subject or experiment ID, None for no constraint. With several
+      projects, subject IDs are qualified by their project, as
+      '<project>/<subject>'.
+    unit_type: {'subject', 'experiment'}
+    projects: list
+      Projects of the update.
+    experiment: str, optional
+      Experiment constraint for subject units.
+
+    Returns
+    -------
+    dict
+      'project', 'subject', and 'experiment' arguments of `query_files()`.
+    """
+    if unit_type == 'experiment':
+        # identifies the files without any other constraint
+        return dict(project=None, subject=None, experiment=unit)
+    project = projects[0] if len(projects) == 1 else None
+    subject = unit
+    if unit is not None and len(projects) > 1:
+        project, subject = unit.split('/', 1)
+    return dict(project=project, subject=subject, experiment=experiment)
+
+
+def _format_path(pathfmt, rec):
+    return f'{pathfmt}{{filename}}'.format(
+        subject=rec['subject_id'],
+        session=rec['experiment_id'],
+        scan=rec['scan_id'],
+        filename=rec['name'],
+    ).split('//')
+
+
+def _get_file_state(rec, info):
+    """Compare a file record with the annex info of a file"""
+    key = info.get('key')
+    if not key:
+        return 'new' if not info['path'].exists() else 'changed'
+    match = _md5_key_regex.match(key)
+    content = get_content_id(rec)
+    if match and content:
+        return 'unchanged' \
+            if (match['md5'], int(match['size'])) == content else 'changed'
+    # cannot compare digests, fall back on the size
+    size = rec.get('byte-size')
+    return 'unchanged' \
+        if size and info.get('bytesize') == int(size) else 'changed'
+
+
+def _get_download_requests(size):
+    if size >= chunked_download_threshold:
+        return math.ceil(size / chunked_download_part_size)
+    return 1
+
+
+def plan_update(ds, platform, units, unit_type, pathfmt, project=None,
+                experiment=None, collections=None, cache=None,
+                download_rate=None, jobs=1):
+    """Determine what an update would do, without doing it
+
+    Parameters
+    ----------
+    ds: Dataset
+    platform: _XNAT
+    units: list
+      Subject or experiment IDs to process, a single None for no
+      constraint.
+    unit_type: {'subject', 'experiment'}
+    pathfmt: str
+    project: str or list, optional
+      With several projects, subject units are qualified by their project,
+      see `get_unit_query()`.
+    experiment: str, optional
+      Experiment constraint for subject units.
+    collections: list, optional
+    cache: ContentCache, optional
+      Content in the cache needs no download.
+    download_rate: float, optional
+      Bytes per second of previous runs, for an estimate of the duration.
+    jobs: int, optional
+      Number of units to list in parallel.
+
+    Yields
+    ------
+    dict
+      Result records, a 'xnat_plan' record for every new or changed file,
+      and a final 'xnat_update' summary.
+    """
+    res = dict(action='xnat_plan', logger=lgr)
+    projects = ensure_list(project)
+    with ThreadPoolExecutor(jobs) as pool:
+        listings = [
+            pool.submit(
+                lambda **kw: list(
+                    query_files(platform, duplicates=False, **kw)),
+                **get_unit_query(unit, unit_type, projects, experiment),
+            )
+            for unit in units
+        ]
+        records = []
+        for fut in listings:
+            for rec in fut.result():
+                if rec['status'] != 'ok':
+                    yield rec
+                elif not collections \
+                        or rec.get('collection') in collections:
+                    records.append(rec)
+
+    # group by the (sub)dataset containing the file
+    by_ds = {}
+    for rec in records:
+        dspath, path = get_file_location(ds, pathfmt, rec)
+        by_ds.setdefault(dspath, []).append((path, rec))
+
+    counts = dict(new=0, changed=0, unchanged=0)
+    nbytes = 0
+    ndownloads = 0
+    download_requests = 0
+    contents = set()
+    for dspath, files in by_ds.items():
+        subds = Dataset(dspath)
+        repo = subds.repo if subds.is_installed() else None
+        infos = repo.get_content_annexinfo(
+            paths=[dspath / p for p, _ in files],
+            init=None,
+            eval_availability=True,
+        ) if hasattr(repo, 'get_content_annexinfo') else {}
+        for path, rec in files:
+            info = dict(infos.get(dspath / path, {}), path=dspath / path)
+            state = _get_file_state(rec, info)
+            counts[state] += 1
+            if state != 'unchanged':
+                yield dict(
+                    res,
+                    status='ok',
+                    type='file',
+                    path=str(dspath / path),
+                    state=state,
+                    message=state,
+                )
+            if state == 'unchanged' and info.get('has_content'):
+                continue
+            # content to obtain
+            content = get_content_id(rec)
+            if content in contents:
+                continue
+            if content:
+                contents.add(content)
+                if cache and cache.contains(*content):
+                    continue
+            size = int(rec.get('byte-size') or 0)
+            nbytes += size
+            ndownloads += 1
+            download_requests += _get_download_requests(size)
+
+    # listing of experiments, and their files
+    list_requests = len(units) + len({r['experiment_id'] for r in records})
+    estimate = timedelta(seconds=round(nbytes / download_rate)) \
+        if download_rate else None
+    seconds = estimate.total_seconds() if estimate is not None else None
+    yield dict(
+        res,
+        action='xnat_update',
+        status='ok',
+        type='dataset',
+        path=ds.path,
+        refds=ds.path,
+        new=counts['new'],
+        changed=counts['changed'],
+        unchanged=counts['unchanged'],
+        downloads=ndownloads,
+        download_bytes=nbytes,
+        requests=list_requests + download_requests,
+        estimated_duration=seconds,
+        message=(
+            'Update would add %i new, and %i changed files (%i unchanged), '
+            'downloading %i files (%s) with about %i requests. '
+            'Estimated duration: %s',
+            counts['new'], counts['changed'], counts['unchanged'],
+            ndownloads, bytes2human(nbytes),
+            list_requests + download_requests,
+            estimate if estimate is not None
+            else 'unknown, without a measured download rate'),
+    )
@@ -10,23 +10,23 @@
 """
 
 import logging
+import re
+import threading
+import time
 
 from http import HTTPStatus
-from requests import (
-    HTTPError,
-    Session,
-)
 from urllib.parse import (
     urlparse,
 )
 
-from datalad.downloaders.credentials import UserPassword
 from datalad.support.constraints import (
     EnsureNone,
     EnsureStr,
 )
 from datalad.support.param import Parameter
 
+from .metrics import phase
+
 lgr = logging.getLogger('datalad.xnat.platform')
 
 
@@ -34,6 +34,23 @@ lgr = logging.getLogger('datalad.xnat.platform')
 http_error_lookup = {i.value: i.phrase for i in HTTPStatus}
 
 
+# hooks that receive the request events of all _XNAT instances
+_request_hooks = []
+
+
+def register_request_hook(hook):
+    """Register a callable that receives the events of all XNAT requests
+
+    See `RequestMetrics` for the properties of an event.
+    """
+    _request_hooks.append(hook)
+
+
+def unregister_request_hook(hook):
+    if hook in _request_hooks:
+        _request_hooks.remove(hook)
+
+
 class XNATRequestError(Exception):
     """A request to an XNAT server resulted in an error
 
@@ -45,6 +62,21 @@ class XNATRequestError(Exception):
 
 
 class _XNAT(object):
+    """Access to an XNAT server
+
+    Parameters
+    ----------
+    url: str
+      Base URL of the server.
+    credential: str or None
+      Name of the credential, see `cmd_params`.
+    hooks: list, optional
+      Request hooks, see `add_request_hook()`.
+    lazy_auth: bool, optional
+      Do not check the authentication with a dedicated request. Instead,
+      the first request establishes the session, and fails if
+      authentication fails.
+    """
     # URL must not have a leading slash
     api_endpoints = dict(
         session_token='data/JSESSION',
@@ -96,10 +128,14 @@ class _XNAT(object):
         ),
     )
 
-    def __init__(self, url, credential):
+    def __init__(self, url, credential, hooks=None, lazy_auth=False):
         # all URL joining operations require NO trailing slash of the base URL
         self.url = url.rstrip('/')
+        self._hooks = list(hooks or [])
 
+        # requests and credential support are only imported, when they are
+        # needed, to keep the start-up of commands fast
+        from requests import Session
         session = Session()
         if credential is None:
             credential = urlparse(url).netloc
@@ -107,6 +143,7 @@ class _XNAT(object):
         if credential == 'anonymous':
             auth = None
         else:
+            from datalad.downloaders.credentials import UserPassword
             try:
                 auth = UserPassword(
                     credential,
@@ -123,10 +160,28 @@ class _XNAT(object):
             session.auth = (auth['user'], auth['password'])
 
         self._session = session
+        # number of requests made, for progress reporting
+        self.request_count = 0
+        self._request_count_lock = threading.Lock()
+        self._credential_name = credential
+        # whether a request established the session (and its token)
+        self._has_session = False
+        self._session_lock = threading.Lock()
+        # minimum seconds between the start of requests, and the earliest
+        # time of the next request
+        self._min_interval = 0
+        self._next_request = 0
+        self._rate_lock = threading.Lock()
+        # URL -> results of listing requests, answered without a request
+        self._preloaded = {}
+        # URL -> results of listing requests made, if recorded
+        self._recorded = None
+        if lazy_auth:
+            # the first request will fail, if auth does not work
+            return
         # now check if auth works (if any is needed)
         # TODO check that we have anonymous OR user/pass
         self._wrapped_post(self._get_api('session_token'))
-        self._credential_name = credential
 
     def _wrapped_request(self, method, *args, **kwargs):
         """Helper for `_wrapped_get` and `_wrapped_post`"""
@@ -134,18 +189,117 @@ class _XNAT(object):
         if method not in ['GET', 'POST']:
             raise ValueError("method parameter can either be 'GET' or 'POST'.")
 
+        if self._has_session:
+            return self._send(method, *args, **kwargs)
+        # the first request obtains the session token, any concurrent ones
+        # wait for it, instead of obtaining tokens of their own
+        with self._session_lock:
+            if self._has_session:
+                return self._send(method, *args, **kwargs)
+            with phase('auth', url=self.url):
+                response = self._send(method, *args, **kwargs)
+            self._has_session = True
+            return response
+
+    def _send(self, method, *args, **kwargs):
+        """Helper for `_wrapped_request`"""
+        from requests import (
+            HTTPError,
+            RequestException,
+        )
         req = self._session.get if method == 'GET' else self._session.post
 
+        self._throttle()
+        with self._request_count_lock:
+            self.request_count += 1
+        hooks = self._hooks + _request_hooks
+        start = time.perf_counter()
+        response = None
         try:
             lgr.debug('%s: %s, %s', method, args, kwargs)
             response = req(*args, **kwargs)
             response.raise_for_status()
+            if hooks:
+                self._report_request(hooks, method, args, kwargs, start,
+                                     response)
             return response
         except HTTPError as exc:
             reason = exc.response.reason or \
                      http_error_lookup[exc.response.status_code]
+            if hooks:
+                self._report_request(hooks, method, args, kwargs, start,
+                                     response, error=reason)
             raise XNATRequestError("Request to XNAT server failed: %s"
                                    % reason) from exc
+        except RequestException as exc:
+            if hooks:
+                self._report_request(hooks, method, args, kwargs, start,
+                                     response, error=str(exc))
+            raise
+
+    def _report_request(self, hooks, method, args, kwargs, start, response,
+                        error=None):
+        """Pass the event of a request on to the request hooks"""
+        url = args[0] if args else kwargs.get('url')
+        duration = time.perf_counter() - start
+        event = dict(
+            method=method,
+            url=url,
+            endpoint=self._get_endpoint(url),
+            status=None,
+            latency=duration,
+            duration=duration,
+            bytes=0,
+            retries=0,
+            error=error,
+        )
+        if response is not None:
+            event['status'] = response.status_code
+            # time to the response headers, the rest is the transfer
+            event['latency'] = response.elapsed.total_seconds()
+            if kwargs.get('stream'):
+                event['bytes'] = int(
+                    response.headers.get('Content-Length') or 0)
+            else:
+                event['bytes'] = len(response.content)
+            retries = getattr(response.raw, 'retries', None)
+            if retries is not None:
+                event['retries'] = len(retries.history)
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                lgr.debug('Request hook %r failed: %s', hook, e)
+
+    def _get_endpoint(self, url):
+        """Return the name of the API endpoint of a URL"""
+        path = url[len(self.url) + 1:] if url.startswith(self.url) else url
+        path = path.partition('?')[0]
+        for name, regex in self._get_endpoint_regexes():
+            if regex.fullmatch(path):
+                return name
+        return 'file' if '/files/' in path else 'other'
+
+    @classmethod
+    def _get_endpoint_regexes(cls):
+        regexes = cls.__dict__.get('_endpoint_regexes')
+        if regexes is None:
+            regexes = [
+                # replace placeholders, as escaped by re.escape()
+                (name, re.compile(re.sub(
+                    r'\\\{[^}]+\\\}', '[^/]+',
+                    re.escape(ep.partition('?')[0]))))
+                for name, ep in cls.api_endpoints.items()
+            ]
+            cls._endpoint_regexes = regexes
+        return regexes
+
+    def add_request_hook(self, hook):
+        """Add a callable that receives an event for every request
+
+        See `RequestMetrics` for the properties of an event.
+        """
+        self._hooks.append(hook)
 
     def _wrapped_get(self, *args, **kwargs):
         """Wraps `self._session.get` for error handling.
@@ -187,6 +341,60 @@ class _XNAT(object):
 
         return self._wrapped_request('POST', *args, **kwargs)
 
+    def set_max_connections(self, n):
+        """Size the connection pool for `n` concurrent requests
+
+        Without this, concurrent requests beyond the default pool size of
+        the session are not kept alive.
+        """
+        from requests.adapters import HTTPAdapter
+        adapter = HTTPAdapter(pool_connections=n, pool_maxsize=n)
+        for prefix in ('https://', 'http://'):
+            self._session.mount(prefix, adapter)
+
+    def set_rate_limit(self, rate):
+        """Limit the rate at which requests are started
+
+        Parameters
+        ----------
+        rate: float or None
+          Maximum number of requests per second, None for no limit.
+        """
+        self._min_interval = 1 / rate if rate else 0
+
+    def _throttle(self):
+        """Wait until the rate limit permits another request"""
+        if not self._min_interval:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            delay = self._next_request - now
+            self._next_request = max(now, self._next_request) + \
+                self._min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_stream(self, url, headers=None):
+        """Return a streaming response for a (file) URL
+
+        Parameters
+        ----------
+        url: str
+          Full URL.
+        headers: dict, optional
+          Additional request headers.
+
+        Returns
+        -------
+        requests.Response
+          Must be closed by the caller.
+
+        Raises
+        ------
+        XNATRequestError
+        """
+        return self._wrapped_get(url, stream=True, headers=headers)
+
     @property
     def credential_name(self):
         return self._credential_name
@@ -195,18 +403,44 @@ class _XNAT(object):
     def authenticated_user(self):
         return self._session.auth[0] if self._session else None
 
+    def record_listings(self):
+        """Record the results of all subsequent listing requests
+
+        Returns
+        -------
+        dict
+          Maps the URL of every listing request to its results, filled as
+          requests are made. It can be given to `preload_listings()`.
+        """
+        if self._recorded is None:
+            self._recorded = {}
+        return self._recorded
+
+    def preload_listings(self, listings):
+        """Answer listing requests from previously recorded results
+
+        Parameters
+        ----------
+        listings: dict
+          See `record_listings()`.
+        """
+        self._preloaded.update(listings)
+
     def get_projects(self):
         """Returns a list with project records"""
-        return self._unwrap(self._wrapped_get(self._get_api('projects')))
+        return self._get_results(self._get_api('projects'))
 
     def get_project_ids(self):
         """Returns a list with project identifiers"""
         return self._unwrap_ids(self.get_projects())
 
+    def get_subjects(self, project):
+        """Return a list of subject records of a project"""
+        return self._get_results(self._get_api('subjects', project=project))
+
     def get_subject_ids(self, project):
         """Return a list of subject IDs available in a project"""
-        return self._unwrap_ids(self._unwrap(self._wrapped_get(
-            self._get_api('subjects', project=project))))
+        return self._unwrap_ids(self.get_subjects(project))
 
     def get_nsubjs(self, project):
         """Return the number of subjects available in a project"""
@@ -228,9 +462,16 @@ class _XNAT(object):
         # optionally constrain the query
         if project:
             url += f'&project={project}'
+            if subject and url in self._preloaded:
+                # no need to ask, when all experiments of the project are
+                # known already
+                return [
+                    r for r in self._preloaded[url]
+                    if r.get('subject_ID', r.get('subject_id')) == subject
+                ]
         if subject:
             url += f'&subject_ID={subject}'
-        return self._unwrap(self._wrapped_get(url))
+        return self._get_results(url)
 
     def get_experiment_ids(self, project=None, subject=None):
         """Return a list of experiment IDs available for a project's subject"""
@@ -238,13 +479,12 @@ class _XNAT(object):
 
     def get_scan_ids(self, experiment):
         """Return a list of scan IDs available for an experiment"""
-        return self._unwrap_ids(self._unwrap(self._wrapped_get(
-            self._get_api('scans', experiment=experiment))))
+        return self._unwrap_ids(self._get_results(
+            self._get_api('scans', experiment=experiment)))
 
     def get_files(self, experiment):
         """Return a list of file records for a scan in an experiment"""
-        return self._unwrap(self._wrapped_get(
-            self._get_api('files', experiment=experiment)))
+        return self._get_results(self._get_api('files', experiment=experiment))
 
     def _get_api(self, id, **kwargs):
         ep = self.api_endpoints[id]
@@ -252,6 +492,14 @@ class _XNAT(object):
             ep = ep.format(**kwargs)
         return f'{self.url}/{ep}'
 
+    def _get_results(self, url):
+        results = self._preloaded.get(url)
+        if results is None:
+            results = self._unwrap(self._wrapped_get(url))
+        if self._recorded is not None:
+            self._recorded[url] = results
+        return results
+
     def _unwrap(self, response):
         return response.json().get('ResultSet', {}).get('Result')
 
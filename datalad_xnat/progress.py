@@ -0,0 +1,209 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Progress reporting for an entire xnat-update run
+
+Progress is shown as a single progress bar of the downloaded bytes, with a
+label that summarizes the processed units and files, and the request rate.
+In addition, a machine-readable status line is logged periodically via the
+'datalad.xnat.status' logger, e.g. for the log of a batch job::
+
+  xnat-update status {"units_done": 3, "units_total": 10, ...}
+
+The interval of status lines is configured with
+'datalad.xnat.status-interval' in seconds (default: 60, 0 disables them).
+"""
+
+import json
+import logging
+import threading
+import time
+
+from datalad.log import log_progress
+from datalad.utils import ensure_list
+
+lgr = logging.getLogger('datalad.xnat.progress')
+status_lgr = logging.getLogger('datalad.xnat.status')
+
+
+class UpdateProgress(object):
+    """Track and report the progress of an update
+
+    Totals grow while units are listed. All methods are thread-safe.
+
+    Parameters
+    ----------
+    units_total: int
+      Number of units of the update.
+    unit_type: str, optional
+      Type of units, e.g. 'subject'.
+    units_done: int, optional
+      Number of units that were processed before, e.g. by an interrupted
+      run.
+    platform: _XNAT or list, optional
+      Platform(s) whose request count is reported.
+    status_interval: float, optional
+      Seconds between status lines, 0 disables them.
+    """
+    # minimum seconds between progress bar updates
+    progress_interval = 0.2
+
+    def __init__(self, units_total, unit_type='subject', units_done=0,
+                 platform=None, status_interval=60):
+        self.units_total = units_total
+        self.unit_type = unit_type
+        self.units_done = units_done
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self._platform = platform
+        self._status_interval = status_interval
+        self._lock = threading.Lock()
+        # held while the progress bar is started, updated, or finished
+        self._report_lock = threading.Lock()
+        self._pid = f'xnat-update-{id(self)}'
+        self._started = False
+        self._start_time = time.time()
+        self._last_progress = 0
+        self._last_status = self._start_time
+        self._reported_bytes = 0
+        # (time, request count) samples for the recent request rate
+        self._request_samples = [(self._start_time, self._get_requests())]
+
+    def _get_requests(self):
+        return sum(p.request_count for p in ensure_list(self._platform))
+
+    def add_files(self, total, done=0):
+        """Add the files of a listed unit, `done` of them need no download
+        """
+        with self._lock:
+            self.files_total += total
+            self.files_done += done
+        self.report()
+
+    def add_bytes_total(self, nbytes):
+        """Add the size of a queued download"""
+        with self._lock:
+            self.bytes_total += nbytes
+        self.report()
+
+    def add_bytes(self, nbytes):
+        """Account for received bytes"""
+        with self._lock:
+            self.bytes_done += nbytes
+        self.report()
+
+    def file_done(self, n=1):
+        with self._lock:
+            self.files_done += n
+        self.report()
+
+    def unit_done(self):
+        with self._lock:
+            self.units_done += 1
+        self.report(force=True)
+
+    def get_status(self):
+        """Return a snapshot of the progress
+
+        Returns
+        -------
+        dict
+          With numbers of done and total units, files, and bytes, the
+          elapsed seconds, the recent request rate (per second), the mean
+          download rate (bytes per second), and the estimated seconds
+          until all known downloads are complete (None if unknown).
+        """
+        now = time.time()
+        requests = self._get_requests()
+        with self._lock:
+            samples = self._request_samples
+            if now - samples[-1][0] >= 5:
+                samples.append((now, requests))
+            # request rate over about the last 30 seconds
+            while len(samples) > 1 and now - samples[1][0] >= 30:
+                samples.pop(0)
+            start, start_requests = samples[0]
+            elapsed = now - self._start_time
+            byte_rate = self.bytes_done / elapsed if elapsed > 0 else 0
+            return dict(
+                units_done=self.units_done,
+                units_total=self.units_total,
+                files_done=self.files_done,
+                files_total=self.files_total,
+                bytes_done=self.bytes_done,
+                bytes_total=self.bytes_total,
+                elapsed=round(elapsed, 1),
+                request_rate=round(
+                    (requests - start_requests) / (now - start), 2)
+                if now > start else 0.0,
+                byte_rate=round(byte_rate),
+                eta=round((self.bytes_total - self.bytes_done) / byte_rate)
+                if byte_rate else None,
+            )
+
+    def report(self, force=False):
+        """Update the progress bar, and log a status line when it is due
+
+        Reports of concurrent threads are made one at a time. A report that
+        is not forced is skipped, while another one is made.
+        """
+        if not self._report_lock.acquire(blocking=force):
+            return
+        try:
+            self._report(time.time(), force)
+        finally:
+            self._report_lock.release()
+
+    def _report(self, now, force):
+        if not force and now - self._last_progress < self.progress_interval:
+            return
+        status = self.get_status()
+        self._last_progress = now
+        update = status['bytes_done'] - self._reported_bytes
+        self._reported_bytes = status['bytes_done']
+        status_due = self._status_interval and \
+            now - self._last_status >= self._status_interval
+        if status_due:
+            self._last_status = now
+        label = 'XNAT update {}/{} {}s, {}/{} files, {} req/s'.format(
+            status['units_done'], status['units_total'], self.unit_type,
+            status['files_done'], status['files_total'],
+            status['request_rate'])
+        if not self._started:
+            log_progress(
+                lgr.info, self._pid, 'Start XNAT update',
+                label=label, unit='B', total=status['bytes_total'],
+            )
+            self._started = True
+        # the bar shows the byte rate, and the ETA
+        log_progress(
+            lgr.info, self._pid, '%s, %i of %i bytes', label,
+            status['bytes_done'], status['bytes_total'],
+            label=label, update=update, increment=True,
+            total=status['bytes_total'],
+            noninteractive_level=logging.DEBUG,
+        )
+        if status_due:
+            self.log_status(status)
+
+    def log_status(self, status=None):
+        """Log a machine-readable status line"""
+        status_lgr.info(
+            'xnat-update status %s',
+            json.dumps(status or self.get_status(), separators=(',', ':')))
+
+    def finish(self):
+        """Finish the progress bar, and log a final status line"""
+        with self._report_lock:
+            if self._started:
+                log_progress(lgr.info, self._pid, 'Finished XNAT update')
+                self._started = False
+        if self._status_interval:
+            self.log_status()
@@ -0,0 +1,104 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Bulk creation of the subdatasets of '//' path formats
+
+Subdatasets are created as standalone datasets, one after another, and
+configured in parallel. Afterwards, all new subdatasets are registered in
+their superdatasets with a single save, instead of one save per
+subdataset.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from string import Formatter
+
+from datalad.distribution.dataset import Dataset
+
+from .auth import configure_dataset_auth
+
+lgr = logging.getLogger('datalad.xnat.provision')
+
+
+def get_subject_dataset_paths(ds, pathfmt, subject):
+    """Return the paths of the subdatasets of a subject, if known upfront
+
+    Only the subdatasets whose path is determined by the subject alone
+    are known before the files of the subject are listed.
+
+    Returns
+    -------
+    list
+      Paths of the subdatasets, top-most first.
+    """
+    paths = []
+    path = ds.pathobj
+    for fmt in pathfmt.split('//')[:-1]:
+        if any(field not in (None, 'subject')
+               for _, field, _, _ in Formatter().parse(fmt)):
+            break
+        path = path / fmt.format(subject=subject)
+        paths.append(path)
+    return paths
+
+
+def provision_datasets(ds, paths, auth=None, jobs=1):
+    """Create the missing subdatasets of a dataset
+
+    Parameters
+    ----------
+    ds: Dataset
+      Top-most superdataset.
+    paths: iterable
+      Paths of subdatasets. The superdataset of each is either `ds`, or
+      also in `paths`.
+    auth: dict or list, optional
+      Arguments of `configure_dataset_auth()`, for configuring XNAT
+      authentication in the new subdatasets, a list of them for several
+      XNAT servers.
+    jobs: int, optional
+      Number of subdatasets to configure in parallel.
+
+    Returns
+    -------
+    list
+      Paths of the created subdatasets.
+    """
+    # by nesting depth, superdatasets must exist before their subdatasets
+    levels = {}
+    for path in paths:
+        levels.setdefault(
+            len(path.relative_to(ds.pathobj).parts), {})[path] = None
+    created = []
+    for level in sorted(levels):
+        new = [p for p in levels[level] if not Dataset(p).is_installed()]
+        if not new:
+            continue
+        lgr.info('Creating %i subdatasets', len(new))
+        # create() is not meant to run concurrently
+        for p in new:
+            Dataset(p).create(result_renderer='disabled')
+        if auth:
+            with ThreadPoolExecutor(jobs) as pool:
+                # raises on the first failure
+                list(pool.map(lambda p: _configure_dataset(p, auth), new))
+        # register all new subdatasets in their superdatasets at once
+        ds.save(
+            path=[str(p) for p in new],
+            message=f'Add {len(new)} XNAT subdatasets',
+            result_renderer='disabled',
+        )
+        created.extend(new)
+    return created
+
+
+def _configure_dataset(path, auth):
+    sub = Dataset(path)
+    # ensure_list() would turn a dict into its keys
+    for a in [auth] if isinstance(auth, dict) else auth:
+        configure_dataset_auth(sub, **a)
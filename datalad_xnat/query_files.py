@@ -11,12 +11,17 @@
 """
 
 import logging
-from pathlib import PurePosixPath
+import re
 
 from datalad.interface.base import Interface
 from datalad.interface.utils import eval_results
 from datalad.interface.base import build_doc
 
+from datalad.support.constraints import (
+    EnsureChoice,
+    EnsureNone,
+    EnsureStr,
+)
 from datalad.support.param import Parameter
 
 from datalad.distribution.dataset import (
@@ -24,7 +29,16 @@ from datalad.distribution.dataset import (
     EnsureDataset,
     require_dataset,
 )
-from datalad.utils import ensure_list
+from datalad.utils import (
+    bytes2human,
+    ensure_list,
+)
+from .export import (
+    export_formats,
+    get_record_writer,
+    text_formats,
+)
+from .metrics import with_command_metrics
 from .platform import _XNAT
 
 __docformat__ = 'restructuredtext'
@@ -41,6 +55,7 @@ _import_experiment_props = {
     'project': 'project_id',
     'uri': 'experiment_uri',
     'subject_label': 'subject_label',
+    'label': 'experiment_label',
 }
 
 _standardize_file_keys = {
@@ -54,6 +69,15 @@ _standardize_file_keys = {
     'uri': 'uri',
 }
 
+# API is /data/experiments/ID/scans/ID/resources/ID/files/NAME
+# NAME can contain slashes, if a resource has subdirectories
+_file_uri_regex = re.compile(
+    r'/data/experiments/(?P<experiment_id>[^/]+)'
+    r'/scans/(?P<scan_id>[^/]+)'
+    r'/resources/(?P<resource_id>[^/]+)'
+    r'/files/(?P<name>.+)'
+)
+
 
 @build_doc
 class QueryFiles(Interface):
@@ -62,6 +86,13 @@ class QueryFiles(Interface):
     Use this command to get a list of available projects at an XNAT instance
     for a given URL, or to get a list of subjects inside a specific project
     at the given XNAT instance.
+
+    Files with the same MD5 digest and size as a file that was reported
+    before are marked with a 'duplicate_of' property that holds the path of
+    that first file. This requires keeping the digest and size of every
+    distinct file content in memory, for the entire query. When records
+    are written to an [CMD: --output CMD][PY: `output` PY] file, which is
+    meant for any number of files, this marking is only done on request.
     """
 
     _examples_ = [
@@ -73,6 +104,19 @@ class QueryFiles(Interface):
             text='Get a list of subject for a given XNAT project:',
             code_cmd='datalad xnat-query http://central.xnat.org:8080 -p myproject',
             code_py='xnat_query("http://central.xnat.org:8080", project="myproject")'),
+        dict(
+            text='Write all file records of a project into a Parquet file:',
+            code_cmd=('datalad xnat-query http://central.xnat.org:8080 '
+                      '-p myproject --output parquet --output-file files.parquet'),
+            code_py=('xnat_query("http://central.xnat.org:8080", '
+                     'project="myproject", output="parquet", '
+                     'output_file="files.parquet")')),
+        dict(
+            text='Stream file records as JSON lines into another tool:',
+            code_cmd=('datalad -f disabled xnat-query '
+                      'http://central.xnat.org:8080 -p myproject '
+                      '--output jsonl | jq .url'),
+        ),
     ]
 
     _params_ = dict(
@@ -80,29 +124,115 @@ class QueryFiles(Interface):
             args=("url",),
             doc="""XNAT instance URL to query""",
         ),
+        output=Parameter(
+            args=("--output",),
+            constraints=EnsureChoice(None, *export_formats),
+            doc="""write all file records in batches to [CMD: --output-file
+            CMD][PY: `output_file` PY], instead of reporting them as
+            individual results. 'parquet' and 'arrow' (Arrow IPC) are
+            columnar formats that require the 'pyarrow' package; without it,
+            CSV is written instead. 'jsonl' writes one compact JSON object
+            per line, as soon as a record is available. Only a single
+            summary result is reported. 'csv' and 'jsonl' output is written
+            to stdout, if no output file is given; in this case no summary
+            result is reported, and only failures are reported as results
+            (disable the result renderer to get a clean stream).""",
+        ),
+        output_file=Parameter(
+            args=("--output-file",),
+            metavar='PATH',
+            constraints=EnsureStr() | EnsureNone(),
+            doc="""path of the file to write records to, when an
+            [CMD: --output CMD][PY: `output` PY] format is given. '-' means
+            stdout.""",
+        ),
+        duplicates=Parameter(
+            args=("--duplicates",),
+            action='store_true',
+            doc="""mark files with duplicate content also in records that
+            are written with [CMD: --output CMD][PY: `output` PY]. Memory
+            use grows with the number of distinct files.""",
+        ),
         **_XNAT.cmd_params
     )
 
     @staticmethod
     @datasetmethod(name='xnat_query')
     @eval_results
+    @with_command_metrics('xnat-query-files')
     def __call__(url,
                  project=None,
                  experiment=None,
                  subject=None,
-                 credential=None):
+                 credential=None,
+                 output=None,
+                 output_file=None,
+                 duplicates=False):
+
+        if output_file is not None and not output:
+            raise ValueError(
+                'An output format is required for writing to an output file')
+        if output_file == '-':
+            output_file = None
+        if output and output_file is None and output not in text_formats:
+            raise ValueError(
+                f'An output file is required for {output!r} output')
 
-        platform = _XNAT(url, credential=credential)
+        platform = _XNAT(url, credential=credential, lazy_auth=True)
 
-        yield from query_files(
+        records = query_files(
             platform,
             experiment=experiment,
             project=project,
             subject=subject,
+            duplicates=duplicates or not output,
         )
+        # number and total size of files with duplicate content
+        duplicates = [0, 0]
+        if not output:
+            for rec in records:
+                _count_duplicate(rec, duplicates)
+                yield rec
+            _report_duplicates(duplicates)
+            return
+
+        with get_record_writer(output, output_file) as writer:
+            for rec in records:
+                if rec['status'] != 'ok':
+                    # failures are still reported individually
+                    yield rec
+                    continue
+                _count_duplicate(rec, duplicates)
+                writer.write(rec)
+        _report_duplicates(duplicates)
+        if writer.path is None:
+            # keep stdout clean for the records
+            lgr.info('Wrote %i file records', writer.count)
+            return
+        yield dict(
+            action='xnat_query',
+            status='ok',
+            type='file',
+            path=str(writer.path),
+            message=('Wrote %i file records', writer.count),
+            logger=lgr,
+        )
+
+
+def _count_duplicate(rec, duplicates):
+    if rec.get('duplicate_of'):
+        duplicates[0] += 1
+        duplicates[1] += int(rec['byte-size'])
 
 
-def query_files(platform, experiment=None, project=None, subject=None):
+def _report_duplicates(duplicates):
+    if duplicates[0]:
+        lgr.info('Found %i files (%s) with the same content as another file',
+                 duplicates[0], bytes2human(duplicates[1]))
+
+
+def query_files(platform, experiment=None, project=None, subject=None,
+                duplicates=True):
     # prep for yield
     res = dict(
         action='xnat_query',
@@ -129,6 +259,9 @@ def query_files(platform, experiment=None, project=None, subject=None):
             er = {k.lower(): v for k, v in er.items()}
             experiments[er['id']] = er
 
+    # (digest-md5, byte-size) -> path of the first file with that content.
+    # one item per distinct content of all queried files
+    contents = {}
     for eid, er in experiments.items():
         if not er:
             er = {
@@ -150,27 +283,83 @@ def query_files(platform, experiment=None, project=None, subject=None):
                 lgr.debug('Unrecognized digest of length %i ignored',
                           len(digest))
             # figure our scan ID from URI
-            path = PurePosixPath(fr['uri'])
-            # API is /data/experiments/ID/scans/ID/resources/ID/files/NAME
-            fr['scan_id'] = path.parts[5]
+            uri_props = _parse_file_uri(fr['uri'])
+            if uri_props is None:
+                # not a scan file, nothing we could build a path for.
+                # do not fail the entire query (or update) over it
+                lgr.warning('Skipping file with unexpected XNAT URI: %s',
+                            fr['uri'])
+                continue
+            fr['scan_id'] = uri_props['scan_id']
             # we need a file extension for conveniently building E-keys
             # for git-annex
-            # we cannot use '.suffixes', because an entire DICOM filename
-            # is considered a suffix ;-)
-            fr['name_suffix'] = ''.join(PurePosixPath(fr['name']).suffix)
+            fr['name_suffix'] = _get_name_suffix(fr['name'])
             # inject a full URL for convenience too
             fr['url'] = f'{platform.url}{fr["uri"]}'
             for ik, ek in _import_experiment_props.items():
                 if ik in er:
                     fr[ek] = er[ik]
+            # give artificial internal XNAT path, matches API,
+            # improves comprehension
+            path = f"{fr['experiment_id']}/{fr['scan_id']}/{fr['name']}"
+            content = get_content_id(fr) if duplicates else None
+            if content:
+                if content in contents:
+                    fr['duplicate_of'] = contents[content]
+                else:
+                    contents[content] = path
             yield dict(
                 res,
                 status='ok',
                 type='file',
-                # give artificial internal XNAT path, matches API,
-                # improves comprehension
-                path=f"{fr['experiment_id']}/{fr['scan_id']}/{fr['name']}",
+                path=path,
                 # include collection info (i.e. resource)
                 message=fr.get('collection'),
                 **fr
             )
+
+
+def get_content_id(record):
+    """Return the (digest-md5, byte-size) of a file record, if known
+
+    Files with the same content identifier have identical content.
+
+    Returns
+    -------
+    tuple or None
+    """
+    md5, size = record.get('digest-md5'), record.get('byte-size')
+    try:
+        return (md5, int(size)) if md5 and size else None
+    except ValueError:
+        return None
+
+
+def _parse_file_uri(uri):
+    """Decompose an XNAT file URI into its components
+
+    Parameters
+    ----------
+    uri: str
+      Server-relative file URI, as reported by XNAT, i.e.
+      /data/experiments/ID/scans/ID/resources/ID/files/NAME
+
+    Returns
+    -------
+    dict or None
+      With keys 'experiment_id', 'scan_id', 'resource_id', and 'name'.
+      None is returned, if the URI does not match the expected structure.
+    """
+    match = _file_uri_regex.fullmatch(uri)
+    return match.groupdict() if match else None
+
+
+def _get_name_suffix(name):
+    """Return the last extension of a file name (equivalent to pathlib)
+
+    We cannot use '.suffixes', because an entire DICOM filename is
+    considered a suffix ;-)
+    """
+    name = name.rpartition('/')[2]
+    idx = name.rfind('.')
+    return name[idx:] if 0 < idx < len(name) - 1 else ''
@@ -45,69 +45,6 @@ DATALAD_XNAT_DEFAULT__NAME=myxnat
 import sys
 
 from datalad.api import Dataset
-from urllib.parse import urlparse
-from datalad.support.annexrepo import AnnexRepo
-from datalad.consts import DATALAD_SPECIAL_REMOTE
-from datalad.support.exceptions import (RemoteNotAvailableError)
-
-ds = Dataset(sys.argv[1])
-
-xnat_cfg_name = ds.config.get('datalad.xnat.default-name', 'default')
-cfg_section = 'datalad.xnat.{}'.format(xnat_cfg_name)
-xnat_url = ds.config.obtain(
-    '{}.url'.format(cfg_section),
-    dialog_type='question',
-    title='XNAT server address',
-    text='Full URL of XNAT server (e.g. https://xnat.example.com:8443/xnat)',
-    store=False,
-    reload=False)
-
-parsed_url = urlparse(xnat_url)
-
-auth_cfg = """\
-[provider:xnat-{name}]
-url_re = {url}/.*
-credential = {credential_name}
-authentication_type = {auth_type}
-
-[credential:{credential_name}]
-type = {cred_type}
-""".format(
-    name=xnat_cfg_name,
-    # strip /, because it is in the template
-    url=xnat_url.rstrip('/'),
-    # use a simplified/stripped URL as identifier for the credential cfg
-    credential_name=ds.config.obtain('{}.credential-name'.format(cfg_section)),
-    auth_type=ds.config.obtain(
-        '{}.authentication-type'.format(cfg_section),
-        'http_basic_auth'),
-    cred_type=ds.config.obtain(
-        '{}.credential-type'.format(cfg_section),
-        'user_password'),
-)
-
-# place in a file that contains the config name
-auth_file = ds.pathobj / '.datalad' / 'providers' / 'xnat-{}.cfg'.format(
-    xnat_cfg_name)
-
-# don't stress with prev variants, all in git anyways
-if auth_file.exists():
-    auth_file.unlink()
-auth_file.parent.mkdir(parents=True, exist_ok=True)
-
-# write and save file to git
-auth_file.write_text(auth_cfg)
-ds.save(
-    str(auth_file),
-    to_git=True,
-    message="Configure XNAT access authentication",
-)
-
-# enable datalad special remote
-annex = AnnexRepo(ds.path)
-try:
-    annex.is_special_annex_remote(DATALAD_SPECIAL_REMOTE)
-except RemoteNotAvailableError:
-    annex.init_remote(DATALAD_SPECIAL_REMOTE,
-        ['encryption=none', 'type=external', 'externaltype=%s' % DATALAD_SPECIAL_REMOTE,
-            'autoenable=true'])
+from datalad_xnat.auth import configure_dataset_auth
+
+configure_dataset_auth(Dataset(sys.argv[1]))
@@ -0,0 +1,107 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Size-aware scheduling of file downloads
+
+XNAT reports the size of every file, hence the order of downloads can be
+planned. Half of the download slots start with the largest files, so that
+no big transfer is left for the end of an update. The other half works
+through the smallest files, which keeps connections busy while the large
+transfers are bound by bandwidth.
+"""
+
+import logging
+import threading
+from bisect import insort
+from itertools import count
+
+lgr = logging.getLogger('datalad.xnat.schedule')
+
+
+class DownloadScheduler(object):
+    """Dispatch downloads to a thread pool, by file size
+
+    Parameters
+    ----------
+    pool: concurrent.futures.Executor
+    slots: int
+      Maximum number of concurrent downloads.
+    progress: UpdateProgress, optional
+      Receives the size of queued downloads, and the received bytes.
+    """
+    def __init__(self, pool, slots, progress=None):
+        self._pool = pool
+        self._slots = slots
+        # (size, seq, fn, args, item), sorted by size
+        self._queue = []
+        self._seq = count()
+        # future -> (item, is_large)
+        self._running = {}
+        self._large_running = 0
+        self._progress = progress
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.done_bytes = 0
+
+    def __len__(self):
+        """Number of queued and running downloads"""
+        return len(self._queue) + len(self._running)
+
+    @property
+    def running(self):
+        """Futures of the currently running downloads"""
+        return list(self._running)
+
+    def add(self, size, fn, args, item=None):
+        """Queue a download
+
+        Call `dispatch()` to start queued downloads.
+
+        Parameters
+        ----------
+        size: int
+          File size in bytes.
+        fn: callable
+          Download function. It is called with `*args`, and a `progress`
+          keyword argument that must be called with the number of bytes
+          received, as they come in.
+        args: tuple
+        item:
+          Anything that identifies the download to the caller, returned
+          by `pop()` when the download finished.
+        """
+        insort(self._queue, (size, next(self._seq), fn, args, item))
+        self.total_bytes += size
+        if self._progress:
+            self._progress.add_bytes_total(size)
+
+    def pop(self, future):
+        """Return the item of a finished download, and start another one"""
+        item, is_large = self._running.pop(future)
+        if is_large:
+            self._large_running -= 1
+        self.dispatch()
+        return item
+
+    def dispatch(self):
+        """Start queued downloads, while there are free slots"""
+        while self._queue and len(self._running) < self._slots:
+            # half the slots for the largest files, rounded up
+            is_large = self._large_running < (self._slots + 1) // 2
+            size, _, fn, args, item = self._queue.pop(-1 if is_large else 0)
+            if is_large:
+                self._large_running += 1
+            fut = self._pool.submit(fn, *args, progress=self._on_progress)
+            self._running[fut] = (item, is_large)
+
+    def _on_progress(self, nbytes):
+        # called from download threads
+        with self._lock:
+            self.done_bytes += nbytes
+        if self._progress:
+            self._progress.add_bytes(nbytes)
@@ -0,0 +1,185 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Validation of what an XNAT dataset tracks
+
+All experiments of a project are listed with a single request, and the
+given subject and experiment are looked up in there. Only when they are
+not found, further requests tell an unknown identifier from one without
+experiments. The files of the selected experiments are listed
+concurrently, for a summary of what an update would download.
+
+The listings can be saved in the dataset's local state, so that the first
+xnat-update right after xnat-init does not request them again. They are
+used only once, and only if they are younger than
+`datalad.xnat.listing-max-age` seconds (default: 3600).
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from datalad.utils import ensure_list
+
+lgr = logging.getLogger('datalad.xnat.selection')
+
+# default for datalad.xnat.listing-max-age
+listing_max_age = 3600
+
+
+def validate_selection(platform, project=None, subject=None,
+                       experiment=None, collection=None, jobs=4):
+    """Check that what is selected exists, and summarize its files
+
+    Parameters
+    ----------
+    platform: _XNAT
+    project: str or list, optional
+    subject: str, optional
+    experiment: str or list, optional
+    collection: list, optional
+    jobs: int, optional
+      Number of file listings requested concurrently.
+
+    Returns
+    -------
+    dict or None
+      Number of 'experiments', 'files', and their 'bytes'. None, if there
+      is no constraint at all, and everything on the server is selected.
+
+    Raises
+    ------
+    ValueError
+      If an identifier is unknown, or a collection has no files.
+    """
+    projects = project.split() if isinstance(project, str) \
+        else ensure_list(project)
+    if experiment:
+        experiments = ensure_list(experiment)
+        if projects:
+            known = {}
+            for p in projects:
+                known.update(_get_ids(platform.get_experiments(project=p)))
+            unknown = [e for e in experiments if e not in known]
+        else:
+            # nothing to list them all at once
+            unknown = [
+                e for e in experiments if not platform.get_experiment(e)]
+        if unknown:
+            raise ValueError(
+                'Unknown XNAT experiment {}{}'.format(
+                    ', '.join(unknown),
+                    f" in project {' '.join(projects)}" if projects else ''))
+    elif projects:
+        records = []
+        for p in projects:
+            precords = platform.get_experiments(project=p)
+            if not precords and p not in platform.get_project_ids():
+                raise ValueError(f'Unknown XNAT project {p}')
+            records.extend(precords)
+        if subject:
+            records = [r for r in records
+                       if _lower_keys(r).get('subject_id') == subject]
+            if not records and not any(
+                    subject in platform.get_subject_ids(p)
+                    for p in projects):
+                raise ValueError(
+                    f"Unknown XNAT subject {subject} in project "
+                    f"{' '.join(projects)}")
+        experiments = list(_get_ids(records))
+    elif subject:
+        experiments = list(_get_ids(platform.get_experiments(subject=subject)))
+    else:
+        return None
+
+    platform.set_max_connections(jobs)
+    with ThreadPoolExecutor(jobs) as pool:
+        listings = list(pool.map(platform.get_files, experiments))
+    nfiles = nbytes = 0
+    found = set()
+    for files in listings:
+        for f in files or []:
+            f = _lower_keys(f)
+            if collection and f.get('collection') not in collection:
+                continue
+            found.add(f.get('collection'))
+            nfiles += 1
+            nbytes += int(f.get('size') or 0)
+    missing = [c for c in collection or [] if c not in found]
+    if missing and experiments:
+        raise ValueError(
+            'No files in XNAT collection {} of the {} selected '
+            'experiments'.format(', '.join(missing), len(experiments)))
+    return dict(experiments=len(experiments), files=nfiles, bytes=nbytes)
+
+
+def save_listings(path, url, listings):
+    """Save recorded listings of an XNAT server
+
+    Parameters
+    ----------
+    path: Path
+    url: str
+      URL of the XNAT server.
+    listings: dict
+      See `_XNAT.record_listings()`.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as fp:
+        json.dump(dict(url=url, time=time.time(), listings=listings), fp)
+    os.replace(tmp, path)
+
+
+def load_listings(path, url, max_age=listing_max_age, consume=True):
+    """Load listings saved with `save_listings()`
+
+    Parameters
+    ----------
+    path: Path
+    url: str
+      URL of the XNAT server, listings of any other server are ignored.
+    max_age: float, optional
+      Maximum age of the listings in seconds.
+    consume: bool, optional
+      Whether to remove the listings, so that they are used only once.
+
+    Returns
+    -------
+    dict
+      Empty, if there are no suitable listings.
+    """
+    try:
+        with open(path, encoding='utf-8') as fp:
+            saved = json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        lgr.debug('Ignoring invalid XNAT listings in %s: %s', path, e)
+        saved = {}
+    if consume:
+        path.unlink()
+    if saved.get('url') != url:
+        return {}
+    age = time.time() - saved.get('time', 0)
+    if age > max_age:
+        lgr.debug('Ignoring XNAT listings from %.0fs ago', age)
+        return {}
+    listings = saved.get('listings') or {}
+    lgr.debug('Using %i XNAT listings from %.0fs ago', len(listings), age)
+    return listings
+
+
+def _lower_keys(rec):
+    return {k.lower(): v for k, v in rec.items()}
+
+
+def _get_ids(records):
+    return {_lower_keys(r)['id']: None for r in records or []}
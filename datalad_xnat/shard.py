@@ -0,0 +1,174 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Partitioning of xnat-update runs, and merging of their results
+
+A sharded update is run as N independent jobs, each on its own clone of the
+dataset. Every job selects its share of the work units (subjects, or
+experiments) with `select_shard()`. Afterwards `merge_shards()` combines the
+shard clones' results into a single dataset.
+"""
+
+import logging
+
+from datalad.support.exceptions import CommandError
+from datalad.utils import ensure_list
+
+lgr = logging.getLogger('datalad.xnat.shard')
+
+
+def parse_shard_spec(spec):
+    """Parse a shard specification 'I/N' into a 1-based index and a count
+
+    Raises
+    ------
+    ValueError
+      For a malformed specification.
+    """
+    try:
+        index, count = (int(i) for i in spec.split('/'))
+    except (AttributeError, ValueError) as e:
+        raise ValueError(
+            f'Shard specification must be I/N, not {spec!r}') from e
+    if not 0 < index <= count:
+        raise ValueError(
+            f'Shard index must be between 1 and {count}, not {index}')
+    return index, count
+
+
+def select_shard(units, index, count, weights=None):
+    """Select the units of one shard from a balanced partition
+
+    The partition only depends on the units and their weights, not on their
+    order, so all shards of an update agree on it. Units are assigned in
+    order of decreasing weight to the shard with the lowest total weight so
+    far (longest-processing-time-first scheduling).
+
+    Parameters
+    ----------
+    units: list
+      Unique, sortable unit identifiers.
+    index: int
+      1-based index of the shard to select.
+    count: int
+      Total number of shards.
+    weights: dict, optional
+      Mapping of units to their (relative) processing cost, e.g. byte
+      size. Units without a weight have a weight of 1.
+
+    Returns
+    -------
+    list
+      Selected units, in the order of `units`.
+    """
+    weights = weights or {}
+    loads = [0] * count
+    selected = set()
+    for unit in sorted(units, key=lambda u: (-weights.get(u, 1), u)):
+        # ties are resolved by shard index
+        target = min(range(count), key=lambda i: (loads[i], i))
+        loads[target] += weights.get(unit, 1)
+        if target == index - 1:
+            selected.add(unit)
+    return [u for u in units if u in selected]
+
+
+def merge_shards(ds, sources, get_data=True):
+    """Merge the results of sharded updates into a dataset
+
+    Each source is registered as a remote, and the branch checked out in
+    it is merged. Shards do not need to use the same branch name as `ds`.
+    Conflicting additions to `.gitmodules`, caused by subdatasets created in
+    different shards, are resolved by taking the union. Subdatasets and file
+    content added by the shards are then obtained from the shard clones, and
+    the shard remotes are removed again.
+
+    Parameters
+    ----------
+    ds: Dataset
+    sources: list
+      Paths or URLs of the shard clones.
+    get_data: bool, optional
+      Whether to obtain file content, or only subdatasets.
+
+    Yields
+    ------
+    dict
+      Result records.
+    """
+    repo = ds.repo
+    prev_head = repo.get_hexsha()
+    remotes = []
+    try:
+        for i, src in enumerate(ensure_list(sources), start=1):
+            remote = f'xnat-shard-{i}'
+            if remote in repo.get_remotes():
+                repo.remove_remote(remote)
+            repo.add_remote(remote, str(src))
+            remotes.append(remote)
+            # also brings in the git-annex branch, which will be merged
+            # automatically by the next annex command
+            repo.call_git(['fetch', remote])
+            # the branch checked out in the shard
+            repo.call_git(['remote', 'set-head', remote, '--auto'])
+            _merge_shard(repo, f'{remote}/HEAD')
+
+        # anything that changed needs to be obtained from the shard clones,
+        # they come first in the cost order of annex remotes
+        changed = [
+            str(ds.pathobj / p)
+            for p in repo.call_git_items_(
+                ['diff', '--name-only', prev_head, 'HEAD'])
+        ]
+        if changed:
+            yield from ds.get(
+                changed,
+                recursive=True,
+                get_data=get_data,
+                result_renderer='disabled',
+                return_type='generator',
+                on_failure='ignore',
+            )
+    finally:
+        for remote in remotes:
+            repo.remove_remote(remote)
+
+
+def _merge_shard(repo, ref):
+    try:
+        repo.call_git(
+            ['merge', '--no-edit', '-m', f'Merge sharded XNAT update {ref}',
+             ref])
+        return
+    except CommandError:
+        conflicts = list(repo.call_git_items_(
+            ['diff', '--name-only', '--diff-filter=U']))
+        if conflicts != ['.gitmodules']:
+            repo.call_git(['merge', '--abort'])
+            raise
+    lgr.debug('Resolving .gitmodules conflict in merge of %s', ref)
+    # each shard appended its own subdatasets, keep them all
+    stages = {}
+    for stage in (1, 2, 3):
+        stages[stage] = repo.dot_git / f'xnat-gitmodules.{stage}'
+        try:
+            content = repo.call_git(['show', f':{stage}:.gitmodules'])
+        except CommandError:
+            # no common ancestor version
+            content = ''
+        stages[stage].write_text(content)
+    try:
+        repo.call_git(
+            ['merge-file', '--union',
+             str(stages[2]), str(stages[1]), str(stages[3])])
+        (repo.pathobj / '.gitmodules').write_text(stages[2].read_text())
+    finally:
+        for p in stages.values():
+            p.unlink()
+    repo.call_git(['add', '.gitmodules'])
+    repo.call_git(['commit', '--no-edit'])
@@ -0,0 +1,54 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test the configuration of XNAT authentication in a dataset
+
+"""
+
+from unittest.mock import patch
+
+from datalad.api import Dataset
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_in,
+    assert_true,
+    with_tempfile,
+)
+
+from ..auth import configure_dataset_auth
+
+
+@with_tempfile
+def test_configure_dataset_auth(path=None):
+    ds = Dataset(path).create()
+    assert_true(configure_dataset_auth(
+        ds, url='https://xnat.example.org/', credential_name='xnat'))
+    auth_file = ds.pathobj / '.datalad' / 'providers' / 'xnat-default.cfg'
+    auth_cfg = auth_file.read_text()
+    assert_in('url_re = https://xnat.example.org/.*\n', auth_cfg)
+    assert_in('credential = xnat\n', auth_cfg)
+    assert_in('authentication_type = http_basic_auth\n', auth_cfg)
+    assert_false(ds.repo.dirty)
+    commit = ds.repo.get_hexsha()
+    assert_true(ds.repo.is_special_annex_remote('datalad'))
+
+    # nothing to save, or to enable a second time
+    with patch('datalad_xnat.auth.AnnexRepo') as repo:
+        assert_false(configure_dataset_auth(
+            ds, url='https://xnat.example.org', credential_name='xnat'))
+    assert_false(repo.called)
+    assert_equal(ds.repo.get_hexsha(), commit)
+    # the procedure has the same effect
+    ds.config.set('datalad.xnat.default.url', 'https://xnat.example.org',
+                  where='local')
+    ds.config.set('datalad.xnat.default.credential-name', 'xnat',
+                  where='local')
+    ds.run_procedure(spec='cfg_xnat_dataset')
+    assert_equal(auth_file.read_text(), auth_cfg)
+    assert_equal(ds.repo.get_hexsha(), commit)
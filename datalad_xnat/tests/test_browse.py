@@ -0,0 +1,91 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test interactive selection for xnat-init
+
+"""
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_in,
+)
+
+from ..browse import browse_selection
+
+
+class _UI(object):
+    """Gives scripted answers"""
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.messages = []
+
+    def message(self, msg):
+        self.messages.append(msg)
+
+    def question(self, text, **kwargs):
+        return self.answers.pop(0)
+
+    def yesno(self, text, **kwargs):
+        return self.answers.pop(0)
+
+
+class _Platform(object):
+    def __init__(self):
+        self.requests = []
+
+    def get_projects(self):
+        self.requests.append('projects')
+        return [dict(ID='p1', name='Pilot'), dict(ID='p2', name='Main')]
+
+    def get_subjects(self, project):
+        self.requests.append(('subjects', project))
+        return [dict(ID=f's{i:05d}', label=f'sub-{i}') for i in range(10000)]
+
+    def get_experiments(self, project=None):
+        self.requests.append(('experiments', project))
+        return [dict(ID=f'e{i}', label=f'ses-{i}',
+                     subject_ID=f's{i % 3:05d}') for i in range(6)]
+
+    def get_files(self, experiment):
+        self.requests.append(('files', experiment))
+        return [dict(collection='DICOM'), dict(collection='NIFTI'),
+                dict(collection='DICOM')]
+
+
+def test_browse_selection():
+    platform = _Platform()
+    ui = _UI([
+        # filter the projects, confirm the single match
+        'main', True,
+        # second page of subjects, filter, and pick one
+        '>', 's0000', '2',
+        # experiments of the subject only
+        '2',
+        'NIFTI', True,
+    ])
+    assert_equal(
+        browse_selection(ui, platform),
+        ('p2', 's00001', 'e4', ['NIFTI']))
+    assert_equal(ui.answers, [])
+    assert_in('10000 subjects, page 2 of 500:', ui.messages)
+    assert_in('2 experiments, page 1 of 1:', ui.messages)
+    # every listing once
+    assert_equal(
+        sorted(map(str, platform.requests)),
+        sorted(map(str, [
+            'projects', ('subjects', 'p2'), ('experiments', 'p2'),
+            ('files', 'e4')])))
+
+    # nothing to ask
+    assert_equal(
+        browse_selection(_UI([]), platform, 'p1', 's1', 'e1', ['DICOM']),
+        ('p1', 's1', 'e1', ['DICOM']))
+    # no project means no constraint at all
+    assert_equal(
+        browse_selection(_UI(['']), platform),
+        (None, None, None, None))
@@ -0,0 +1,90 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test the host-wide content cache
+
+"""
+
+import hashlib
+import os
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_not_equal,
+    assert_true,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from ..cache import (
+    ContentCache,
+    _parse_size,
+)
+
+
+def test_parse_size():
+    assert_equal(_parse_size('100'), 100)
+    assert_equal(_parse_size('2k'), 2048)
+    assert_equal(_parse_size('1.5G'), 1536 * 1024 ** 2)
+    assert_equal(_parse_size('10MB'), 10 * 1024 ** 2)
+
+
+@with_tempfile(mkdir=True)
+def test_cache(path=None):
+    path = Path(path)
+    cache = ContentCache(path / 'cache', 250)
+    files = {}
+    for i, name in enumerate('abc'):
+        content = name.encode() * 100
+        md5 = hashlib.md5(content).hexdigest()
+        src = path / name
+        src.write_bytes(content)
+        files[name] = (md5, len(content))
+        cache.put(src, md5, len(content))
+        # fixed order of use
+        os.utime(cache._get_object_path(md5, len(content)), (i, i))
+    # 'a' was evicted, after 'c' was added
+    assert_false(cache.get(*files['a'], path / 'a_out'))
+    assert_true(cache.get(*files['b'], path / 'b_out'))
+    assert_equal((path / 'b_out').read_bytes(), b'b' * 100)
+
+    # 'b' was used last, 'c' is evicted next
+    src = path / 'd'
+    src.write_bytes(b'd' * 100)
+    cache.put(src, hashlib.md5(src.read_bytes()).hexdigest(), 100)
+    assert_false(cache.get(*files['c'], path / 'c_out'))
+    assert_true(cache.get(*files['b'], path / 'b_out2'))
+
+    # content is never hardlinked
+    obj = cache._get_object_path(*files['b'])
+    assert_not_equal(obj.stat().st_ino, (path / 'b').stat().st_ino)
+    assert_not_equal(obj.stat().st_ino, (path / 'b_out').stat().st_ino)
+
+    # truncated content is not provided
+    obj.write_bytes(b'b' * 50)
+    assert_false(cache.get(*files['b'], path / 'b_out3'))
+    assert_false((path / 'b_out3').exists())
+    # content that failed verification elsewhere is removed
+    cache.discard(*files['b'])
+    assert_false(obj.exists())
+
+
+@with_tempfile(mkdir=True)
+def test_cache_size(path=None):
+    path = Path(path)
+    src = path / 'a'
+    src.write_bytes(b'a' * 100)
+    md5 = hashlib.md5(src.read_bytes()).hexdigest()
+    ContentCache(path / 'cache', 1000).put(src, md5, 100)
+    # a new cache instance learns the size of existing content on first
+    # put, which includes the new content already
+    cache = ContentCache(path / 'cache', 1000)
+    src.write_bytes(b'b' * 100)
+    cache.put(src, hashlib.md5(src.read_bytes()).hexdigest(), 100)
+    assert_equal(cache._size, 200)
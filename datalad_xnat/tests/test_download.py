@@ -0,0 +1,229 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test downloads of file content
+
+"""
+
+import hashlib
+import re
+from unittest.mock import patch
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_raises,
+    assert_true,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from .. import download
+from ..download import download_file
+from ..platform import XNATRequestError
+
+
+class _Response(object):
+    def __init__(self, content, status_code=200, fail_at=None):
+        self.content = content
+        self.status_code = status_code
+        self.fail_at = fail_at
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.closed = True
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            if self.fail_at is not None and i >= self.fail_at:
+                raise XNATRequestError('Connection dropped')
+            yield self.content[i:i + chunk_size]
+
+
+class _Platform(object):
+    """Serves a single file, optionally honoring range requests"""
+    def __init__(self, content, ranges=True, fail_at=None):
+        self.content = content
+        self.ranges = ranges
+        # byte offset at which the connection drops
+        self.fail_at = fail_at
+        self.requests = []
+        self.responses = []
+
+    def get_stream(self, url, headers=None):
+        rng = (headers or {}).get('Range')
+        self.requests.append(rng)
+        if rng and self.ranges:
+            start, end = re.fullmatch(r'bytes=(\d+)-(\d*)', rng).groups()
+            start = int(start)
+            end = int(end) if end else len(self.content) - 1
+            response = _Response(
+                self.content[start:end + 1], 206,
+                fail_at=self._get_fail_at(start, end))
+        else:
+            response = _Response(self.content, fail_at=self._get_fail_at(
+                0, len(self.content) - 1))
+        self.responses.append(response)
+        return response
+
+    def _get_fail_at(self, start, end):
+        if self.fail_at is not None and start <= self.fail_at <= end:
+            return self.fail_at - start
+
+
+class _Repo(object):
+    def __init__(self, path):
+        self.dot_git = Path(path)
+
+
+@with_tempfile(mkdir=True)
+def test_download_file(path=None):
+    repo = _Repo(path)
+    content = bytes(range(256)) * 41
+    md5 = hashlib.md5(content).hexdigest()
+    received = []
+    with patch.object(download, 'chunked_download_threshold', 1000), \
+            patch.object(download, 'chunked_download_part_size', 1000):
+        # small file, single stream
+        platform = _Platform(content[:999])
+        dest = download_file(platform, 'url', repo, size=999)
+        assert_equal(dest.read_bytes(), content[:999])
+        assert_equal(platform.requests, [None])
+
+        # large file, in ranges
+        platform = _Platform(content)
+        dest = download_file(platform, 'url', repo, size=len(content),
+                             md5=md5, chunk_size=100,
+                             progress=received.append)
+        assert_equal(dest.read_bytes(), content)
+        assert_equal(sum(received), len(content))
+        assert_equal(len(platform.requests), 11)
+        assert_equal(platform.requests[-1],
+                     f'bytes=10000-{len(content) - 1}')
+
+        # no range support on the server
+        platform = _Platform(content, ranges=False)
+        dest = download_file(platform, 'url', repo, size=len(content),
+                             md5=md5)
+        assert_equal(dest.read_bytes(), content)
+        assert_equal(len(platform.requests), 1)
+
+        # corrupted download is removed
+        platform = _Platform(content)
+        assert_raises(
+            XNATRequestError,
+            download_file, platform, 'url', repo, size=len(content),
+            md5=hashlib.md5(b'other').hexdigest())
+        # only the successful downloads are left, the last two of the
+        # same content
+        assert_equal(len(list((Path(path) / 'annex' / 'tmp').iterdir())), 2)
+
+
+@with_tempfile(mkdir=True)
+def test_preallocation_failure(path=None):
+    repo = _Repo(path)
+    content = bytes(range(256)) * 8
+    platform = _Platform(content)
+    with patch.object(download, 'chunked_download_threshold', 1000), \
+            patch.object(download, 'chunked_download_part_size', 1000), \
+            patch('os.posix_fallocate', create=True,
+                  side_effect=OSError(28, 'No space left on device')):
+        assert_raises(
+            OSError,
+            download_file, platform, 'url', repo, size=len(content),
+            md5=hashlib.md5(content).hexdigest())
+    # the response of the first range is not left open
+    assert_equal(len(platform.responses), 1)
+    assert_true(platform.responses[0].closed)
+
+
+@with_tempfile(mkdir=True)
+def test_resume_download(path=None):
+    repo = _Repo(path)
+    content = bytes(range(256)) * 41
+    md5 = hashlib.md5(content).hexdigest()
+    with patch.object(download, 'chunked_download_threshold', 1000), \
+            patch.object(download, 'chunked_download_part_size', 1000):
+        # connection drops in the middle of the fifth range
+        platform = _Platform(content, fail_at=4500)
+        with patch.object(download, 'chunked_download_max_parts', 1):
+            assert_raises(
+                XNATRequestError,
+                download_file, platform, 'url', repo, size=len(content),
+                md5=md5, chunk_size=100)
+        # ranges are fetched again from the fifth one on
+        platform = _Platform(content)
+        received = []
+        dest = download_file(platform, 'url', repo, size=len(content),
+                             md5=md5, chunk_size=100,
+                             progress=received.append)
+        assert_equal(dest.read_bytes(), content)
+        assert_equal(platform.requests[0], 'bytes=4000-4999')
+        assert_equal(len(platform.requests), 7)
+        # verified ranges count as progress
+        assert_equal(sum(received), len(content))
+
+        # single stream download of a small file, of several parts
+        small = content[:900]
+        small_md5 = hashlib.md5(small).hexdigest()
+        with patch.object(download, 'chunked_download_part_size', 300):
+            platform = _Platform(small, fail_at=500)
+            assert_raises(
+                XNATRequestError,
+                download_file, platform, 'url', repo, size=900,
+                md5=small_md5, chunk_size=100)
+            platform = _Platform(small)
+            dest = download_file(platform, 'url', repo, size=900,
+                                 md5=small_md5, chunk_size=100)
+        assert_equal(dest.read_bytes(), small)
+        assert_equal(platform.requests, ['bytes=500-'])
+
+        # only the intact head of a stream download is continued
+        with patch.object(download, 'chunked_download_part_size', 300):
+            platform = _Platform(small, fail_at=700)
+            assert_raises(
+                XNATRequestError,
+                download_file, platform, 'url', repo, size=900,
+                md5=small_md5, chunk_size=100)
+            with open(Path(path) / 'annex' / 'tmp' / f'xnat-{small_md5}-900',
+                      'r+b') as fp:
+                # in the second part
+                fp.seek(400)
+                fp.write(b'X')
+            platform = _Platform(small)
+            received = []
+            dest = download_file(platform, 'url', repo, size=900,
+                                 md5=small_md5, chunk_size=100,
+                                 progress=received.append)
+        assert_equal(dest.read_bytes(), small)
+        assert_equal(platform.requests, ['bytes=300-'])
+        assert_equal(sum(received), 900)
+        # no bookkeeping is left behind
+        assert_equal(
+            sorted(p.name for p in (Path(path) / 'annex' / 'tmp').iterdir()),
+            sorted([f'xnat-{md5}-{len(content)}', f'xnat-{small_md5}-900']))
+
+        # a file of a single part is not resumable, and downloaded again
+        tiny = content[:800]
+        platform = _Platform(tiny, fail_at=500)
+        assert_raises(
+            XNATRequestError,
+            download_file, platform, 'url', repo, size=800,
+            md5=hashlib.md5(tiny).hexdigest(), chunk_size=100)
+        assert_equal(len(list((Path(path) / 'annex' / 'tmp').iterdir())), 2)
+        platform = _Platform(tiny)
+        dest = download_file(platform, 'url', repo, size=800,
+                             md5=hashlib.md5(tiny).hexdigest(),
+                             chunk_size=100)
+        assert_equal(dest.read_bytes(), tiny)
+        assert_equal(platform.requests, [None])
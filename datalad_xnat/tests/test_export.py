@@ -0,0 +1,101 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test bulk export of file records
+
+"""
+
+import csv
+import json
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_raises,
+    skip_if_no_module,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from ..export import get_record_writer
+
+
+def _make_records(n):
+    return [
+        dict(
+            action='xnat_query',
+            status='ok',
+            path=f'E1/{i}/f{i}.dcm',
+            experiment_id='E1',
+            scan_id=str(i),
+            name=f'f{i}.dcm',
+            name_suffix='.dcm',
+            # XNAT reports sizes as strings
+            **{'byte-size': str(i * 100)},
+        )
+        for i in range(n)
+    ]
+
+
+@with_tempfile
+def test_export_csv(path=None):
+    records = _make_records(25)
+    with get_record_writer('csv', path, batch_size=10) as writer:
+        for r in records:
+            writer.write(r)
+    assert_equal(writer.count, 25)
+    with open(path, newline='', encoding='utf-8') as fp:
+        rows = list(csv.DictReader(fp))
+    assert_equal(len(rows), 25)
+    assert_equal(rows[3]['path'], 'E1/3/f3.dcm')
+    assert_equal(rows[3]['byte-size'], '300')
+    # result properties are not exported
+    assert 'action' not in rows[0]
+
+
+@with_tempfile
+def test_export_jsonl(path=None):
+    with get_record_writer('jsonl', path, batch_size=10) as writer:
+        for r in _make_records(25):
+            writer.write(r)
+    lines = Path(path).read_text().splitlines()
+    assert_equal(len(lines), 25)
+    rec = json.loads(lines[3])
+    assert_equal(rec['path'], 'E1/3/f3.dcm')
+    assert_equal(rec['byte-size'], 300)
+    # compact representation
+    assert ', ' not in lines[3]
+
+
+def test_export_stdout(capsys):
+    with get_record_writer('jsonl', None) as writer:
+        for r in _make_records(3):
+            writer.write(r)
+    assert_equal(len(capsys.readouterr().out.splitlines()), 3)
+    with get_record_writer('csv', None) as writer:
+        for r in _make_records(3):
+            writer.write(r)
+    out = capsys.readouterr().out
+    assert_equal(len(out.splitlines()), 4)
+    # no CSV line terminators, newlines are left to the stream
+    assert '\r' not in out
+    assert_raises(ValueError, get_record_writer, 'parquet', None)
+
+
+@with_tempfile
+def test_export_parquet(path=None):
+    skip_if_no_module('pyarrow')
+    import pyarrow.parquet as pq
+
+    path = Path(path).with_suffix('.parquet')
+    with get_record_writer('parquet', path, batch_size=10) as writer:
+        for r in _make_records(25):
+            writer.write(r)
+    table = pq.read_table(str(path))
+    assert_equal(table.num_rows, 25)
+    assert_equal(table.column('byte-size').to_pylist()[3], 300)
+    assert_equal(table.column('digest-md5').to_pylist()[3], None)
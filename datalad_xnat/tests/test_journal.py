@@ -0,0 +1,70 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test the xnat-update checkpoint journal
+
+"""
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_true,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from ..journal import (
+    UpdateJournal,
+    get_download_rate,
+    record_run_stats,
+)
+
+
+@with_tempfile
+def test_journal(path=None):
+    path = Path(path)
+    params = dict(project='p1', subject=[])
+
+    journal = UpdateJournal(path)
+    # nothing on record
+    assert_false(journal.is_resumable(params))
+    journal.begin(params, ['s1', 's2', 's3'])
+    journal.start('s1')
+    journal.done('s1', nfiles=3)
+    journal.start('s2')
+    # simulate an interruption while writing
+    with open(path, 'a') as fp:
+        fp.write('{"event": "do')
+
+    journal = UpdateJournal(path)
+    assert_true(journal.is_resumable(params))
+    assert_false(journal.is_resumable(dict(params, project='p2')))
+    assert_equal(journal.units, ['s1', 's2', 's3'])
+    assert_equal(journal.finished, {'s1': {'nfiles': 3}})
+    assert_equal(journal.inflight, {'s2'})
+
+    journal.complete()
+    assert_false(UpdateJournal(path).is_resumable(params))
+
+    # a new run discards the previous record
+    journal.begin(params, ['s4'])
+    journal = UpdateJournal(path)
+    assert_equal(journal.units, ['s4'])
+    assert_equal(journal.finished, {})
+
+
+@with_tempfile
+def test_download_rate(path=None):
+    path = Path(path)
+    assert_equal(get_download_rate(path), None)
+    record_run_stats(path, bytes=1000, seconds=10)
+    # runs without downloads do not count
+    record_run_stats(path, bytes=0, seconds=5)
+    record_run_stats(path, bytes=3000, seconds=10)
+    assert_equal(get_download_rate(path), 200)
+    assert_equal(get_download_rate(path, max_runs=1), 300)
@@ -0,0 +1,123 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test request metrics
+
+"""
+
+from unittest.mock import patch
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_in,
+    assert_not_in,
+    patch_config,
+    with_tempfile,
+)
+
+from ..metrics import (
+    CommandMetrics,
+    RequestMetrics,
+    _get_command_config,
+)
+from ..platform import _XNAT
+
+
+def _event(endpoint, latency, **kwargs):
+    event = dict(method='GET', url='', endpoint=endpoint, status=200,
+                 latency=latency, duration=latency, bytes=0, retries=0,
+                 error=None)
+    event.update(kwargs)
+    return event
+
+
+def test_request_metrics():
+    metrics = RequestMetrics()
+    metrics(_event('scans', 0.02, bytes=100))
+    metrics(_event('scans', 0.3, duration=0.5, bytes=50, retries=2))
+    metrics(_event('file', 12.0, status=None, error='timeout'))
+    scans = metrics.endpoints['scans']
+    assert_equal(scans['count'], 2)
+    assert_equal(scans['bytes'], 150)
+    assert_equal(scans['retries'], 2)
+    assert_equal(scans['status'], {200: 2})
+    assert_equal(sum(scans['latency_buckets']), 2)
+    files = metrics.endpoints['file']
+    assert_equal(files['errors'], 1)
+    # beyond the largest finite bound
+    assert_equal(files['latency_buckets'][-1], 1)
+    summary = metrics.format_summary()
+    assert_in('scans: 2 requests, 0 errors, 2 retries, 150 bytes', summary)
+    assert_in('file: 1 requests, 1 errors', summary)
+
+
+def test_get_endpoint():
+    xnat = _XNAT.__new__(_XNAT)
+    xnat.url = 'https://xnat.example.org'
+    for url, endpoint in (
+            ('data/projects?format=json', 'projects'),
+            ('data/projects/p1/subjects?format=json', 'subjects'),
+            ('data/experiments/e1?format=json', 'experiment'),
+            ('data/experiments?format=json', 'experiments'),
+            ('data/experiments/e1/scans?format=json', 'scans'),
+            ('data/experiments/e1/scans/ALL/files?format=json', 'files'),
+            ('data/experiments/e1/scans/2/resources/DICOM/files/a.dcm',
+             'file'),
+            ('data/somewhere', 'other')):
+        assert_equal(xnat._get_endpoint(f'{xnat.url}/{url}'), endpoint)
+
+
+@with_tempfile(mkdir=True)
+def test_command_metrics_textfile(path=None):
+    metrics = CommandMetrics('xnat-update', '/data/"ds"')
+    metrics.requests(_event('scans', 0.02, bytes=100))
+    metrics.add_result(dict(action='xnat_download', status='ok'))
+    metrics.add_count('downloaded_bytes', 1000)
+    metrics.add_phase('listing', 1.5)
+    metrics.add_phase('listing', 0.5)
+    metrics.finish()
+    labels = 'command="xnat-update",dataset="/data/\\"ds\\""'
+    text = metrics.format_textfile()
+    for line in (
+            '# TYPE datalad_xnat_requests_total counter',
+            f'datalad_xnat_requests_total{{{labels},endpoint="scans",'
+            'code="200"} 1',
+            f'datalad_xnat_request_latency_seconds_bucket{{{labels},'
+            'endpoint="scans",le="0.025"} 1',
+            f'datalad_xnat_request_latency_seconds_bucket{{{labels},'
+            'endpoint="scans",le="+Inf"} 1',
+            f'datalad_xnat_results_total{{{labels},action="xnat_download",'
+            'status="ok"} 1',
+            f'datalad_xnat_downloaded_bytes_total{{{labels}}} 1000',
+            f'datalad_xnat_phase_seconds_total{{{labels},phase="listing"}} '
+            '2.0'):
+        assert_in(line, text.splitlines())
+    assert_not_in('# EOF', text)
+
+    text = metrics.format_textfile(openmetrics=True)
+    assert_in('# TYPE datalad_xnat_requests counter', text.splitlines())
+    assert_equal(text.splitlines()[-1], '# EOF')
+
+    written = metrics.write_textfile(path)
+    assert_equal(written.suffix, '.prom')
+    assert_equal(written.read_text(), metrics.format_textfile())
+    # replaced by the next run
+    assert_equal(metrics.write_textfile(path), written)
+
+
+def test_get_command_config():
+    from datalad import cfg
+    with patch('datalad.distribution.dataset.require_dataset') as require:
+        # no dataset is looked up for a command without one, unless enabled
+        assert_equal(_get_command_config(None, with_dataset=False),
+                     (cfg, None))
+        assert_false(require.called)
+        with patch_config({'datalad.xnat.metrics': 'true'}):
+            _get_command_config(None, with_dataset=False)
+        assert_equal(require.call_count, 1)
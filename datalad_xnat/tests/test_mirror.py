@@ -0,0 +1,149 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test downloads from XNAT mirrors
+
+"""
+
+from unittest.mock import patch
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_in,
+    assert_raises,
+    assert_true,
+)
+from requests import ConnectionError
+
+from ..mirror import (
+    Mirror,
+    ServerStats,
+    download_from_fastest,
+)
+from ..platform import XNATRequestError
+
+
+class _Platform(object):
+    def __init__(self, url):
+        self.url = url
+        self.requests = []
+
+    def get_experiments(self, project=None):
+        self.requests.append(('experiments', project))
+        return [dict(ID='M_E1', label='ses-1'), dict(ID='M_E2', label='ses-2')]
+
+    def get_files(self, experiment):
+        self.requests.append(('files', experiment))
+        uri = f'/data/experiments/{experiment}/scans/1/resources/9/files/'
+        return [
+            dict(Name='a.dcm', collection='DICOM', digest='a' * 32,
+                 URI=uri + 'a.dcm'),
+            dict(Name='b.dcm', collection='DICOM', digest='c' * 32,
+                 URI=uri + 'b.dcm'),
+        ]
+
+
+def _rec(name, digest, label='ses-1'):
+    return {
+        'project_id': 'P1',
+        'experiment_label': label,
+        'scan_id': '1',
+        'collection': 'DICOM',
+        'name': name,
+        'digest-md5': digest,
+    }
+
+
+def test_mirror_urls():
+    mirror = Mirror('central', _Platform('https://central.example.org'))
+    assert_equal(
+        mirror.get_urls([
+            _rec('a.dcm', 'a' * 32),
+            # different content
+            _rec('b.dcm', 'b' * 32),
+            # unknown experiment
+            _rec('a.dcm', 'a' * 32, label='ses-3'),
+            _rec('a.dcm', 'a' * 32, label='ses-2'),
+        ]),
+        ['https://central.example.org/data/experiments/M_E1/scans/1'
+         '/resources/9/files/a.dcm',
+         None,
+         None,
+         'https://central.example.org/data/experiments/M_E2/scans/1'
+         '/resources/9/files/a.dcm'])
+    # the experiments of a project are listed once
+    mirror.get_urls([_rec('a.dcm', 'a' * 32)])
+    assert_equal(
+        mirror.platform.requests,
+        [('experiments', 'P1'), ('files', 'M_E1'), ('files', 'M_E2'),
+         ('files', 'M_E1')])
+
+
+def test_server_stats():
+    site = _Platform('https://site.example.org')
+    central = _Platform('https://central.example.org')
+    candidates = [(site, 'site-url'), (central, 'central-url')]
+    stats = ServerStats()
+    # unmeasured servers in the given order
+    assert_equal(stats.rank(candidates, 1000), candidates)
+    stats.add_latency(site.url, dict(status=200, latency=0.5))
+    stats.add_transfer(site.url, 1000, 1.0)
+    # servers without measurements are tried first
+    assert_equal(stats.rank(candidates, 1000), candidates[::-1])
+    stats.add_latency(central.url, dict(status=200, latency=0.1))
+    stats.add_transfer(central.url, 1000, 0.1)
+    assert_equal(stats.rank(candidates, 1000), candidates[::-1])
+    # small files are bound by latency, large ones by throughput
+    stats.add_latency(central.url, dict(status=200, latency=2.0))
+    assert_equal(stats.rank(candidates, 10), candidates)
+    assert_equal(stats.rank(candidates, 10 ** 6), candidates[::-1])
+    # unreachable servers come last
+    stats.set_unreachable(central.url)
+    assert_equal(stats.rank(candidates, 10 ** 6), candidates)
+
+
+def test_download_from_fastest():
+    site = _Platform('https://site.example.org')
+    central = _Platform('https://central.example.org')
+    candidates = [(site, 'site-url'), (central, 'central-url')]
+    attempts = []
+    received = []
+
+    def download(platform, url, repo, size, md5, cache, progress=None):
+        attempts.append(url)
+        # a part arrives from every server
+        progress(40)
+        if url == 'site-url':
+            raise XNATRequestError('Request to XNAT server failed')
+        progress(60)
+        return 'path'
+
+    with patch('datalad_xnat.download.download_file', side_effect=download):
+        assert_equal(
+            download_from_fastest(
+                candidates, ServerStats(), None, size=100, md5='a' * 32,
+                progress=received.append),
+            'path')
+        assert_equal(attempts, ['site-url', 'central-url'])
+        # the retry reports only new bytes
+        assert_equal(sum(received), 100)
+
+        with assert_raises(XNATRequestError):
+            download_from_fastest(candidates[:1], ServerStats(), None)
+
+    # a failure of all servers names the file, and every failed URL
+    uri = '/data/experiments/E1/scans/1/resources/9/files/a.dcm'
+    candidates = [(site, site.url + uri), (central, central.url + uri)]
+    with patch('datalad_xnat.download.download_file',
+               side_effect=ConnectionError('unreachable')):
+        with assert_raises(XNATRequestError) as cm:
+            download_from_fastest(candidates, ServerStats(), None)
+    assert_in('a.dcm', str(cm.value))
+    for _, url in candidates:
+        assert_in(url, str(cm.value))
+    assert_true(isinstance(cm.value.__cause__, ConnectionError))
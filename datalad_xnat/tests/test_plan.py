@@ -0,0 +1,83 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test xnat-update planning
+
+"""
+
+from datalad.distribution.dataset import Dataset
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from ..plan import (
+    _get_file_state,
+    get_file_location,
+    get_unit_query,
+)
+
+_rec = {
+    'subject_id': 'S1',
+    'experiment_id': 'E1',
+    'scan_id': '2',
+    'name': 'f.dcm',
+    'byte-size': '450',
+    'digest-md5': '19b1adc022d2f0c5a25c08c623d31c46',
+}
+
+
+def test_get_file_location():
+    ds = Dataset('/tmp/ds')
+    assert_equal(
+        get_file_location(ds, '{subject}/{session}/{scan}/', _rec),
+        (ds.pathobj, 'S1/E1/2/f.dcm'))
+    assert_equal(
+        get_file_location(ds, '{subject}//{session}/{scan}/', _rec),
+        (ds.pathobj / 'S1', 'E1/2/f.dcm'))
+
+
+@with_tempfile
+def test_get_file_state(path=None):
+    path = Path(path)
+    key = 'MD5E-s450--19b1adc022d2f0c5a25c08c623d31c46.dcm'
+    assert_equal(_get_file_state(_rec, dict(path=path)), 'new')
+    assert_equal(_get_file_state(_rec, dict(path=path, key=key)),
+                 'unchanged')
+    assert_equal(
+        _get_file_state(dict(_rec, **{'digest-md5': 'a' * 32}),
+                        dict(path=path, key=key)),
+        'changed')
+    # other backends are compared by size
+    assert_equal(
+        _get_file_state(_rec, dict(path=path, key='SHA256E-s450--abc.dcm',
+                                   bytesize=450)),
+        'unchanged')
+    assert_equal(
+        _get_file_state(_rec, dict(path=path, key='SHA256E-s45--abc.dcm',
+                                   bytesize=45)),
+        'changed')
+    # a file that is not annexed
+    path.write_text('content')
+    assert_equal(_get_file_state(_rec, dict(path=path)), 'changed')
+
+
+def test_get_unit_query():
+    assert_equal(
+        get_unit_query('S1', 'subject', ['P1'], 'E1'),
+        dict(project='P1', subject='S1', experiment='E1'))
+    assert_equal(
+        get_unit_query('P2/S1', 'subject', ['P1', 'P2']),
+        dict(project='P2', subject='S1', experiment=None))
+    assert_equal(
+        get_unit_query(None, 'subject', ['P1', 'P2'], 'E1'),
+        dict(project=None, subject=None, experiment='E1'))
+    assert_equal(
+        get_unit_query('E2', 'experiment', ['P1']),
+        dict(project=None, subject=None, experiment='E2'))
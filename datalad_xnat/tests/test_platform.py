@@ -0,0 +1,115 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test the platform abstraction without an XNAT server
+
+"""
+
+import time
+from unittest.mock import patch
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_raises,
+    assert_true,
+)
+from requests import (
+    HTTPError,
+    Response,
+)
+
+from ..platform import (
+    _XNAT,
+    XNATRequestError,
+)
+
+
+def _response(status=200, content=b'{"ResultSet": {"Result": []}}'):
+    response = Response()
+    response.status_code = status
+    response._content = content
+    response.url = 'http://xnat.example.org'
+    return response
+
+
+def test_lazy_auth():
+    calls = []
+
+    def request(method):
+        def send(url, **kwargs):
+            calls.append((method, url))
+            return responses.pop(0)
+        return send
+
+    with patch('requests.Session.get', side_effect=request('GET')), \
+            patch('requests.Session.post', side_effect=request('POST')):
+        responses = [_response()]
+        xnat = _XNAT('http://xnat.example.org/', 'anonymous')
+        # the eager check obtains a session
+        assert_equal(
+            calls, [('POST', 'http://xnat.example.org/data/JSESSION')])
+        assert_true(xnat._has_session)
+
+        calls.clear()
+        xnat = _XNAT('http://xnat.example.org/', 'anonymous', lazy_auth=True)
+        assert_equal(calls, [])
+        assert_false(xnat._has_session)
+        # a failing first request leaves no session
+        responses = [_response(status=401)]
+        with assert_raises(XNATRequestError) as cm:
+            xnat.get_projects()
+        assert_true(isinstance(cm.value.__cause__, HTTPError))
+        assert_false(xnat._has_session)
+        responses = [_response()]
+        assert_equal(xnat.get_projects(), [])
+        assert_true(xnat._has_session)
+        assert_equal(
+            calls,
+            [('GET', 'http://xnat.example.org/data/projects?format=json')] * 2)
+
+
+def test_preload_listings():
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        return _response(
+            content=b'{"ResultSet": {"Result": ['
+                    b'{"ID": "e1", "subject_ID": "s1"}, '
+                    b'{"ID": "e2", "subject_ID": "s2"}]}}')
+
+    with patch('requests.Session.get', side_effect=get):
+        xnat = _XNAT('http://xnat.example.org/', 'anonymous', lazy_auth=True)
+        listings = xnat.record_listings()
+        assert_equal(xnat.get_experiment_ids(project='p1'), ['e1', 'e2'])
+        assert_equal(len(calls), 1)
+
+        xnat = _XNAT('http://xnat.example.org/', 'anonymous', lazy_auth=True)
+        xnat.preload_listings(listings)
+        assert_equal(xnat.get_experiment_ids(project='p1'), ['e1', 'e2'])
+        # narrowed down to a subject without a request
+        assert_equal(xnat.get_experiment_ids(project='p1', subject='s2'),
+                     ['e2'])
+        assert_equal(len(calls), 1)
+        # anything else is requested
+        xnat.get_experiments(project='p2')
+        assert_equal(len(calls), 2)
+
+
+def test_rate_limit():
+    xnat = _XNAT('http://xnat.example.org/', 'anonymous', lazy_auth=True)
+    start = time.monotonic()
+    for i in range(3):
+        xnat._throttle()
+    assert_true(time.monotonic() - start < 0.05)
+    xnat.set_rate_limit(20)
+    for i in range(3):
+        xnat._throttle()
+    # the first request is immediate, every further one waits 50ms
+    assert_true(time.monotonic() - start >= 0.1)
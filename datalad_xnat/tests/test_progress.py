@@ -0,0 +1,82 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test progress reporting of xnat-update
+
+"""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_in,
+    swallow_logs,
+)
+
+from ..progress import UpdateProgress
+
+
+class _Platform(object):
+    request_count = 0
+
+
+def test_update_progress():
+    platform = _Platform()
+    progress = UpdateProgress(
+        4, units_done=1, platform=platform, status_interval=0)
+    progress.add_files(10, done=6)
+    progress.add_bytes_total(1000)
+    progress.add_bytes(400)
+    progress.file_done()
+    progress.unit_done()
+    platform.request_count = 12
+    status = progress.get_status()
+    assert_equal(
+        {k: status[k] for k in ('units_done', 'units_total', 'files_done',
+                                'files_total', 'bytes_done', 'bytes_total')},
+        dict(units_done=2, units_total=4, files_done=7, files_total=10,
+             bytes_done=400, bytes_total=1000))
+    assert_equal(status['eta'] is None, status['byte_rate'] == 0)
+
+    with swallow_logs(new_level=20) as cml:
+        progress.log_status()
+        line = cml.out.strip()
+    assert_in('xnat-update status ', line)
+    logged = json.loads(line.split('xnat-update status ', 1)[1])
+    assert_equal(logged['files_done'], 7)
+    progress.finish()
+
+
+def test_concurrent_reports():
+    progress = UpdateProgress(1, platform=_Platform(), status_interval=0)
+    # report every update
+    progress.progress_interval = 0
+    calls = []
+
+    def log_progress(*args, **kwargs):
+        # a slow progress bar lets threads interleave
+        time.sleep(0.001)
+        calls.append((args[2], kwargs))
+
+    with patch('datalad_xnat.progress.log_progress',
+               side_effect=log_progress):
+        with ThreadPoolExecutor(8) as pool:
+            for _ in range(8):
+                pool.submit(progress.add_bytes_total, 100)
+            for _ in range(800):
+                pool.submit(progress.add_bytes, 1)
+        progress.unit_done()
+        progress.finish()
+    # a single start, before any update, and the bar ends complete
+    assert_equal(calls[0][0], 'Start XNAT update')
+    assert_equal(calls[-1][0], 'Finished XNAT update')
+    assert_equal([m for m, _ in calls].count('Start XNAT update'), 1)
+    assert_equal(sum(kw.get('update', 0) for _, kw in calls), 800)
@@ -0,0 +1,56 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test bulk creation of subdatasets
+
+"""
+
+from datalad.api import Dataset
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_true,
+    with_tempfile,
+)
+
+from ..provision import (
+    get_subject_dataset_paths,
+    provision_datasets,
+)
+
+
+@with_tempfile
+def test_provision_datasets(path=None):
+    ds = Dataset(path).create()
+    assert_equal(
+        get_subject_dataset_paths(ds, '{subject}/{session}/{scan}/', 's1'),
+        [])
+    assert_equal(
+        get_subject_dataset_paths(ds, 'sub-{subject}//{session}//', 's1'),
+        [ds.pathobj / 'sub-s1'])
+
+    paths = [ds.pathobj / 's1', ds.pathobj / 's2', ds.pathobj / 's1' / 'e1']
+    assert_equal(
+        provision_datasets(
+            ds, paths,
+            auth=dict(url='https://xnat.example.org', credential_name='x'),
+            jobs=2),
+        paths)
+    assert_false(ds.repo.dirty)
+    assert_equal(
+        sorted(s['path'] for s in ds.subdatasets(
+            recursive=True, result_renderer='disabled')),
+        sorted(str(p) for p in paths))
+    # all are configured, in parallel
+    for p in paths:
+        assert_true(
+            (p / '.datalad' / 'providers' / 'xnat-default.cfg').exists())
+        assert_true(Dataset(p).repo.is_special_annex_remote('datalad'))
+        assert_false(Dataset(p).repo.dirty)
+    # nothing to do a second time
+    assert_equal(provision_datasets(ds, paths), [])
@@ -0,0 +1,126 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test xnat-query-files helpers
+
+"""
+
+from pathlib import PurePosixPath
+
+from datalad.api import xnat_query_files
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_is_none,
+    assert_raises,
+)
+
+from ..query_files import (
+    _get_name_suffix,
+    _parse_file_uri,
+    get_content_id,
+    query_files,
+)
+
+
+class _Platform(object):
+    url = 'https://xnat.example.org'
+
+    def __init__(self, files):
+        # experiment ID -> list of (name, content) tuples
+        self.files = files
+
+    def get_experiments(self, project=None, subject=None):
+        return [dict(ID=e, subject_ID='S1', project='P1')
+                for e in self.files]
+
+    def get_files(self, experiment):
+        return [
+            dict(Name=name, Size=str(len(content)), digest=content * 32,
+                 URI=f'/data/experiments/{experiment}/scans/1/resources/'
+                     f'DICOM/files/{name}')
+            for name, content in self.files[experiment]
+        ]
+
+
+def test_parse_file_uri():
+    assert_equal(
+        _parse_file_uri(
+            '/data/experiments/CENTRAL_E03907/scans/2/resources/1234/files/'
+            'dcmtest1.MR.Sample_DICOM.2.1.20010108.120022.1azj8tu.dcm'),
+        dict(
+            experiment_id='CENTRAL_E03907',
+            scan_id='2',
+            resource_id='1234',
+            name='dcmtest1.MR.Sample_DICOM.2.1.20010108.120022.1azj8tu.dcm',
+        ))
+    # resources can have subdirectories
+    assert_equal(
+        _parse_file_uri(
+            '/data/experiments/E1/scans/BOLD_1/resources/MAT/files/sub/f.mat'
+        )['name'],
+        'sub/f.mat')
+    # anything else is rejected
+    for uri in (
+            '',
+            '/data/experiments/E1/scans/BOLD_1',
+            '/data/experiments/E1/resources/MAT/files/f.mat',
+            '/data/experiments/E1/scans/BOLD_1/resources/MAT/files/',
+            'data/experiments/E1/scans/BOLD_1/resources/MAT/files/f.mat',
+            '/data/experiments/E1/scans//resources/MAT/files/f.mat'):
+        assert_is_none(_parse_file_uri(uri))
+
+
+def test_get_name_suffix():
+    for name in ('dcmtest1.MR.Sample_DICOM.2.1.20010108.120022.1azj8tu.dcm',
+                 'file.nii.gz',
+                 'noext',
+                 '.hidden',
+                 'trailing.',
+                 'a..b',
+                 'sub/dir.d/file',
+                 'sub/file.txt'):
+        assert_equal(_get_name_suffix(name), PurePosixPath(name).suffix)
+
+
+def test_duplicates():
+    platform = _Platform(dict(
+        E1=[('a.dcm', 'a'), ('phantom.dcm', 'p')],
+        E2=[('b.dcm', 'b'), ('phantom.dcm', 'p'), ('a.dcm', 'a')],
+        E3=[('phantom.dcm', 'p')],
+    ))
+    records = list(query_files(platform, project='P1'))
+    assert_equal(
+        [r.get('duplicate_of') for r in records],
+        [None, None, None, 'E1/1/phantom.dcm', 'E1/1/a.dcm',
+         'E1/1/phantom.dcm'])
+    assert_equal(get_content_id(records[0]), ('a' * 32, 1))
+    assert_is_none(get_content_id(dict(records[0], **{'byte-size': ''})))
+    # not tracked on request
+    records = list(query_files(platform, project='P1', duplicates=False))
+    assert_equal([r.get('duplicate_of') for r in records], [None] * 6)
+
+
+def test_unexpected_uri():
+    platform = _Platform(dict(E1=[('a.dcm', 'a'), ('b.dcm', 'b')]))
+    get_files = platform.get_files
+    # an experiment-level resource, not a scan file
+    platform.get_files = lambda e: [
+        dict(f, URI=f['URI'].replace('/scans/1', ''))
+        if f['Name'] == 'a.dcm' else f
+        for f in get_files(e)
+    ]
+    records = list(query_files(platform, project='P1'))
+    # skipped, without failing the query
+    assert_equal([(r['status'], r['path']) for r in records],
+                 [('ok', 'E1/1/b.dcm')])
+
+
+def test_output_file_without_format():
+    # fails before contacting the server
+    assert_raises(ValueError, xnat_query_files, 'https://xnat.example.org',
+                  project='P1', output_file='files.csv')
@@ -13,3 +13,17 @@
 def test_register():
     import datalad.api as da
     assert hasattr(da, 'xnat_init')
+
+
+def test_lazy_version():
+    import subprocess
+    import sys
+    out = subprocess.run(
+        [sys.executable, '-c',
+         'import sys, datalad_xnat; '
+         'print("datalad_xnat._version" in sys.modules)'],
+        capture_output=True, text=True, check=True).stdout
+    # determining the version is left until it is needed
+    assert out.strip() == 'False'
+    import datalad_xnat
+    assert isinstance(datalad_xnat.__version__, str)
@@ -0,0 +1,55 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test size-aware download scheduling
+
+"""
+
+from concurrent.futures import Future
+
+from datalad.tests.utils_pytest import assert_equal
+
+from ..schedule import DownloadScheduler
+
+
+class _RecordingPool(object):
+    """Executor that only records submissions"""
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args, **kwargs):
+        fut = Future()
+        self.submitted.append((fut, args))
+        return fut
+
+
+def _download(size, progress):
+    progress(size)
+
+
+def test_scheduler():
+    pool = _RecordingPool()
+    sched = DownloadScheduler(pool, 4)
+    for size in (5, 100, 1, 50, 3, 1000, 2):
+        sched.add(size, _download, (size,), item=size)
+    assert_equal(sched.total_bytes, 1161)
+    # nothing runs before dispatch
+    assert_equal(pool.submitted, [])
+    sched.dispatch()
+    # two largest, and two smallest files first
+    assert_equal([a[0] for _, a in pool.submitted], [1000, 100, 1, 2])
+    assert_equal(len(sched), 7)
+    # a finished large file is replaced by the largest remaining one
+    fut = [f for f, a in pool.submitted if a[0] == 1000][0]
+    assert_equal(sched.pop(fut), 1000)
+    assert_equal(pool.submitted[-1][1][0], 50)
+    # a finished small one by the smallest remaining one
+    fut = [f for f, a in pool.submitted if a[0] == 1][0]
+    assert_equal(sched.pop(fut), 1)
+    assert_equal(pool.submitted[-1][1][0], 3)
+    assert_equal(len(sched), 5)
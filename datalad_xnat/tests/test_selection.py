@@ -0,0 +1,117 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test the validation of xnat-init selections
+
+"""
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_in,
+    assert_raises,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from ..selection import (
+    load_listings,
+    save_listings,
+    validate_selection,
+)
+
+
+class _Platform(object):
+    def __init__(self):
+        self.requests = []
+
+    def set_max_connections(self, n):
+        pass
+
+    def get_project_ids(self):
+        self.requests.append('projects')
+        return ['p1', 'p2']
+
+    def get_subject_ids(self, project):
+        self.requests.append(('subjects', project))
+        return ['s0', 's1', 's2'] if project == 'p1' else []
+
+    def get_experiment(self, experiment):
+        self.requests.append(('experiment', experiment))
+        return dict(ID=experiment) if experiment.startswith('e') else None
+
+    def get_experiments(self, project=None, subject=None):
+        self.requests.append(('experiments', project, subject))
+        if project != 'p1':
+            return []
+        return [dict(ID=f'e{i}', subject_ID=f's{i % 2}') for i in range(4)]
+
+    def get_files(self, experiment):
+        self.requests.append(('files', experiment))
+        return [dict(collection='DICOM', Size='100'),
+                dict(collection='NIFTI', Size='20')]
+
+
+def test_validate_selection():
+    platform = _Platform()
+    assert_equal(
+        validate_selection(platform, 'p1'),
+        dict(experiments=4, files=8, bytes=480))
+    # a single listing, besides the files
+    assert_equal(
+        [r for r in platform.requests if r[0] != 'files'],
+        [('experiments', 'p1', None)])
+
+    platform.requests.clear()
+    assert_equal(
+        validate_selection(platform, 'p1', 's1', collection=['NIFTI']),
+        dict(experiments=2, files=2, bytes=40))
+    assert_equal(
+        sorted(platform.requests),
+        [('experiments', 'p1', None), ('files', 'e1'), ('files', 'e3')])
+    # a subject without experiments is no error
+    assert_equal(
+        validate_selection(platform, 'p1', 's2'),
+        dict(experiments=0, files=0, bytes=0))
+    assert_equal(
+        validate_selection(platform, 'p1', experiment='e2'),
+        dict(experiments=1, files=2, bytes=120))
+    assert_equal(
+        validate_selection(platform, experiment='e2'),
+        dict(experiments=1, files=2, bytes=120))
+    # nothing to validate
+    assert_equal(validate_selection(platform), None)
+
+    for kwargs, msg in (
+            (dict(project='p3'), 'project p3'),
+            (dict(project='p1', subject='s9'), 'subject s9'),
+            (dict(project='p1', experiment='x1'), 'experiment x1'),
+            (dict(experiment='x1'), 'experiment x1'),
+            (dict(project='p1', collection=['DICOM', 'BIDS']),
+             'collection BIDS')):
+        with assert_raises(ValueError) as cm:
+            validate_selection(platform, **kwargs)
+        assert_in(msg, str(cm.value))
+
+
+@with_tempfile
+def test_listings(path=None):
+    path = Path(path) / 'listings.json'
+    listings = {'http://xnat.example.org/data/projects?format=json': []}
+    url = 'http://xnat.example.org'
+    assert_equal(load_listings(path, url), {})
+
+    save_listings(path, url, listings)
+    assert_equal(load_listings(path, url, consume=False), listings)
+    assert_equal(load_listings(path, 'http://other.example.org',
+                               consume=False), {})
+    assert_equal(load_listings(path, url, max_age=-1, consume=False), {})
+    # used only once
+    assert_equal(load_listings(path, url), listings)
+    assert_false(path.exists())
+    assert_equal(load_listings(path, url), {})
@@ -0,0 +1,91 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test partitioning of sharded updates
+
+"""
+
+from datalad.api import (
+    Dataset,
+    clone,
+)
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_in,
+    assert_not_in,
+    assert_raises,
+    assert_status,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from ..shard import (
+    merge_shards,
+    parse_shard_spec,
+    select_shard,
+)
+
+
+def test_parse_shard_spec():
+    assert_equal(parse_shard_spec('1/4'), (1, 4))
+    assert_equal(parse_shard_spec('4/4'), (4, 4))
+    for spec in ('0/4', '5/4', '1', '1/2/3', 'a/b', None):
+        assert_raises(ValueError, parse_shard_spec, spec)
+
+
+def test_select_shard():
+    units = [f'S{i:02d}' for i in range(10)]
+    shards = [select_shard(units, i, 3) for i in (1, 2, 3)]
+    # a complete, disjoint partition
+    assert_equal(sorted(sum(shards, [])), units)
+    assert_equal([len(s) for s in shards], [4, 3, 3])
+    # order of units is kept, but does not matter for the partition
+    assert_equal(shards[0], sorted(shards[0]))
+    assert_equal(select_shard(units[::-1], 1, 3), shards[0][::-1])
+
+    # balanced by weight
+    weights = dict(S00=10, S01=6, S02=5)
+    shards = [select_shard(units, i, 2, weights) for i in (1, 2)]
+    assert_equal(shards[0], ['S00', 'S03', 'S04', 'S06', 'S08'])
+    assert_equal([sum(weights.get(u, 1) for u in s) for s in shards],
+                 [14, 14])
+
+
+@with_tempfile(mkdir=True)
+def test_merge_shards(path=None):
+    path = Path(path)
+    ds = Dataset(path / 'ds').create()
+    shards = [
+        clone(source=ds.path, path=str(path / f'shard{i}'),
+              result_renderer='disabled')
+        for i in (1, 2)
+    ]
+    # a file and a subdataset in one shard
+    (shards[0].pathobj / 'file.txt').write_text('shard1')
+    shards[0].create('sub1', result_renderer='disabled')
+    shards[0].save(result_renderer='disabled')
+    # another subdataset in the other shard, which is on another branch
+    shards[1].repo.call_git(['checkout', '-b', 'shard2'])
+    sub2 = shards[1].create('sub2', result_renderer='disabled')
+    (sub2.pathobj / 'file.txt').write_text('shard2')
+    shards[1].save(recursive=True, result_renderer='disabled')
+
+    res = list(merge_shards(ds, [s.path for s in shards]))
+    assert_status(('ok', 'notneeded'), res)
+    assert_equal((ds.pathobj / 'file.txt').read_text(), 'shard1')
+    assert_equal((ds.pathobj / 'sub2' / 'file.txt').read_text(), 'shard2')
+    # the .gitmodules of both shards are combined
+    assert_equal(
+        sorted(Path(r['path']).name for r in ds.subdatasets(
+            result_renderer='disabled')),
+        ['sub1', 'sub2'])
+    assert_in('sub1', (ds.pathobj / '.gitmodules').read_text())
+    assert_in('sub2', (ds.pathobj / '.gitmodules').read_text())
+    # shard remotes are removed again
+    for remote in ('xnat-shard-1', 'xnat-shard-2'):
+        assert_not_in(remote, ds.repo.get_remotes())
@@ -0,0 +1,118 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Test tracing of commands
+
+"""
+
+import json
+import threading
+from pathlib import Path
+from unittest.mock import patch
+
+from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_in,
+    assert_raises,
+    with_tempfile,
+)
+from requests import Response
+
+from ..platform import _XNAT
+from ..tracing import (
+    Tracer,
+    _active_tracers,
+    span,
+)
+
+
+@with_tempfile
+def test_tracer(path=None):
+    # no-op without a tracer
+    with span('nothing', subject='s1') as s:
+        s.set_attribute('files', 1)
+
+    tracer = Tracer('xnat-update', dict(dataset='/ds'))
+    _active_tracers.append(tracer)
+    try:
+        with span('register', subject='s1') as s:
+            with span('addurls') as inner:
+                inner.set_attribute('files', 3)
+        with assert_raises(ValueError):
+            with span('failing'):
+                raise ValueError('bad')
+
+        def listing():
+            with span('listing'):
+                pass
+        thread = threading.Thread(target=listing)
+        thread.start()
+        thread.join()
+    finally:
+        _active_tracers.remove(tracer)
+    tracer.root.finish()
+    tracer.write(path)
+
+    lines = Path(path).read_text().splitlines()
+    assert_equal(len(lines), 1)
+    spans = json.loads(lines[0])['resourceSpans'][0]['scopeSpans'][0]['spans']
+    spans = {s['name']: s for s in spans}
+    root = spans['xnat-update']
+    assert_equal(
+        {s['traceId'] for s in spans.values()}, {root['traceId']})
+    assert_equal(spans['register']['parentSpanId'], root['spanId'])
+    assert_equal(spans['addurls']['parentSpanId'],
+                 spans['register']['spanId'])
+    # a thread without an open span starts from the root
+    assert_equal(spans['listing']['parentSpanId'], root['spanId'])
+    assert_in(dict(key='files', value=dict(intValue='3')),
+              spans['addurls']['attributes'])
+    assert_in(dict(key='subject', value=dict(stringValue='s1')),
+              spans['register']['attributes'])
+    assert_equal(spans['failing']['status'], dict(code=2, message='bad'))
+    assert_equal(spans['register']['status'], dict(code=1))
+
+
+def test_max_spans():
+    tracer = Tracer('xnat-update', max_spans=3)
+    _active_tracers.append(tracer)
+    try:
+        with span('register'):
+            for i in range(5):
+                with span('download', bytes=i):
+                    pass
+    finally:
+        _active_tracers.remove(tracer)
+    spans = tracer.to_otlp()['resourceSpans'][0]['scopeSpans'][0]['spans']
+    assert_equal([s['name'] for s in spans],
+                 ['xnat-update', 'register', 'download'])
+    # the others are aggregated
+    attributes = {a['key']: a['value'] for a in spans[0]['attributes']}
+    assert_equal(attributes['spans_dropped.download'], dict(intValue='4'))
+    assert_in('doubleValue', attributes['spans_dropped.download.seconds'])
+
+
+def test_auth_span():
+    def get(url, **kwargs):
+        response = Response()
+        response.status_code = 200
+        response._content = b'{"ResultSet": {"Result": []}}'
+        return response
+
+    tracer = Tracer('xnat-query-files')
+    _active_tracers.append(tracer)
+    try:
+        with patch('requests.Session.get', side_effect=get):
+            xnat = _XNAT('http://xnat.example.org', 'anonymous',
+                         lazy_auth=True)
+            xnat.get_projects()
+            xnat.get_projects()
+    finally:
+        _active_tracers.remove(tracer)
+    # only the first request authenticates
+    assert_equal([s.name for s in tracer.spans], ['xnat-query-files', 'auth'])
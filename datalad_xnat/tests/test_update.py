@@ -10,17 +10,48 @@
 
 """
 
+import hashlib
+import json
+import time
+from unittest.mock import patch
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
 from datalad.api import (
     Dataset,
     xnat_update,
 )
 
 from datalad.tests.utils_pytest import (
+    assert_equal,
+    assert_false,
+    assert_in,
     assert_in_results,
+    assert_not_in_results,
+    assert_raises,
+    assert_repo_status,
+    assert_true,
     with_tempfile,
 )
+from datalad.utils import Path
+from requests import (
+    ConnectionError,
+    Response,
+)
 
 from datalad_xnat.init import _cfg_dataset
+from datalad_xnat.journal import (
+    UpdateJournal,
+    get_state_path,
+)
+from datalad_xnat.platform import _XNAT
+from datalad_xnat.provision import provision_datasets
+from datalad_xnat.update import (
+    _Source,
+    _list_unit,
+    _register_files,
+    _resolve_units,
+)
 
 
 def fake_init(path=None):
@@ -51,3 +82,432 @@ def test_invalid(path=None):
         ds.xnat_update(on_failure='ignore'),
         status='impossible',
         action='update')
+
+
+class _Platform(object):
+    def get_subject_ids(self, project):
+        return [f'{project}s{i}' for i in range(3 if project == 'p1' else 1)]
+
+    def get_experiments(self, project=None):
+        return [dict(ID=f'{s}e', subject_ID=s)
+                for s in self.get_subject_ids(project)]
+
+
+def test_resolve_units():
+    platform = _Platform()
+    assert_equal(
+        _resolve_units(platform, ['p1'], [], None),
+        ('subject', ['p1s0', 'p1s1', 'p1s2']))
+    # qualified by project, alternating between projects
+    assert_equal(
+        _resolve_units(platform, ['p1', 'p2'], [], None),
+        ('subject', ['p1/p1s0', 'p2/p2s0', 'p1/p1s1', 'p1/p1s2']))
+    assert_equal(
+        _resolve_units(platform, ['p1', 'p2'], ['s1'], None),
+        ('subject', ['p1/s1', 'p2/s1']))
+    assert_equal(
+        _resolve_units(platform, ['p1', 'p2'], [], 'e1'),
+        ('subject', [None]))
+    # shards across projects
+    shards = [
+        _resolve_units(platform, ['p1', 'p2'], [], None, (i, 2))[1]
+        for i in (1, 2)
+    ]
+    assert_equal(
+        sorted(shards[0] + shards[1]),
+        ['p1/p1s0', 'p1/p1s1', 'p1/p1s2', 'p2/p2s0'])
+    assert_equal(len(shards[0]), 2)
+
+
+@with_tempfile
+def test_sources(path=None):
+    ds = fake_init(path)
+    ds.config.set('datalad.xnat.mirror.url', 'https://mirror.example.com',
+                  where='local')
+    ds.config.set('datalad.xnat.mirror.project', 'p1 p2', where='local')
+    ds.config.set('datalad.xnat.mirror.jobs', '2', where='local')
+    ds.config.set('datalad.xnat.mirror.max-request-rate', '5', where='local')
+    src = _Source(ds, 'default')
+    assert_equal(src.url, 'https://example.com')
+    assert_equal(src.projects, ['dummy_project'])
+    assert_equal(src.subjects, ['dummy_subject'])
+    assert_equal(src.collections, ['dummy_collection'])
+    assert_equal(src.jobs, None)
+    assert_equal(src.max_request_rate, None)
+    src = _Source(ds, 'mirror', subject='s1')
+    assert_equal(src.projects, ['p1', 'p2'])
+    assert_equal(src.subjects, ['s1'])
+    assert_equal(src.collections, None)
+    assert_equal(src.jobs, '2')
+    assert_equal(src.max_request_rate, 5.0)
+
+
+def _response(url, content, status=200):
+    response = Response()
+    response.status_code = status
+    response._content = content
+    # also for iter_content() of streaming requests
+    response._content_consumed = True
+    response.url = url
+    return response
+
+
+class _Server(object):
+    """A fake XNAT server of a project 'P1', with files in a local directory
+
+    `get()` replaces `requests.Session.get`. Files are served from `file://`
+    URLs, which git-annex can download from too.
+
+    Parameters
+    ----------
+    files: list
+      (subject, experiment, name, content, props) tuples. `props` override
+      properties of the file record, e.g. the 'digest'.
+    """
+    def __init__(self, path, files):
+        path = Path(path)
+        self.url = path.as_uri()
+        # URLs of all requests
+        self.requests = []
+        # URL -> seconds to wait before responding
+        self.delays = {}
+        # URL -> exception to raise instead of responding
+        self.errors = {}
+        self.listings = {}
+        subjects = {}
+        for subject, experiment, name, content, props in files:
+            uri = (f'/data/experiments/{experiment}/scans/1/resources/DICOM/'
+                   f'files/{name}')
+            (path / uri[1:]).parent.mkdir(parents=True, exist_ok=True)
+            (path / uri[1:]).write_bytes(content)
+            subjects.setdefault(subject, {}).setdefault(experiment, []).append(
+                dict(dict(Name=name,
+                          Size=str(len(content)),
+                          digest=hashlib.md5(content).hexdigest(),
+                          URI=uri,
+                          collection='DICOM'),
+                     **props))
+        self.listings[f'{self.url}/data/projects/P1/subjects?format=json'] = \
+            [dict(ID=s) for s in subjects]
+        for subject, experiments in subjects.items():
+            self.listings[
+                f'{self.url}/data/experiments?format=json&project=P1'
+                f'&subject_ID={subject}'] = [
+                    dict(ID=e, subject_ID=subject, project='P1', label=e)
+                    for e in experiments]
+            for experiment, files in experiments.items():
+                self.listings[
+                    f'{self.url}/data/experiments/{experiment}/scans/ALL/'
+                    f'files?format=json'] = files
+
+    def get(self, url, **kwargs):
+        self.requests.append(url)
+        time.sleep(self.delays.get(url, 0))
+        if url in self.errors:
+            raise self.errors[url]
+        if url in self.listings:
+            return _response(url, json.dumps(
+                dict(ResultSet=dict(Result=self.listings[url]))).encode())
+        path = Path(url2pathname(urlparse(url).path))
+        if path.is_file():
+            return _response(url, path.read_bytes())
+        return _response(url, b'', status=404)
+
+    def get_file_requests(self):
+        return [u for u in self.requests if '/files/' in u]
+
+    def delay_subject(self, subject, seconds=1):
+        """Respond late to the listing of the experiments of a subject"""
+        self.delays[f'{self.url}/data/experiments?format=json&project=P1'
+                    f'&subject_ID={subject}'] = seconds
+
+
+def _init_offline(path, files, pathfmt='{subject}/{session}/{scan}/'):
+    """Create a dataset that tracks all subjects of a fake XNAT server"""
+    path = Path(path)
+    server = _Server(path / 'server', files)
+    ds = Dataset(path / 'ds').create()
+    # git-annex downloads files without an MD5 digest from file:// URLs
+    ds.config.set('annex.security.allowed-url-schemes', 'http https ftp file',
+                  where='local')
+    _cfg_dataset(ds, server.url, 'P1', None, None, None, pathfmt,
+                 'anonymous')
+    return ds, server
+
+
+@with_tempfile(mkdir=True)
+def test_register_files(path=None):
+    ds, server = _init_offline(path, [
+        ('S1', 'E1', 'a.dcm', b'known', {}),
+        ('S1', 'E1', 'b.dcm', b'unknown', dict(digest='')),
+    ])
+    with patch('requests.Session.get', side_effect=server.get):
+        platform = _XNAT(server.url, 'anonymous', lazy_auth=True)
+        table, records = _list_unit(platform, project='P1', subject='S1')
+    assert_equal([r['path'] for r in records], ['E1/1/a.dcm', 'E1/1/b.dcm'])
+    missing = _register_files(ds, table, '{subject}/{session}/{scan}/',
+                              records, ifexists=None, reckless=None, jobs=1)
+    # a file with a known size and MD5 digest is registered by its key,
+    # without a download
+    assert_equal([(repo.path, path) for repo, path, _ in missing],
+                 [(ds.path, 'S1/E1/1/a.dcm')])
+    assert_false(ds.repo.file_has_content('S1/E1/1/a.dcm'))
+    # any other file is downloaded by addurls
+    assert_equal((ds.pathobj / 'S1' / 'E1' / '1' / 'b.dcm').read_bytes(),
+                 b'unknown')
+    assert_equal(server.get_file_requests(), [])
+    assert_false(table.exists())
+
+
+@with_tempfile(mkdir=True)
+def test_update_offline(path=None):
+    ds, server = _init_offline(path, [
+        ('S1', 'E1', 'a.dcm', b'known', {}),
+        ('S1', 'E1', 'b.dcm', b'unknown', dict(digest='')),
+        # same content as a.dcm
+        ('S2', 'E2', 'c.dcm', b'known', {}),
+    ])
+    # the setting of the dataset is used, wherever the command runs
+    metrics_dir = Path(path) / 'metrics'
+    ds.config.set('datalad.xnat.metrics-textfile-dir', str(metrics_dir),
+                  where='local')
+    with patch('requests.Session.get', side_effect=server.get):
+        # a single listing at a time, S1 is registered first
+        res = ds.xnat_update(jobs=1, result_renderer='disabled')
+    assert_in_results(res, action='xnat_update', status='ok')
+    assert_in_results(res, action='xnat_download', status='ok',
+                      path=str(ds.pathobj / 'S1' / 'E1' / '1' / 'a.dcm'))
+    for path, content in (('S1/E1/1/a.dcm', b'known'),
+                          ('S1/E1/1/b.dcm', b'unknown'),
+                          ('S2/E2/1/c.dcm', b'known')):
+        assert_equal((ds.pathobj / path).read_bytes(), content)
+    # shared content is downloaded once, and b.dcm by addurls
+    assert_equal(
+        server.get_file_requests(),
+        [f'{server.url}/data/experiments/E1/scans/1/resources/DICOM/files/'
+         f'a.dcm'])
+    assert_repo_status(ds.path)
+    metrics = {
+        line.partition('{')[0]: line.rpartition(' ')[2]
+        for line in next(metrics_dir.iterdir()).read_text().splitlines()
+        if not line.startswith('#')
+    }
+    assert_equal(metrics['datalad_xnat_files_added_total'], '3')
+    assert_equal(metrics['datalad_xnat_files_listed_total'], '3')
+    assert_equal(metrics['datalad_xnat_downloaded_bytes_total'], '5')
+
+
+@with_tempfile(mkdir=True)
+def test_update_inject_failure(path=None):
+    ds, server = _init_offline(path, [
+        # the reported size does not match the content
+        ('S1', 'E1', 'a.dcm', b'known', dict(Size='6')),
+        ('S1', 'E1', 'b.dcm', b'other', {}),
+        ('S2', 'E2', 'c.dcm', b'known', dict(Size='6')),
+    ])
+    # S2 is registered after the download of a.dcm is done
+    server.delay_subject('S2')
+    with patch('requests.Session.get', side_effect=server.get):
+        res = ds.xnat_update(jobs=1, on_failure='ignore',
+                             result_renderer='disabled')
+    # the download matches the digest, but git-annex rejects it
+    for path in ('S1/E1/1/a.dcm', 'S2/E2/1/c.dcm'):
+        assert_in_results(res, action='xnat_download', status='error',
+                          path=str(ds.pathobj / path))
+        assert_false(ds.repo.file_has_content(path))
+    assert_in_results(res, action='xnat_download', status='ok',
+                      path=str(ds.pathobj / 'S1' / 'E1' / '1' / 'b.dcm'))
+    assert_not_in_results(res, action='xnat_update', status='ok')
+    # rejected content is not taken for another file, but downloaded again
+    assert_equal(
+        [u.rpartition('/')[2] for u in server.get_file_requests()],
+        ['a.dcm', 'b.dcm', 'c.dcm'])
+
+
+@with_tempfile(mkdir=True)
+def test_update_connection_error(path=None):
+    ds, server = _init_offline(path, [
+        ('S1', 'E1', 'a.dcm', b'first', {}),
+        ('S1', 'E1', 'b.dcm', b'second', {}),
+        ('S2', 'E2', 'c.dcm', b'third', {}),
+        ('S3', 'E3', 'd.dcm', b'fourth', {}),
+    ])
+    server.errors[
+        f'{server.url}/data/experiments/E1/scans/1/resources/DICOM/files/'
+        f'b.dcm'] = ConnectionError('connection reset')
+    server.errors[
+        f'{server.url}/data/experiments?format=json&project=P1'
+        f'&subject_ID=S3'] = ConnectionError('connection refused')
+    with patch('requests.Session.get', side_effect=server.get):
+        res = ds.xnat_update(on_failure='ignore', result_renderer='disabled')
+    # only the download of the file, and the listing of S3 fail, not the
+    # update
+    assert_in_results(res, action='xnat_download', status='error',
+                      path=str(ds.pathobj / 'S1' / 'E1' / '1' / 'b.dcm'))
+    assert_in_results(res, action='xnat_update', status='error')
+    assert_not_in_results(res, action='xnat_update', status='ok')
+    for path, content in (('S1/E1/1/a.dcm', b'first'),
+                          ('S2/E2/1/c.dcm', b'third')):
+        assert_in_results(res, action='xnat_download', status='ok',
+                          path=str(ds.pathobj / path))
+        assert_equal((ds.pathobj / path).read_bytes(), content)
+    assert_false(ds.repo.file_has_content('S1/E1/1/b.dcm'))
+
+
+@with_tempfile(mkdir=True)
+def test_update_resume(path=None):
+    ds, server = _init_offline(path, [
+        ('S1', 'E1', 'a.dcm', b'first', {}),
+        ('S2', 'E2', 'c.dcm', b'second', {}),
+    ])
+    journal_path = get_state_path(ds, 'default') / 'update-journal.jsonl'
+    s2_listing = (f'{server.url}/data/experiments?format=json&project=P1'
+                  f'&subject_ID=S2')
+    # the update is interrupted after S1 is done
+    server.delay_subject('S2')
+    server.errors[s2_listing] = RuntimeError('interrupted')
+    with patch('requests.Session.get', side_effect=server.get), \
+            assert_raises(RuntimeError):
+        ds.xnat_update(jobs=1, result_renderer='disabled')
+    assert_equal(list(UpdateJournal(journal_path).finished), ['S1'])
+    assert_repo_status(ds.path)
+
+    del server.errors[s2_listing]
+    server.requests.clear()
+    with patch('requests.Session.get', side_effect=server.get):
+        res = ds.xnat_update(resume=True, jobs=1, result_renderer='disabled')
+    assert_in_results(res, action='xnat_update', status='ok')
+    # neither the subjects, nor the finished S1 are listed again
+    assert_equal(
+        server.requests,
+        [s2_listing,
+         f'{server.url}/data/experiments/E2/scans/ALL/files?format=json',
+         f'{server.url}/data/experiments/E2/scans/1/resources/DICOM/files/'
+         f'c.dcm'])
+    for path, content in (('S1/E1/1/a.dcm', b'first'),
+                          ('S2/E2/1/c.dcm', b'second')):
+        assert_equal((ds.pathobj / path).read_bytes(), content)
+    # the journal of the completed run is closed, nothing to resume
+    journal = UpdateJournal(journal_path)
+    assert_true(journal.completed)
+    assert_false(journal.is_resumable(journal.params))
+    assert_repo_status(ds.path)
+
+
+@with_tempfile(mkdir=True)
+def test_update_subdatasets(path=None):
+    ds, server = _init_offline(path, [
+        ('S1', 'E1', 'a.dcm', b'known', {}),
+        ('S2', 'E2', 'c.dcm', b'known', {}),
+    ], pathfmt='{subject}//{session}/{scan}/')
+    # c.dcm is registered after a.dcm has its content
+    server.delay_subject('S2')
+    with patch('requests.Session.get', side_effect=server.get), \
+            patch('datalad_xnat.provision.provision_datasets',
+                  wraps=provision_datasets) as provision:
+        res = ds.xnat_update(jobs=1, result_renderer='disabled')
+    # subject datasets are all created upfront, not again per subject
+    assert_equal(provision.call_count, 1)
+    assert_in_results(res, action='xnat_update', status='ok')
+    for path in ('S1/E1/1/a.dcm', 'S2/E2/1/c.dcm'):
+        assert_in_results(res, action='xnat_download', status='ok',
+                          path=str(ds.pathobj / path))
+        assert_equal((ds.pathobj / path).read_bytes(), b'known')
+    # the content is copied from the other subdataset
+    assert_equal(len(server.get_file_requests()), 1)
+    # with the new state of the subdatasets
+    assert_repo_status(ds.path)
+
+
+@with_tempfile(mkdir=True)
+def test_update_dry_run(path=None):
+    ds, server = _init_offline(path, [
+        ('S1', 'E1', 'a.dcm', b'known', {}),
+        ('S1', 'E1', 'b.dcm', b'old', {}),
+    ])
+    with patch('requests.Session.get', side_effect=server.get):
+        ds.xnat_update(jobs=1, result_renderer='disabled')
+    # the server now has a changed, and a new file
+    server = _Server(Path(path) / 'server', [
+        ('S1', 'E1', 'a.dcm', b'known', {}),
+        ('S1', 'E1', 'b.dcm', b'new', {}),
+        ('S2', 'E2', 'c.dcm', b'other', {}),
+    ])
+    state = ds.pathobj / '.git' / 'datalad' / 'xnat'
+
+    def get_state():
+        return (
+            ds.repo.call_git(['status', '--porcelain', '--ignored']),
+            sorted((str(p), p.read_bytes() if p.is_file() else None)
+                   for p in state.rglob('*')),
+        )
+
+    before = get_state()
+    with patch('requests.Session.get', side_effect=server.get):
+        res = ds.xnat_update(dry_run=True, jobs=1,
+                             result_renderer='disabled')
+    assert_in_results(res, action='xnat_update', status='ok',
+                      new=1, changed=1, unchanged=1)
+    assert_in_results(res, action='xnat_plan', state='changed',
+                      path=str(ds.pathobj / 'S1' / 'E1' / '1' / 'b.dcm'))
+    assert_in_results(res, action='xnat_plan', state='new',
+                      path=str(ds.pathobj / 'S2' / 'E2' / '1' / 'c.dcm'))
+    # only listed, nothing downloaded or recorded
+    assert_equal(server.get_file_requests(), [])
+    for e in ('E1', 'E2'):
+        assert_in(
+            f'{server.url}/data/experiments/{e}/scans/ALL/files?format=json',
+            server.requests)
+    assert_equal(get_state(), before)
+    assert_repo_status(ds.path)
+
+
+@with_tempfile(mkdir=True)
+def test_update_names(path=None):
+    ds, server = _init_offline(path, [
+        ('S1', 'E1', 'a.dcm', b'shared', {}),
+    ])
+    other = _Server(Path(path) / 'other', [
+        ('S9', 'E9', 'z.dcm', b'shared', {}),
+    ])
+    for k, v in (('url', other.url),
+                 ('project', 'P1'),
+                 ('pathfmt', 'other/{subject}/{session}/{scan}/'),
+                 ('credential-name', 'anonymous')):
+        ds.config.set(f'datalad.xnat.other.{k}', v, where='local')
+
+    def get(url, **kwargs):
+        return (other if url.startswith(other.url) else server).get(
+            url, **kwargs)
+
+    with patch('requests.Session.get', side_effect=get):
+        res = ds.xnat_update(name=['default', 'other'],
+                             result_renderer='disabled')
+    assert_in_results(res, action='xnat_update', status='ok')
+    for path in ('S1/E1/1/a.dcm', 'other/S9/E9/1/z.dcm'):
+        assert_equal((ds.pathobj / path).read_bytes(), b'shared')
+    # the shared content is fetched from one of the servers only
+    assert_equal(
+        len(server.get_file_requests() + other.get_file_requests()), 1)
+    assert_repo_status(ds.path)
+
+
+@with_tempfile(mkdir=True)
+def test_update_reckless(path=None):
+    ds, server = _init_offline(path, [
+        ('S1', 'E1', 'a.dcm', b'known', {}),
+        ('S1', 'E1', 'b.dcm', b'unknown', dict(digest='')),
+    ])
+    with patch('requests.Session.get', side_effect=server.get):
+        res = ds.xnat_update(reckless='fast', result_renderer='disabled')
+    assert_in_results(res, action='xnat_update', status='ok')
+    assert_not_in_results(res, action='xnat_download')
+    # nothing is downloaded, URLs are registered for a later `datalad get`
+    assert_equal(server.get_file_requests(), [])
+    assert_equal(
+        ds.repo.file_has_content(['S1/E1/1/a.dcm', 'S1/E1/1/b.dcm']),
+        [False, False])
+    assert_in(
+        f'{server.url}/data/experiments/E1/scans/1/resources/DICOM/files/'
+        f'a.dcm',
+        ds.repo.get_urls('S1/E1/1/a.dcm'))
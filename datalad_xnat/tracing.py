@@ -0,0 +1,216 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Tracing of xnat-* commands
+
+With the configuration 'datalad.xnat.trace-file' set to a file, every
+xnat-* command records a trace of its run: a root span for the entire
+command, with child spans for its phases (see `span()`). When the command
+ends, the trace is appended to the file as a single line of OTLP JSON, the
+format of the file exporter of the OpenTelemetry collector. The
+'otlpjsonfile' receiver of the collector can import such files into any
+tracing backend.
+
+Spans started in a thread without an open span are children of the root
+span, e.g. those of concurrent listings and downloads.
+
+A trace keeps at most 'datalad.xnat.trace-max-spans' spans (default:
+10000), e.g. of the first downloads of a large update. Later spans are
+only aggregated by name, into the 'spans_dropped.<name>' (number) and
+'spans_dropped.<name>.seconds' (total duration) attributes of the root
+span.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+lgr = logging.getLogger('datalad.xnat.tracing')
+
+# OTLP span kind and status codes
+_span_kind_internal = 1
+_status_code_ok = 1
+_status_code_error = 2
+
+
+class Span(object):
+    """A timed operation, with attributes
+
+    Parameters
+    ----------
+    name: str
+    trace_id: str
+    parent_id: str or None
+    attributes: dict, optional
+    """
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self, error=None):
+        self.end = time.time_ns()
+        self.error = error
+
+    def to_otlp(self):
+        """Return the span as an OTLP JSON object"""
+        span = dict(
+            traceId=self.trace_id,
+            spanId=self.span_id,
+            name=self.name,
+            kind=_span_kind_internal,
+            startTimeUnixNano=str(self.start),
+            endTimeUnixNano=str(self.end or time.time_ns()),
+            attributes=_get_otlp_attributes(self.attributes),
+            status=dict(code=_status_code_ok) if self.error is None
+            else dict(code=_status_code_error, message=self.error),
+        )
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class _NoSpan(object):
+    """Stand-in for a span, when nothing is traced"""
+    def set_attribute(self, key, value):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+class Tracer(object):
+    """Record the spans of a single trace
+
+    Parameters
+    ----------
+    name: str
+      Name of the root span, e.g. the command.
+    attributes: dict, optional
+      Attributes of the root span.
+    max_spans: int, optional
+      Number of spans to keep, including the root span. Further spans are
+      only counted.
+    """
+    def __init__(self, name, attributes=None, max_spans=10000):
+        self._lock = threading.Lock()
+        # per thread, the stack of its open spans
+        self._local = threading.local()
+        self.root = Span(name, os.urandom(16).hex(), attributes=attributes)
+        self.spans = [self.root]
+        self.max_spans = max_spans
+        # name -> [number, total nanoseconds] of spans that were not kept
+        self.dropped = {}
+
+    def _get_stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name, attributes=None):
+        stack = self._get_stack()
+        s = Span(
+            name,
+            self.root.trace_id,
+            parent_id=(stack[-1] if stack else self.root).span_id,
+            attributes=attributes,
+        )
+        with self._lock:
+            keep = len(self.spans) < self.max_spans
+            if keep:
+                self.spans.append(s)
+        stack.append(s)
+        try:
+            yield s
+        except BaseException as e:
+            s.finish(error=str(e) or type(e).__name__)
+            raise
+        else:
+            s.finish()
+        finally:
+            stack.pop()
+            if not keep:
+                with self._lock:
+                    stats = self.dropped.setdefault(name, [0, 0])
+                    stats[0] += 1
+                    stats[1] += s.end - s.start
+
+    def to_otlp(self, service='datalad-xnat'):
+        """Return the trace as an OTLP JSON object"""
+        with self._lock:
+            for name, (n, ns) in self.dropped.items():
+                self.root.set_attribute(f'spans_dropped.{name}', n)
+                self.root.set_attribute(
+                    f'spans_dropped.{name}.seconds', ns / 1e9)
+            spans = [s.to_otlp() for s in self.spans]
+        return dict(resourceSpans=[dict(
+            resource=dict(attributes=_get_otlp_attributes(
+                {'service.name': service})),
+            scopeSpans=[dict(
+                scope=dict(name='datalad_xnat'),
+                spans=spans,
+            )],
+        )])
+
+    def write(self, path):
+        """Append the trace to a file, as a line of OTLP JSON"""
+        with open(path, 'a', encoding='utf-8') as fp:
+            fp.write(json.dumps(self.to_otlp()))
+            fp.write('\n')
+
+
+def _get_otlp_attributes(attributes):
+    otlp = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = dict(boolValue=value)
+        elif isinstance(value, int):
+            # int64 values are strings in OTLP JSON
+            value = dict(intValue=str(value))
+        elif isinstance(value, float):
+            value = dict(doubleValue=value)
+        else:
+            value = dict(stringValue=str(value))
+        otlp.append(dict(key=key, value=value))
+    return otlp
+
+
+# tracers of the commands that currently run
+_active_tracers = []
+
+
+@contextmanager
+def span(name, **attributes):
+    """Trace an operation of the running command, if it is traced
+
+    Yields
+    ------
+    Span
+      Further attributes can be set with its `set_attribute()`. If nothing
+      is traced, this is a stand-in that ignores them.
+    """
+    if not _active_tracers:
+        yield _no_span
+        return
+    with _active_tracers[-1].span(name, attributes) as s:
+        yield s
@@ -11,6 +11,14 @@
 
 import logging
 import os
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import ExitStack
+from itertools import zip_longest
 from pathlib import Path
 from tempfile import mkstemp
 
@@ -21,30 +29,47 @@ from datalad.interface.results import get_status_dict
 from datalad.support.constraints import (
     EnsureNone,
     EnsureChoice,
+    EnsureStr,
 )
 from datalad.support.param import Parameter
 from datalad.utils import (
+    bytes2human,
     ensure_list,
     quote_cmdlinearg,
 )
 
 from datalad.distribution.dataset import (
+    Dataset,
     datasetmethod,
     EnsureDataset,
     require_dataset,
 )
+from datalad.support.exceptions import CapturedException
 
 from datalad.interface.common_opts import (
     jobs_opt,
 )
 
-from .platform import _XNAT
+from .metrics import (
+    count,
+    phase,
+    with_command_metrics,
+)
+from .platform import (
+    _XNAT,
+    XNATRequestError,
+)
 
 
 __docformat__ = 'restructuredtext'
 
 lgr = logging.getLogger('datalad.xnat.update')
 
+# errors of listing a unit, or downloading a file, that fail only that
+# unit or file: any request error, also of a connection or transfer (all
+# exceptions of requests are OSErrors), and errors of writing the content
+_request_errors = (XNATRequestError, OSError)
+
 
 @build_doc
 class Update(Interface):
@@ -52,6 +77,58 @@ class Update(Interface):
 
     This command expects an xnat-init initialized DataLad dataset. The dataset
     may or may not have existing content already.
+
+    Several projects can be tracked, by configuring a whitespace-separated
+    list of project IDs in 'datalad.xnat.<name>.project'. A single update
+    covers all of them, with a single XNAT session. Their subjects are
+    processed alternately, and the number of concurrent listings and
+    downloads (see [CMD: --jobs CMD][PY: `jobs` PY]) applies to all projects
+    together.
+
+    Several XNAT servers, e.g. a site mirror and a central instance, can be
+    updated from in a single run, see [CMD: --name CMD][PY: `name` PY]. Each
+    server has its own session and thread pools, so that a slow server does
+    not hold up downloads from a fast one. Its concurrency budget can be set
+    with 'datalad.xnat.<name>.jobs' (default: the number of jobs), and its
+    request rate can be limited with 'datalad.xnat.<name>.max-request-rate'
+    (requests per second).
+
+    Files that are also available from another XNAT server, e.g. a site
+    mirror of a central instance, can be obtained from there. The names of
+    the XNAT configurations of such mirrors are set as a whitespace-separated
+    list in 'datalad.xnat.<name>.mirrors'. Files on a mirror are matched by
+    their project, experiment label, scan, collection, name, and MD5 digest,
+    and their mirror URLs are registered as further URLs of the files. Every
+    download is made from the server with the shortest expected transfer
+    time, based on the measured latency and throughput of the servers, and
+    falls back to the next server, if it fails.
+
+    Downloaded content can be shared with other datasets on the same host
+    via a cache that is enabled by configuring its size limit with
+    'datalad.xnat.cache-max-size' (e.g. '100G'). Its location can be set
+    with 'datalad.xnat.cache-dir'.
+
+    Progress of the entire update is shown as a progress bar. In addition,
+    a machine-readable status line with the numbers of processed subjects,
+    files, and bytes, the request and download rates, and an ETA is logged
+    every 'datalad.xnat.status-interval' seconds (default: 60, 0 disables
+    status lines).
+
+    For monitoring, metrics of the requests, results, and phases of an
+    update are written to a file in the Prometheus text format, if
+    'datalad.xnat.metrics-textfile-dir' is configured, e.g. to the
+    directory of the textfile collector of the Prometheus node exporter.
+    'datalad.xnat.metrics-format' can be set to 'openmetrics' for the
+    OpenMetrics text format.
+
+    With 'datalad.xnat.trace-file' set, a trace of the phases of an update
+    (configuration, authentication, subject resolution, listing, addurls,
+    downloads) is appended to this file as OTLP JSON, for import into an
+    OpenTelemetry collector.
+
+    The first update after xnat-init reuses the listings that were requested
+    to validate the selection, if they are younger than
+    'datalad.xnat.listing-max-age' seconds (default: 3600).
     """
 
     _params_ = dict(
@@ -79,6 +156,58 @@ class Update(Interface):
             args=("-f", "--force",),
             doc="""force (re-)building the addurl tables""",
             action='store_true'),
+        resume=Parameter(
+            args=("--resume",),
+            doc="""resume an interrupted update with the same parameters.
+            Subjects that were completely processed before are skipped
+            without querying the XNAT server again, and files of subjects
+            that were in progress are only downloaded if they are not yet
+            in the dataset. Progress is recorded in a journal in
+            `.git/datalad/xnat/<name>/`. If there is no interrupted update
+            on record, a regular update is performed.""",
+            action='store_true'),
+        shard=Parameter(
+            args=("--shard",),
+            metavar='I/N',
+            doc="""only process the I-th of N (1-based) disjoint shares of
+            the update, e.g. in one of N cluster jobs. Subjects are balanced
+            across shards by their number of experiments. Without a subject
+            constraint, experiments are distributed instead. Each shard must
+            run in its own clone of the dataset; the results can be combined
+            with [CMD: --merge-shard CMD][PY: `merge_shard` PY].""",
+            constraints=EnsureStr() | EnsureNone()),
+        merge_shard=Parameter(
+            args=("--merge-shard",),
+            metavar='PATH',
+            action='append',
+            doc="""merge the results of sharded updates from the given
+            dataset clones into the dataset, and obtain their subdatasets
+            and content. No XNAT server is queried.
+            [CMD: Can be given multiple times CMD][PY: Multiple clones can be
+            specified as a list PY]""",
+            constraints=EnsureStr() | EnsureNone()),
+        dry_run=Parameter(
+            args=("--dry-run",),
+            doc="""only report what an update would do. All files are
+            listed, and compared against the dataset content. New and
+            changed files are reported, together with the number of
+            requests and bytes the update would involve, and an estimate of
+            its duration, based on the download rate of previous updates.
+            The dataset is not modified.""",
+            action='store_true'),
+        name=Parameter(
+            args=("--name",),
+            metavar='NAME',
+            action='append',
+            doc="""name of the XNAT configuration to update from, i.e. of its
+            'datalad.xnat.<NAME>.*' settings. With several names, all their
+            XNAT servers are updated from at the same time, each with its own
+            session and concurrency budget. Any project, subject, experiment,
+            collection, or credential that is given applies to all of them.
+            [CMD: Can be given multiple times CMD][PY: Multiple names can be
+            specified as a list PY]. Default: the value of
+            'datalad.xnat.default-name', or 'default'.""",
+            constraints=EnsureStr() | EnsureNone()),
         jobs=jobs_opt,
         **_XNAT.cmd_params
     )
@@ -86,6 +215,7 @@ class Update(Interface):
     @staticmethod
     @datasetmethod(name='xnat_update')
     @eval_results
+    @with_command_metrics('xnat-update')
     def __call__(project=None,
                  subject=None,
                  experiment=None,
@@ -94,41 +224,78 @@ class Update(Interface):
                  force=False,
                  reckless=None,
                  ifexists=None,
+                 resume=False,
+                 shard=None,
+                 merge_shard=None,
+                 dry_run=False,
+                 name=None,
                  jobs='auto',
                  dataset=None):
-
+        # the machinery of an update is only imported when it runs, to keep
+        # the start-up of all commands fast
+        from datalad.support.parallel import ProducerConsumer
+        from .auth import configure_dataset_auth
+        from .cache import ContentCache
+        from .download import chunked_download_max_parts
+        from .journal import (
+            UpdateJournal,
+            get_download_rate,
+            get_state_path,
+            record_run_stats,
+        )
+        from .plan import (
+            get_unit_query,
+            plan_update,
+        )
+        from .mirror import (
+            Mirror,
+            ServerStats,
+        )
+        from .progress import UpdateProgress
+        from .provision import (
+            get_subject_dataset_paths,
+            provision_datasets,
+        )
+        from .schedule import DownloadScheduler
+        from .selection import (
+            listing_max_age,
+            load_listings,
+        )
+        from .shard import (
+            merge_shards,
+            parse_shard_spec,
+        )
 
         ds = require_dataset(
             dataset, check_installed=True, purpose='update')
 
-        xnat_cfg_name = ds.config.get('datalad.xnat.default-name', 'default')
-        cfg_section = 'datalad.xnat.{}'.format(xnat_cfg_name)
-
-        # TODO fail is there is no URL
-        xnat_url = ds.config.get(f'{cfg_section}.url')
-        # TODO fail without pathfmt
-        pathfmt = ds.config.get(f'{cfg_section}.pathfmt')
-
-        if project is None:
-            project = ds.config.get(f'{cfg_section}.project')
-        if subject is None:
-            subject = ds.config.get(f'{cfg_section}.subject')
-        if experiment is None:
-            experiment = ds.config.get(f'{cfg_section}.experiment')
-        if collection is None:
-            collection = ds.config.get(f'{cfg_section}.collection', '').split()
-
-        subjects = ensure_list(subject)
+        with phase('config'):
+            # every XNAT configuration to update from is a source
+            sources = [
+                _Source(
+                    ds, n,
+                    project=project,
+                    subject=subject,
+                    experiment=experiment,
+                    collection=collection,
+                    credential=credential,
+                )
+                for n in ensure_list(name) or [ds.config.get(
+                    'datalad.xnat.default-name', 'default')]
+            ]
 
         # require a clean dataset
-        if ds.repo.dirty:
+        if not dry_run and ds.repo.dirty:
             yield get_status_dict(
                 'update',
                 ds=ds,
                 status='impossible',
                 message=(
                     'Clean dataset required; use `datalad status` to inspect '
-                    'unsaved changes'))
+                    'unsaved changes{}'.format(
+                        '. Leftovers of an interrupted update can be saved '
+                        'with `datalad save -r`, before resuming it'
+                        if resume else '')))
             return
 
         # prep for yield
@@ -139,89 +306,831 @@ class Update(Interface):
             logger=lgr,
             refds=ds.path,
         )
-        # obtain configured XNAT url and project name
-        if not credential:
-            credential = ds.config.get(
-                '{}.credential-name'.format(cfg_section))
-
-        platform = _XNAT(xnat_url, credential=credential)
-
-        # parse and download one subject at a time
-        # we could also make one big query
-        if experiment is not None:
-            # no need to query
-            subjects = [None]
-        elif subjects:
-            # we can go with the subjects as-is
-            pass
-        elif project:
-            # we have a project constraint, we can resolve subjects
-            subjects = platform.get_subject_ids(project)
-        else:
-            # we have nothing to compartmentalize the query
-            # go with a single big one
-            subjects = [None]
-        from datalad_xnat.parser import parse_xnat
-        from unittest.mock import patch
-        for sub in subjects:
-            try:
-                # all this tempfile madness is only needed because windows
-                # cannot open the same file twice. shame!
-                addurls_table, addurls_table_fname = mkstemp()
-                addurls_table_fname = Path(addurls_table_fname)
-                os.close(addurls_table)
-                with open(
-                        addurls_table_fname,
-                        'w',
-                        newline='',
-                        encoding='utf-8') as addurls_table:
-                    yield from parse_xnat(
-                        addurls_table,
-                        platform,
-                        force=force,
-                        project=project,
-                        subject=sub,
-                        experiment=experiment,
-                        collections=ensure_list(collection)
-                        if collection else None,
-                    )
-
-                # add file urls for subject
-                lgr.info('Downloading files for subject %s', sub)
-                # corresponds to the header field 'filename' in the csv table
-                filename = '{filename}'
-                filenameformat = f"{pathfmt}{filename}"
-                # shoehorn essential info into the ENV to make it
-                # accessible to the config procedure
-                # TODO maybe alter the config procedure to pull this info
-                # from a superdataset, if it finds the dataset at hand
-                # unconfigured.
-                env_prefix = f'DATALAD_XNAT_{xnat_cfg_name.upper()}'
-                env = {
-                    'DATALAD_XNAT_DEFAULT__NAME': xnat_cfg_name,
-                    f'{env_prefix}_URL': platform.url,
-                }
-                if platform.credential_name != 'anonymous':
-                    env[f'{env_prefix}_CREDENTIAL__NAME'] = \
-                        platform.credential_name
-                with patch.dict('os.environ', env):
-                    ds.addurls(
-                        str(addurls_table_fname), '{url}', filenameformat,
-                        ifexists=ifexists,
-                        fast=True if reckless == 'fast'
-                        else False,
-                        save=True,
-                        jobs=jobs,
-                        cfg_proc=None
-                        if platform.credential_name == 'anonymous'
-                        else 'xnat_dataset',
-                        result_renderer='default')
-            finally:
-                if addurls_table_fname.exists():
-                    addurls_table_fname.unlink()
+        if merge_shard:
+            yield from merge_shards(
+                ds, merge_shard, get_data=reckless != 'fast')
+            yield dict(
+                res,
+                status='ok',
+                message=('Merged %i shards', len(ensure_list(merge_shard))),
+            )
+            return
+
+        # fail early on a bad specification
+        shard_spec = parse_shard_spec(shard) if shard else None
 
+        cache = ContentCache.from_config(ds.config)
+        njobs = ProducerConsumer.get_effective_jobs(jobs) or 1
+        # latency and throughput of all servers, to pick the fastest
+        # source of a download
+        server_stats = ServerStats()
+        for src in sources:
+            # each server has a budget of its own
+            src.jobs = int(src.jobs or njobs)
+            # authentication is part of the first request
+            src.platform = _XNAT(src.url, credential=src.credential,
+                                 lazy_auth=True)
+            src.platform.set_rate_limit(src.max_request_rate)
+            server_stats.watch(src.platform)
+            src.mirrors = []
+            for m in src.mirror_names:
+                msrc = _Source(ds, m)
+                mplatform = _XNAT(msrc.url, credential=msrc.credential,
+                                  lazy_auth=True)
+                mplatform.set_rate_limit(msrc.max_request_rate)
+                # downloads that may each use several connections
+                mplatform.set_max_connections(
+                    src.jobs * (1 + chunked_download_max_parts))
+                server_stats.watch(mplatform)
+                src.mirrors.append(Mirror(m, mplatform))
+            # listings of a preceding xnat-init, only the first update uses
+            # them
+            src.platform.preload_listings(load_listings(
+                get_state_path(ds, src.name) / 'listings.json',
+                src.platform.url,
+                max_age=float(ds.config.get(
+                    'datalad.xnat.listing-max-age', listing_max_age)),
+                consume=not dry_run,
+            ))
+            src.journal = UpdateJournal(
+                get_state_path(ds, src.name) / 'update-journal.jsonl')
+            src.stats_path = get_state_path(ds, src.name) / \
+                'update-stats.jsonl'
+        if dry_run:
+            for src in sources:
+                with phase('resolve', project=' '.join(src.projects) or None) \
+                        as span:
+                    unit_type, units = _resolve_units(
+                        src.platform, src.projects, src.subjects,
+                        src.experiment, shard_spec)
+                    span.set_attribute(f'{unit_type}s', len(units))
+                yield from plan_update(
+                    ds, src.platform, units, unit_type, src.pathfmt,
+                    project=src.projects,
+                    experiment=src.experiment,
+                    collections=src.collections,
+                    cache=cache,
+                    download_rate=get_download_rate(src.stats_path),
+                    jobs=src.jobs,
+                )
+            return
+        for src in sources:
+            journal = src.journal
+            # everything that determines what a run will do
+            journal_params = dict(
+                url=src.platform.url,
+                project=' '.join(src.projects) or None,
+                subject=src.subjects,
+                experiment=src.experiment,
+                collection=src.collection,
+                pathfmt=src.pathfmt,
+                shard=shard,
+            )
+            if resume and journal.is_resumable(journal_params):
+                # no need to resolve anything again
+                src.unit_type, src.units = journal.unit_type, journal.units
+                lgr.info(
+                    'Resuming interrupted update of %s, %i of %i %ss done',
+                    src.name, len(journal.finished), len(src.units),
+                    src.unit_type)
+            else:
+                with phase('resolve',
+                           project=' '.join(src.projects) or None) as span:
+                    src.unit_type, src.units = _resolve_units(
+                        src.platform, src.projects, src.subjects,
+                        src.experiment, shard_spec)
+                    span.set_attribute(
+                        f'{src.unit_type}s', len(src.units))
+                journal.begin(journal_params, src.units, src.unit_type)
+            # new subdatasets get the XNAT authentication of the dataset,
+            # and of the mirrors
+            src.auth = [
+                dict(
+                    name=name,
+                    url=platform.url,
+                    credential_name=platform.credential_name,
+                )
+                for name, platform in [(src.name, src.platform)] + [
+                    (m.name, m.platform) for m in src.mirrors]
+                if platform.credential_name != 'anonymous'
+            ]
+            for auth in src.auth:
+                if auth['name'] != src.name:
+                    # mirror URLs are registered in the dataset itself too
+                    configure_dataset_auth(ds, **auth)
+
+            src.todo = [u for u in src.units if u not in journal.finished]
+            if len(src.todo) < len(src.units):
+                lgr.debug('Skipping %i finished %ss',
+                          len(src.units) - len(src.todo), src.unit_type)
+            # paths of the subdatasets that exist
+            src.provisioned = set()
+            if '//' in src.pathfmt and src.unit_type == 'subject':
+                # all subdatasets that are known before listing, at once
+                paths = [
+                    p for u in src.todo if u is not None
+                    for p in get_subject_dataset_paths(
+                        ds, src.pathfmt, get_unit_query(
+                            u, src.unit_type, src.projects)['subject'])
+                ]
+                with phase('provision') as span:
+                    span.set_attribute('subdatasets', len(provision_datasets(
+                        ds, paths, auth=src.auth, jobs=src.jobs)))
+                src.provisioned.update(paths)
+            # listing, plus downloads that may each use several connections
+            src.platform.set_max_connections(
+                src.jobs * (1 + chunked_download_max_parts))
+            src.units_iter = iter(src.todo)
+            # units that were in progress when a previous run was interrupted
+            src.interrupted = set(journal.inflight)
+            # number of units being listed
+            src.listing = 0
+        by_name = {src.name: src for src in sources}
+        unit_type = sources[0].unit_type \
+            if len({src.unit_type for src in sources}) == 1 else 'unit'
+
+        # listing and downloading of several units runs concurrently in
+        # threads, with pools of its own for every source. Anything that
+        # modifies the dataset happens right here, one unit or file at a
+        # time. Units are identified by (source name, unit) keys
+        listings = {}
+        # number of outstanding downloads per unit
+        pending = {}
+        nfiles = {}
+        failed = set()
+        # (digest-md5, byte-size) of the content of every download, mapped
+        # to further (unit, repo, path) targets for the same content
+        sharing = {}
+        # number and total size of files that need no download of their own
+        saved = [0, 0]
+        # content identifier -> path of downloaded content in the annex
+        fetched = {}
+        start_time = time.time()
+        progress = UpdateProgress(
+            sum(len(src.units) for src in sources),
+            unit_type=unit_type,
+            units_done=sum(
+                len(src.units) - len(src.todo) for src in sources),
+            platform=[src.platform for src in sources],
+            status_interval=float(
+                ds.config.get('datalad.xnat.status-interval', 60)),
+        )
+        with ExitStack() as stack:
+            for src in sources:
+                src.listing_pool = stack.enter_context(
+                    ThreadPoolExecutor(src.jobs))
+                src.downloads = DownloadScheduler(
+                    stack.enter_context(ThreadPoolExecutor(src.jobs)),
+                    src.jobs, progress=progress)
+            while True:
+                _submit_listings(sources, listings, force)
+                if not listings and not any(
+                        len(src.downloads) for src in sources):
+                    break
+                done, _ = wait(
+                    list(listings)
+                    + [f for src in sources for f in src.downloads.running],
+                    return_when=FIRST_COMPLETED)
+                for fut in done:
+                    # units whose files got results
+                    touched = []
+                    if fut in listings:
+                        key = listings.pop(fut)
+                        src = by_name[key[0]]
+                        src.listing -= 1
+                        try:
+                            table, records = fut.result()
+                        except _request_errors as e:
+                            ce = CapturedException(e)
+                            failed.add(key)
+                            progress.unit_done()
+                            yield dict(
+                                res,
+                                status='error',
+                                message=('Cannot list files for %s %s: %s',
+                                         src.unit_type, key[1], ce),
+                                exception=ce,
+                            )
+                            continue
+                        yield from records
+                        ok = [r for r in records if r['status'] == 'ok']
+                        nfiles[key] = len(ok)
+                        count('files_listed', nfiles[key])
+                        missing = _add_unit_files(
+                            ds, src, key[1], table, ok,
+                            ifexists=ifexists,
+                            reckless=reckless,
+                        )
+                        pending[key] = len(missing)
+                        progress.add_files(
+                            nfiles[key], done=nfiles[key] - len(missing))
+                        touched.append(key)
+                        injections = _queue_downloads(
+                            src, key, missing, sharing, fetched, saved,
+                            cache, server_stats)
+                    else:
+                        src = next(s for s in sources
+                                   if fut in s.downloads.running)
+                        injections = _finish_download(
+                            src, fut, sharing, fetched, cache)
+                    yield from _count_injections(
+                        injections, pending, failed, touched, progress)
+                    for k in dict.fromkeys(touched):
+                        if pending.get(k):
+                            continue
+                        progress.unit_done()
+                        if k not in failed:
+                            by_name[k[0]].journal.done(k[1], nfiles=nfiles[k])
+        progress.finish()
+        done_bytes = sum(src.downloads.done_bytes for src in sources)
+        count('downloaded_bytes', done_bytes)
+        count('deduplicated_files', saved[0])
+        count('failed_units', len(failed))
+        for src in sources:
+            if src.downloads.done_bytes:
+                # the download rate of every server on its own
+                record_run_stats(
+                    src.stats_path,
+                    bytes=src.downloads.done_bytes,
+                    seconds=time.time() - start_time,
+                )
+
+        if saved[0]:
+            lgr.info('Skipped downloading %i files (%s) with the same '
+                     'content as another file', saved[0],
+                     bytes2human(saved[1]))
+        for src in sources:
+            # keep the journal of a source with failures resumable
+            if not any(k[0] == src.name for k in failed):
+                src.journal.complete()
+        if failed:
+            return
         yield dict(
             res,
-            status='ok'
+            status='ok',
+            **(dict(message=(
+                'Skipped downloading %i files (%s) with duplicate content',
+                saved[0], bytes2human(saved[1])))
+               if saved[0] else {}),
+        )
+        return
+
+
+class _Source(object):
+    """An XNAT configuration of a dataset that an update processes
+
+    Settings of the configuration are overridden by any value that is
+    given. The update assigns the state of processing the source to
+    further attributes, e.g. its `platform` and `journal`.
+    """
+    def __init__(self, ds, name, project=None, subject=None,
+                 experiment=None, collection=None, credential=None):
+        cfg_section = 'datalad.xnat.{}'.format(name)
+        config = ds.config
+        self.name = name
+        # TODO fail is there is no URL
+        self.url = config.get(f'{cfg_section}.url')
+        # TODO fail without pathfmt
+        self.pathfmt = config.get(f'{cfg_section}.pathfmt')
+        if project is None:
+            project = config.get(f'{cfg_section}.project')
+        # several projects are configured as a whitespace-separated list
+        self.projects = project.split() if isinstance(project, str) \
+            else ensure_list(project)
+        if subject is None:
+            subject = config.get(f'{cfg_section}.subject')
+        self.subjects = ensure_list(subject)
+        if experiment is None:
+            experiment = config.get(f'{cfg_section}.experiment')
+        self.experiment = experiment
+        if collection is None:
+            collection = config.get(
+                f'{cfg_section}.collection', '').split()
+        self.collection = collection
+        self.collections = ensure_list(collection) if collection else None
+        self.credential = credential or config.get(
+            f'{cfg_section}.credential-name')
+        # concurrency budget, and requests per second
+        self.jobs = config.get(f'{cfg_section}.jobs')
+        rate = config.get(f'{cfg_section}.max-request-rate')
+        self.max_request_rate = float(rate) if rate else None
+        # names of XNAT configurations of servers with the same files
+        self.mirror_names = config.get(f'{cfg_section}.mirrors', '').split()
+
+
+# maximum number of downloads to queue, before listing more units
+_max_queued_downloads = 10000
+_exhausted = object()
+
+
+def _list_unit(platform, force=False, project=None, subject=None,
+               experiment=None, collections=None, mirrors=None):
+    """Query the files of a single unit, and build an addurls table
+
+    The URLs of the files on any of the `mirrors` are added to their
+    records as a 'mirror_urls' mapping of mirror names to URLs.
+
+    Returns
+    -------
+    Path, list
+      Location of the addurls table, and the query results.
+    """
+    from datalad_xnat.parser import parse_xnat
+
+    # all this tempfile madness is only needed because windows
+    # cannot open the same file twice. shame!
+    addurls_table, addurls_table_fname = mkstemp()
+    addurls_table_fname = Path(addurls_table_fname)
+    os.close(addurls_table)
+    try:
+        with phase('listing', project=project, subject=subject,
+                   experiment=experiment) as span:
+            with open(
+                    addurls_table_fname,
+                    'w',
+                    newline='',
+                    encoding='utf-8') as addurls_table:
+                records = list(parse_xnat(
+                    addurls_table,
+                    platform,
+                    force=force,
+                    project=project,
+                    subject=subject,
+                    experiment=experiment,
+                    collections=collections,
+                ))
+            ok = [r for r in records if r['status'] == 'ok']
+            span.set_attribute('files', len(ok))
+            span.set_attribute(
+                'bytes', sum(int(r.get('byte-size') or 0) for r in ok))
+        for mirror in mirrors or []:
+            with phase('mirror-listing', mirror=mirror.name) as span:
+                urls = mirror.get_urls(ok)
+                span.set_attribute('files', sum(u is not None for u in urls))
+            for rec, url in zip(ok, urls):
+                if url:
+                    rec.setdefault('mirror_urls', {})[mirror.name] = url
+    except BaseException:
+        addurls_table_fname.unlink()
+        raise
+    return addurls_table_fname, records
+
+
+def _submit_listings(sources, listings, force):
+    """Start listing the next units of every source
+
+    Listing is kept ahead of the downloads of a source, but not too far.
+
+    Parameters
+    ----------
+    sources: list
+      `_Source` instances.
+    listings: dict
+      Futures of running listings, mapped to (source name, unit) keys. New
+      listings are added to it.
+    """
+    from .plan import get_unit_query
+
+    for src in sources:
+        while src.listing < src.jobs \
+                and len(src.downloads) < _max_queued_downloads:
+            unit = next(src.units_iter, _exhausted)
+            if unit is _exhausted:
+                break
+            src.journal.start(unit)
+            src.listing += 1
+            listings[src.listing_pool.submit(
+                _list_unit,
+                src.platform,
+                collections=src.collections,
+                mirrors=src.mirrors,
+                force=force,
+                **get_unit_query(
+                    unit, src.unit_type, src.projects, src.experiment),
+            )] = (src.name, unit)
+
+
+def _add_unit_files(ds, src, unit, table, records, ifexists, reckless):
+    """Add the listed files of a unit to the dataset
+
+    Any subdatasets the files go into are created first. Files of a unit
+    that was interrupted by a previous run are skipped, if they exist
+    already, unless `ifexists` says otherwise.
+
+    Returns
+    -------
+    list
+      Files without content, see `_register_files()`.
+    """
+    from .plan import get_dataset_paths
+    from .provision import provision_datasets
+
+    lgr.info('Adding files for %s %s', src.unit_type, unit)
+    with phase('register', **{src.unit_type: unit}) as span:
+        # subdatasets need configuration, before addurls adds files to
+        # them. most exist already, for earlier files and units
+        paths = {
+            p for r in records
+            for p in get_dataset_paths(ds, src.pathfmt, r)
+        }.difference(src.provisioned) if '//' in src.pathfmt else None
+        if paths:
+            with phase('provision'):
+                provision_datasets(
+                    ds, sorted(paths), auth=src.auth, jobs=src.jobs)
+            src.provisioned.update(paths)
+        missing = _register_files(
+            ds,
+            table,
+            src.pathfmt,
+            records,
+            ifexists='skip'
+            if ifexists is None and unit in src.interrupted
+            else ifexists,
+            reckless=reckless,
+            jobs=src.jobs,
         )
+        span.set_attribute('missing_files', len(missing))
+    return missing
+
+
+def _register_files(ds, table, pathfmt, records, ifexists, reckless, jobs):
+    """Add the files of an addurls table to the dataset
+
+    Files with a known size and MD5 digest are only registered with their
+    annex key and URL, without downloading them. All other files are
+    downloaded by addurls. The URLs of files on mirrors are registered
+    as further URLs of the files.
+
+    Returns
+    -------
+    list
+      (repo, path, record) tuples of the files without content, where `path`
+      is relative to the root of `repo`. Empty for reckless updates.
+    """
+    from .plan import get_file_location
+
+    # corresponds to the header field 'filename' in the csv table
+    filename = '{filename}'
+    filenameformat = f"{pathfmt}{filename}"
+    try:
+        with phase('addurls', files=len(records)) as span:
+            try:
+                results = ds.addurls(
+                    str(table), '{url}', filenameformat,
+                    key='et:MD5-s{byte_size}--{md5}',
+                    ifexists=ifexists,
+                    fast=True if reckless == 'fast'
+                    else False,
+                    save=True,
+                    jobs=jobs,
+                    result_renderer='default')
+            finally:
+                if '//' in pathfmt:
+                    _save_subdatasets(ds, pathfmt, records)
+            # saving, and the creation of new datasets are part of addurls
+            for action in ('create', 'save'):
+                span.set_attribute(
+                    f'{action}s',
+                    sum(r.get('action') == action for r in results))
+            # files are added by key, or by downloading them
+            added = sum(r.get('action') in ('fromkey', 'addurl')
+                        and r.get('status') == 'ok' for r in results)
+            span.set_attribute('files_added', added)
+        count('files_added', added)
+    finally:
+        table.unlink()
+    _register_mirror_urls(ds, pathfmt, records)
+    if reckless == 'fast':
+        return []
+
+    # group by the (sub)dataset containing the file
+    by_ds = {}
+    for rec in records:
+        if not (rec.get('byte-size') and rec.get('digest-md5')):
+            # downloaded by addurls
+            continue
+        dspath, path = get_file_location(ds, pathfmt, rec)
+        by_ds.setdefault(dspath, []).append((path, rec))
+
+    missing = []
+    for dspath, files in by_ds.items():
+        repo = Dataset(dspath).repo
+        has_content = repo.file_has_content([p for p, _ in files])
+        missing.extend(
+            (repo, p, rec)
+            for (p, rec), present in zip(files, has_content)
+            if not present
+        )
+    return missing
+
+
+def _save_subdatasets(ds, pathfmt, records):
+    """Record the state of the subdatasets of files in their superdatasets
+
+    The save of addurls does this only for the subdatasets that it creates.
+    """
+    from .plan import get_file_location
+
+    ds.save(
+        path=sorted({
+            str(dspath) for dspath, _ in (
+                get_file_location(ds, pathfmt, rec) for rec in records)
+            if dspath != ds.pathobj
+        }),
+        message='Record the state of XNAT subdatasets',
+        result_renderer='disabled',
+    )
+
+
+def _register_mirror_urls(ds, pathfmt, records):
+    """Register the 'mirror_urls' of file records in the annex"""
+    from datalad.support.exceptions import CommandError
+    from .plan import get_file_location
+
+    repos = {}
+    with phase('mirror-urls') as span:
+        nurls = 0
+        for rec in records:
+            urls = rec.get('mirror_urls')
+            if not urls:
+                continue
+            dspath, path = get_file_location(ds, pathfmt, rec)
+            repo = repos.get(dspath)
+            if repo is None:
+                repo = repos[dspath] = Dataset(dspath).repo
+            for url in urls.values():
+                try:
+                    # no download to verify the URL, the digest matched
+                    repo.add_url_to_file(
+                        path, url, options=['--relaxed'], batch=True)
+                    nurls += 1
+                except CommandError as e:
+                    ce = CapturedException(e)
+                    lgr.warning('Cannot register mirror URL %s: %s', url, ce)
+        for repo in repos.values():
+            # end the batched addurl processes
+            repo.precommit()
+        span.set_attribute('urls', nurls)
+
+
+def _download_file(candidates, repo, size, md5, cache, stats,
+                   progress=None):
+    """Download a file from the fastest candidate, as a phase of the update
+
+    Parameters
+    ----------
+    candidates: list
+      (platform, url) tuples of the tracked server, and of any mirror.
+    stats: ServerStats
+    """
+    from .download import download_file
+    from .mirror import download_from_fastest
+    with phase('download', url=candidates[0][1], bytes=size,
+               candidates=len(candidates)):
+        if len(candidates) == 1:
+            platform, url = candidates[0]
+            return download_file(platform, url, repo, size, md5, cache,
+                                 progress=progress)
+        return download_from_fastest(
+            candidates, stats, repo, size, md5, cache, progress=progress)
+
+
+def _queue_downloads(src, unit, missing, sharing, fetched, saved, cache,
+                     server_stats):
+    """Schedule the downloads of the files of a unit without content
+
+    Content that is downloaded already, or is being downloaded, for another
+    file is not downloaded again.
+
+    Parameters
+    ----------
+    unit: tuple
+      (source name, unit) key of the unit.
+    missing: list
+      (repo, path, record) tuples, see `_register_files()`.
+    sharing: dict
+      Content identifiers of running and queued downloads, mapped to further
+      (unit, repo, path) targets of their content.
+    fetched: dict
+      Content identifiers mapped to a (repo, path) file that received
+      the downloaded content.
+    saved: list
+      Number and total size of files that need no download of their own.
+
+    Yields
+    ------
+    tuple
+      (unit, repo, path, result) for files that got content from another
+      repository, see `_inject_content()`.
+    """
+    from .query_files import get_content_id
+
+    for repo, relpath, rec in missing:
+        content = get_content_id(rec)
+        # the content may be in another repository already
+        obj = _get_annex_object(*fetched[content]) \
+            if content in fetched and content not in sharing else None
+        if content in sharing or obj:
+            saved[0] += 1
+            saved[1] += content[1]
+        if content in sharing:
+            # same content is downloaded already, from this or another
+            # server
+            sharing[content].append((unit, repo, relpath))
+            continue
+        if obj:
+            yield from _inject_content(
+                obj, [(unit, repo, relpath)], keep_src=True)
+            continue
+        sharing[content] = []
+        src.downloads.add(
+            content[1],
+            _download_file,
+            ([(src.platform, rec['url'])] + [
+                (m.platform, rec['mirror_urls'][m.name])
+                for m in src.mirrors
+                if m.name in rec.get('mirror_urls', {})],
+             repo, content[1], content[0], cache, server_stats),
+            item=(unit, repo, relpath, content),
+        )
+    src.downloads.dispatch()
+
+
+def _finish_download(src, fut, sharing, fetched, cache):
+    """Inject the content of a completed download into all its files
+
+    See `_queue_downloads()` for the parameters. Content that git-annex
+    rejects is removed from the `cache`, it may come from there.
+
+    Yields
+    ------
+    tuple
+      (unit, repo, path, result), see `_inject_content()`.
+    """
+    unit, repo, relpath, content = src.downloads.pop(fut)
+    targets = [(unit, repo, relpath)] + sharing.pop(content)
+    try:
+        downloaded = fut.result()
+    except _request_errors as e:
+        yield from _fail_injections(e, targets)
         return
+    for injection in _inject_content(downloaded, targets):
+        if injection[3]['status'] == 'ok':
+            # the content can be taken from this file from now on
+            fetched[content] = injection[1:3]
+        elif cache:
+            cache.discard(*content)
+        yield injection
+
+
+def _get_annex_object(repo, path):
+    """Return the path of the annex object of a file, if it has content
+
+    Returns
+    -------
+    Path or None
+    """
+    key = repo.get_file_annexinfo(repo.pathobj / path).get('key')
+    loc = repo.get_contentlocation(key) if key else None
+    return repo.pathobj / loc if loc else None
+
+
+def _inject_content(src, targets, keep_src=False):
+    """Inject content into all files of the same content
+
+    Parameters
+    ----------
+    src: Path
+      File with the content. It is moved into the annex of the first
+      target, unless `keep_src` is set.
+    targets: list
+      (unit, repo, path) tuples of the files with the content of `src`.
+
+    Yields
+    ------
+    tuple
+      (unit, repo, path, result) for each target.
+    """
+    from .download import (
+        clone_file,
+        get_annex_tmp_path,
+        inject_file,
+    )
+    # every repository needs its own copy, annex keys are shared
+    # by all files in a repository
+    sources = {} if keep_src else {targets[0][1].path: src}
+    errors = {}
+    for unit, repo, path in targets:
+        if repo.path in sources:
+            continue
+        fd, dest = mkstemp(prefix='xnat-', dir=str(get_annex_tmp_path(repo)))
+        os.close(fd)
+        dest = Path(dest)
+        dest.unlink()
+        try:
+            clone_file(src, dest)
+        except OSError as e:
+            errors[repo.path] = str(e)
+        sources[repo.path] = dest
+    for unit, repo, path in targets:
+        if repo.path not in errors:
+            errors[repo.path] = inject_file(repo, sources[repo.path], path)
+        error = errors[repo.path]
+        yield unit, repo, path, _get_download_result(
+            repo, path,
+            status='error' if error else 'ok',
+            message=error)
+
+
+def _fail_injections(exc, targets):
+    """Report a failed download for all files of its content"""
+    ce = CapturedException(exc)
+    for unit, repo, path in targets:
+        yield unit, repo, path, _get_download_result(
+            repo, path, status='error', message=str(ce), exception=ce)
+
+
+def _count_injections(injections, pending, failed, touched, progress):
+    """Yield the results of injections, and account for them per unit"""
+    for unit, _, _, result in injections:
+        progress.file_done()
+        pending[unit] -= 1
+        if result['status'] != 'ok':
+            failed.add(unit)
+        touched.append(unit)
+        yield result
+
+
+def _get_download_result(repo, path, **kwargs):
+    return dict(
+        action='xnat_download',
+        type='file',
+        path=str(repo.pathobj / path),
+        logger=lgr,
+        **{k: v for k, v in kwargs.items() if v is not None}
+    )
+
+
+def _resolve_units(platform, projects, subjects, experiment, shard=None):
+    """Determine the units of work to process one at a time
+
+    Parameters
+    ----------
+    projects: list
+      With several projects, subject units are qualified by their project,
+      see `get_unit_query()`.
+    shard: tuple, optional
+      1-based index and count of the shard to select.
+
+    Returns
+    -------
+    str, list
+      Type of units ('subject' or 'experiment'), and their IDs. A single
+      `None` item means no constraint.
+    """
+    from .shard import select_shard
+
+    def qualify(project, subject):
+        return f'{project}/{subject}' if len(projects) > 1 else subject
+
+    # parse and download one subject at a time
+    # we could also make one big query
+    if experiment is not None:
+        # no need to query
+        units = [None]
+    elif subjects:
+        # we can go with the subjects as-is
+        units = [qualify(p, s) for s in subjects for p in projects or [None]]
+    elif projects:
+        # we have a project constraint, we can resolve subjects, and
+        # alternate between projects, for a schedule that progresses in
+        # all of them
+        units = [
+            u for us in zip_longest(*(
+                [qualify(p, s) for s in platform.get_subject_ids(p)]
+                for p in projects))
+            for u in us if u is not None
+        ]
+    else:
+        # we have nothing to compartmentalize the query
+        # go with a single big one
+        units = [None]
+    if not shard:
+        return 'subject', units
+
+    if units == [None]:
+        # no subjects to distribute, go with experiments
+        return 'experiment', select_shard(
+            ensure_list(experiment) if experiment
+            else [e for p in projects or [None]
+                  for e in platform.get_experiment_ids(project=p)],
+            *shard)
+    # balance by the number of experiments, all shards get the same answer
+    # with a single request per project
+    weights = {}
+    for p in projects:
+        for er in platform.get_experiments(project=p):
+            er = {k.lower(): v for k, v in er.items()}
+            u = qualify(p, er['subject_id'])
+            weights[u] = weights.get(u, 0) + 1
+    return 'subject', select_shard(units, *shard, weights=weights)